@@ -0,0 +1,253 @@
+"""
+Annotates archives of games played on the board, such as the PGN files
+written by LichessBroadcaster. Every move gets an [%eval] comment, and
+moves that lose too much of the winning chances are marked as
+inaccuracy (?!), mistake (?) or blunder (??), using the same winning
+chances as Lichess.
+
+    python BatchAnalysis.py games.pgn annotated.pgn [--depth 14 | --time 0.2] [--workers 8]
+
+Games are read from the archive one at a time and analysed in a pool of
+processes, each running its own engine (STOCKFISH_LOCATION) with a
+single thread. Only a few games per process are in flight, so memory use
+does not depend on the size of the archive. Annotated games are written
+in archive order, and progress is checkpointed after every game: running
+the same command again after an interruption continues where it stopped.
+A game that can't be analysed is written without annotations, with the
+error in its comment, and the archive continues with the next game.
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import multiprocessing.util
+import os
+import signal
+import time
+
+import chess
+import chess.engine
+import chess.pgn
+
+import env
+
+# Loss of winning chances, as an expected score between 0 and 1, for a move to be annotated
+INACCURACY = 0.05
+MISTAKE = 0.1
+BLUNDER = 0.15
+
+# Games queued per worker process, enough to keep every engine busy
+GAMES_PER_WORKER = 2
+
+# Engine of the worker process, started once and used for every game it analyses
+engine = None
+engine_finalizer = None
+limit = None
+engine_settings = None
+
+def start_worker(path, engine_limit, options):
+    global limit, engine_settings
+
+    # Ctrl+C is handled by the main process, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    limit = engine_limit
+    engine_settings = (path, options)
+    start_engine()
+
+# Starts the engine of the worker, stopping the previous one if there is one
+def start_engine():
+    global engine, engine_finalizer
+    if engine_finalizer is not None:
+        engine_finalizer()
+
+    path, options = engine_settings
+    engine = chess.engine.SimpleEngine.popen_uci(path)
+    engine.configure({name: value for name, value in options.items() if name in engine.options})
+
+    # The engine runs its own thread, which would keep the worker process alive when the pool shuts down
+    engine_finalizer = multiprocessing.util.Finalize(None, stop_engine, args=(engine,), exitpriority=0)
+
+def stop_engine(worker_engine):
+    try:
+        worker_engine.quit()
+    except chess.engine.EngineError:
+        pass
+
+def evaluate(board):
+    # Finished games are scored without asking the engine
+    if board.is_checkmate():
+        return chess.engine.PovScore(chess.engine.Mate(0), board.turn), None
+    if board.is_stalemate() or board.is_insufficient_material():
+        return chess.engine.PovScore(chess.engine.Cp(0), board.turn), None
+
+    info = engine.analyse(board, limit)
+    return info["score"], info.get("depth")
+
+def classify(before, after, mover):
+    loss = before.pov(mover).wdl(model="lichess").expectation() - after.pov(mover).wdl(model="lichess").expectation()
+    if loss >= BLUNDER:
+        return chess.pgn.NAG_BLUNDER
+    if loss >= MISTAKE:
+        return chess.pgn.NAG_MISTAKE
+    if loss >= INACCURACY:
+        return chess.pgn.NAG_DUBIOUS_MOVE
+    return None
+
+# Runs in a worker process. Annotates the mainline of a game, returning the annotated PGN and the number of positions
+# analysed. An engine that crashed is replaced for the next game, the error is raised for this one.
+def analyse_game(pgn):
+    try:
+        return annotate_game(pgn)
+    except chess.engine.EngineTerminatedError:
+        start_engine()
+        raise
+
+def annotate_game(pgn):
+    game = chess.pgn.read_game(io.StringIO(pgn))
+    board = game.board()
+    before, _ = evaluate(board)
+    positions = 1
+
+    node = game
+    while node.variations:
+        node = node.variation(0)
+        mover = board.turn
+        board.push(node.move)
+
+        after, depth = evaluate(board)
+        positions += 1
+        node.set_eval(after, depth)
+
+        nag = classify(before, after, mover)
+        if nag:
+            node.nags.add(nag)
+        before = after
+
+    game.headers["Annotator"] = f"{engine.id.get('name', 'Engine')} ({describe(limit)})"
+    return str(game), positions
+
+# The game as read from the archive, with the reason the analysis failed as its comment
+def failed_game(pgn, error):
+    game = chess.pgn.read_game(io.StringIO(pgn))
+    game.comment = f"Analysis failed: {error!r}"
+    return str(game)
+
+def describe(engine_limit):
+    return f"depth {engine_limit.depth}" if engine_limit.depth else f"{engine_limit.time} s per move"
+
+# Yields the games of an archive as PGN text, skipping the first skip games
+def read_games(pgn_file, skip=0):
+    for _ in range(skip):
+        if not chess.pgn.skip_game(pgn_file):
+            return
+    while (game := chess.pgn.read_game(pgn_file)) is not None:
+        yield str(game)
+
+def load_checkpoint(path, input_path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint.get("input") != os.path.abspath(input_path):
+        print(f"Ignoring {path}, it belongs to another archive.")
+        return None
+    return checkpoint
+
+def save_checkpoint(path, checkpoint):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temp_path, path)
+
+def run(input_path, output_path, engine_path, engine_limit, options, workers):
+    checkpoint_path = f"{output_path}.checkpoint"
+    checkpoint = load_checkpoint(checkpoint_path, input_path)
+
+    # Continue after the last completed game, dropping anything written after it
+    if checkpoint and os.path.exists(output_path):
+        os.truncate(output_path, checkpoint["output_size"])
+        output = open(output_path, "a")
+        print(f"Resuming after {checkpoint['games']} games.")
+    else:
+        checkpoint = {"input": os.path.abspath(input_path), "games": 0, "positions": 0, "output_size": 0}
+        output = open(output_path, "w")
+
+    started = time.perf_counter()
+    games = positions = failed = 0
+
+    with open(input_path) as pgn_file, output, concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=start_worker, initargs=(engine_path, engine_limit, options)) as pool:
+        pending = {}
+        submitted = written = checkpoint["games"]
+        archive = read_games(pgn_file, skip=written)
+
+        try:
+            while True:
+                while len(pending) < workers * GAMES_PER_WORKER:
+                    pgn = next(archive, None)
+                    if pgn is None:
+                        break
+                    pending[submitted] = pgn, pool.submit(analyse_game, pgn)
+                    submitted += 1
+                if not pending:
+                    break
+
+                # Games are written in archive order, later games keep analysing in the meantime
+                pgn, future = pending.pop(written)
+                try:
+                    annotated, game_positions = future.result()
+                except concurrent.futures.BrokenExecutor:
+                    raise
+                except Exception as e:
+                    # Only this game is lost, for instance to an unreadable PGN or an engine crash
+                    print(f"Game {written + 1} could not be analysed: {e!r}")
+                    annotated, game_positions = failed_game(pgn, e), 0
+                    failed += 1
+                output.write(annotated + "\n\n")
+                output.flush()
+                written += 1
+
+                games += 1
+                positions += game_positions
+                checkpoint.update(games=written, positions=checkpoint["positions"] + game_positions,
+                                  output_size=output.tell())
+                save_checkpoint(checkpoint_path, checkpoint)
+
+                elapsed = time.perf_counter() - started
+                print(f"{written} games, {positions / elapsed:.1f} positions/s")
+        except KeyboardInterrupt:
+            # Games that did not start yet are dropped, the checkpoint has everything written so far
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    os.remove(checkpoint_path)
+    elapsed = time.perf_counter() - started
+    print(f"Analysed {games} games, {positions} positions in {elapsed:.1f} s with {workers} workers "
+          f"({games / elapsed:.2f} games/s, {positions / elapsed:.1f} positions/s)")
+    if failed:
+        print(f"{failed} games could not be analysed, see the comments in {output_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate a PGN archive with engine evaluations.")
+    parser.add_argument("input", help="PGN archive to analyse")
+    parser.add_argument("output", help="Annotated PGN to write")
+    parser.add_argument("--depth", type=int, default=None, help="Search depth per position (default 12)")
+    parser.add_argument("--time", type=float, default=None, help="Search time per position in seconds, instead of a depth")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of engine processes")
+    parser.add_argument("--hash", type=int, default=64, help="Hash size per engine in MB")
+    parser.add_argument("--engine", default=env.STOCKFISH_LOCATION, help="UCI engine to use")
+    args = parser.parse_args()
+
+    engine_limit = chess.engine.Limit(time=args.time) if args.time and not args.depth else \
+        chess.engine.Limit(depth=args.depth or 12)
+    options = {"Threads": 1, "Hash": args.hash}
+
+    try:
+        run(args.input, args.output, args.engine, engine_limit, options, args.workers)
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to continue.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""
+Replays games through move detection the way the SquareOff Pro reports
+them, to measure detection speed and catch regressions in castling,
+en passant and promotion handling.
+
+Every move of a PGN corpus is detected twice, through both paths a real
+board takes:
+
+- reads: the squares that are picked up and the 30# occupation bitmap
+  read after the piece is put down (two reads for castling, king first),
+  fed through occupation parsing, SquareOffInstance.find_uci_move and
+  _push_and_return.
+- events: the 0#<square>u* and 0#<square>d* frames of the pickups and
+  putdowns (as BoardSimulator sends them), fed through
+  ChessBoardUARTHandler.handle_square_message, which infers the move from
+  the events or requests a board read. Requested reads are answered right
+  away, as the board would.
+
+The detected moves are compared with the game, and misdetections are
+counted per path. The report is written as JSON, so runs can be compared.
+Run from the repository root:
+
+    python -m Benchmarks.detection games.pgn [--output detection.json] [--compare previous.json]
+    python -m Benchmarks.detection --random 500
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import chess
+import chess.pgn
+
+from BoardConfig import BoardConfig
+from ChessboardInstance import ChessboardInstance
+from SquareOffInstance import SquareOffInstance
+from UartComm import ChessBoardUARTHandler
+import GeneralHelpers
+
+RANDOM_GAME_PLIES = 300
+
+# Stands in for ChessBoardUARTHandler on the read path, detection only sends LED commands through it. On the event
+# path it is the transport of the handler, board reads are answered by the benchmark instead.
+class CommandSink:
+    def __init__(self):
+        self.commands = 0
+
+    async def send_command(self, data, priority=None):
+        self.commands += 1
+
+    async def write(self, data):
+        self.commands += 1
+
+    async def start_notify(self, callback):
+        pass
+
+def move_kind(board, move):
+    if board.is_castling(move):
+        return "castling"
+    if board.is_en_passant(move):
+        return "en_passant"
+    if move.promotion:
+        return "promotion"
+    if board.is_capture(move):
+        return "capture"
+    return "normal"
+
+# The 0# frames of every step a player uses to make the move, each a list of (square, "u" or "d"). Castling is split
+# in the king move and the rook move.
+def event_steps(board, move):
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        kingside = board.is_kingside_castling(move)
+        king_to = chess.square(6 if kingside else 2, rank)
+        rook_from = chess.square(7 if kingside else 0, rank)
+        rook_to = chess.square(5 if kingside else 3, rank)
+        return [[(move.from_square, "u"), (king_to, "d")], [(rook_from, "u"), (rook_to, "d")]]
+
+    events = []
+    if board.is_en_passant(move):
+        events.append((chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)), "u"))
+    elif board.piece_at(move.to_square):
+        events.append((move.to_square, "u"))
+    return [events + [(move.from_square, "u"), (move.to_square, "d")]]
+
+# The squares picked up and the 30# payload read afterwards, for every step a player uses to make the move
+def move_steps(board, move):
+    after = board.copy(stack=False)
+    after.push(move)
+
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        kingside = board.is_kingside_castling(move)
+        king_to = chess.square(6 if kingside else 2, rank)
+        rook_from = chess.square(7 if kingside else 0, rank)
+        king_placed = board.occupied & ~chess.BB_SQUARES[move.from_square] | chess.BB_SQUARES[king_to]
+        return [([move.from_square], GeneralHelpers.mask_to_occupation_string(king_placed)),
+                ([rook_from], GeneralHelpers.mask_to_occupation_string(after.occupied))]
+
+    pickups = [move.from_square]
+    if board.is_en_passant(move):
+        pickups.insert(0, chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)))
+    elif board.piece_at(move.to_square):
+        pickups.insert(0, move.to_square)
+    return [(pickups, GeneralHelpers.mask_to_occupation_string(after.occupied))]
+
+def read_corpus(path):
+    with open(path) as pgn:
+        while (game := chess.pgn.read_game(pgn)) is not None:
+            yield game.board(), list(game.mainline_moves())
+
+# Games of random legal moves, which run into castling, en passant and (under)promotions far more often than real games
+def random_corpus(games, seed):
+    rng = random.Random(seed)
+    for _ in range(games):
+        board = chess.Board()
+        moves = []
+        while len(moves) < RANDOM_GAME_PLIES and not board.is_game_over():
+            move = rng.choice(list(board.legal_moves))
+            moves.append(move)
+            board.push(move)
+        yield chess.Board(), moves
+
+class DetectionBenchmark:
+    def __init__(self):
+        self.config = BoardConfig(ENGINE_PLAYERS=[], PLAY_LICHESS_GAME=False)
+        self.event_config = BoardConfig(parent=self.config, ENABLE_LICHESS_BROADCAST=False, GAME_JOURNAL_PATH=None,
+                                        RECORD_NOTIFICATIONS=None, LIVE_ANALYSIS=False, INFER_MOVES_FROM_EVENTS=True)
+        self.samples = {"parse_read": [], "find_uci_move": [], "push": [], "event_move": [],
+                        "reorder_file_major_to_rank_major": [], "board_to_occupation_string": []}
+        self.kinds = {}
+        self.misdetections = []
+        self.helper_mismatches = {"reorder_file_major_to_rank_major": 0, "board_to_occupation_string": 0}
+        self.games = 0
+        self.moves = 0
+        self.replay_ns = 0
+        self.event_ns = 0
+        self.handler = None
+
+    def new_game(self, board):
+        self.chessboardInstance = ChessboardInstance(initial_fen=board.fen(), config=self.config)
+        self.squareOffInstance = SquareOffInstance(chessboardInstance=self.chessboardInstance, config=self.config)
+        self.squareOffInstance.uart_handler = CommandSink()
+
+    # Starts a game on a ChessBoardUARTHandler for the event path, with the physical board read once
+    async def new_event_game(self, board):
+        await self.close()
+        self.occupancy = board.occupied
+        self.handler = ChessBoardUARTHandler(transport=CommandSink(),
+                                             config=BoardConfig(parent=self.event_config, STARTING_FEN=board.fen()))
+        await self.handler.start_game()
+        await self.answer_read()
+
+    async def answer_read(self):
+        await self.handler.handle_board_read(f"30#{GeneralHelpers.mask_to_occupation_string(self.occupancy)}*")
+
+    async def close(self):
+        if self.handler is not None:
+            await self.handler.stop_game()
+            self.handler = None
+
+    async def replay_game(self, board, moves):
+        self.new_game(board)
+        await self.new_event_game(board)
+        self.games += 1
+        for ply, move in enumerate(moves):
+            kind = move_kind(board, move)
+            counts = self.kinds.setdefault(kind, {"moves": 0, "misdetected": 0, "misdetected_events": 0,
+                                                  "inferred": 0})
+            counts["moves"] += 1
+            self.moves += 1
+
+            detected = await self.replay_move(board, move)
+            inferred = self.handler.inferred_moves
+            detected_events = await self.replay_move_events(board, move)
+            if self.handler.inferred_moves > inferred:
+                counts["inferred"] += 1
+            board.push(move)
+
+            # Continue from the correct position after a misdetection
+            if detected != move:
+                counts["misdetected"] += 1
+                self.add_misdetection("reads", ply, kind, move, detected)
+                self.new_game(board)
+            if detected_events != move:
+                counts["misdetected_events"] += 1
+                self.add_misdetection("events", ply, kind, move, detected_events)
+                await self.new_event_game(board)
+
+    def add_misdetection(self, path, ply, kind, move, detected):
+        self.misdetections.append({"game": self.games, "ply": ply + 1, "path": path, "kind": kind,
+                                   "expected": move.uci(), "detected": detected.uci() if detected else None})
+
+    # Returns the last move on the ChessboardInstance after all steps of the move, None if nothing was pushed
+    async def replay_move(self, board, move):
+        squareOffInstance = self.squareOffInstance
+        chessboardInstance = self.chessboardInstance
+        expected_plies = len(chessboardInstance.board.move_stack) + 1
+        chessboardInstance.pending_promotion = move.promotion
+
+        for pickups, read in move_steps(board, move):
+            started = time.perf_counter_ns()
+            for square in pickups:
+                squareOffInstance.picked_up_squares.add(chess.square_name(square))
+
+            new_occupancy = GeneralHelpers.occupation_string_to_mask(read)
+            parsed = time.perf_counter_ns()
+            madeMove = await squareOffInstance.find_uci_move(new_occupancy=new_occupancy)
+            found = time.perf_counter_ns()
+            if madeMove:
+                squareOffInstance._push_and_return(madeMove)
+            pushed = time.perf_counter_ns()
+
+            self.samples["parse_read"].append(parsed - started)
+            self.samples["find_uci_move"].append(found - parsed)
+            self.samples["push"].append(pushed - found)
+            self.replay_ns += pushed - started
+
+            # Helpers outside of the detection path, timed separately and checked against the read
+            started = time.perf_counter_ns()
+            rank_major = squareOffInstance.reorder_file_major_to_rank_major(read)
+            self.samples["reorder_file_major_to_rank_major"].append(time.perf_counter_ns() - started)
+            if rank_major != "".join("1" if new_occupancy >> square & 1 else "0" for square in chess.SQUARES):
+                self.helper_mismatches["reorder_file_major_to_rank_major"] += 1
+
+            started = time.perf_counter_ns()
+            occupation = chessboardInstance.board_to_occupation_string()
+            self.samples["board_to_occupation_string"].append(time.perf_counter_ns() - started)
+            if chessboardInstance.occupation_mask() == new_occupancy and occupation != read:
+                self.helper_mismatches["board_to_occupation_string"] += 1
+
+        if len(chessboardInstance.board.move_stack) != expected_plies:
+            return None
+        return chessboardInstance.board.move_stack[-1]
+
+    # Makes the move with pickup and putdown frames, answering the board reads the handler asks for. Returns the last
+    # move on the ChessboardInstance afterwards, None if nothing was pushed.
+    async def replay_move_events(self, board, move):
+        handler = self.handler
+        chessboardInstance = handler.chessboardInstance
+        expected_plies = len(chessboardInstance.board.move_stack) + 1
+        chessboardInstance.pending_promotion = move.promotion
+
+        started = time.perf_counter_ns()
+        for events in event_steps(board, move):
+            for square, event in events:
+                mask = chess.BB_SQUARES[square]
+                self.occupancy = self.occupancy & ~mask if event == "u" else self.occupancy | mask
+
+                # A putdown that was not inferred sent a board read
+                inferred = handler.inferred_moves
+                await handler.handle_square_message(f"0#{chess.square_name(square)}{event}*")
+                if event == "d" and handler.inferred_moves == inferred:
+                    await self.answer_read()
+        elapsed = time.perf_counter_ns() - started
+        self.samples["event_move"].append(elapsed)
+        self.event_ns += elapsed
+
+        if len(chessboardInstance.board.move_stack) != expected_plies:
+            return None
+        return chessboardInstance.board.move_stack[-1]
+
+    def report(self, corpus) -> dict:
+        latencies = {}
+        for name, samples in self.samples.items():
+            samples.sort()
+            if not samples:
+                continue
+            latencies[name] = {
+                "calls": len(samples),
+                **{f"p{q}_us": samples[min(len(samples) - 1, int(q / 100 * len(samples)))] / 1000 for q in (50, 90, 99)},
+                "max_us": samples[-1] / 1000,
+            }
+        return {
+            "corpus": corpus,
+            "games": self.games,
+            "moves": self.moves,
+            "moves_per_s": self.moves / (self.replay_ns / 1e9) if self.replay_ns else None,
+            "event_moves_per_s": self.moves / (self.event_ns / 1e9) if self.event_ns else None,
+            "latency": latencies,
+            "kinds": self.kinds,
+            "misdetected": sum(1 for misdetection in self.misdetections if misdetection["path"] == "reads"),
+            "misdetected_events": sum(1 for misdetection in self.misdetections if misdetection["path"] == "events"),
+            "misdetections": self.misdetections,
+            "helper_mismatches": self.helper_mismatches,
+        }
+
+def print_report(report, previous=None):
+    print(f"{report['corpus']}: {report['games']} games, {report['moves']} moves, {report['moves_per_s']:.0f} moves/s "
+          f"from reads, {report['event_moves_per_s']:.0f} moves/s from events")
+    if previous:
+        print(f"  previous run: {previous['moves_per_s']:.0f} moves/s "
+              f"({report['moves_per_s'] / previous['moves_per_s'] - 1:+.1%})")
+    for name, latency in report["latency"].items():
+        line = f"  {name:34} p50 {latency['p50_us']:7.1f} us  p90 {latency['p90_us']:7.1f} us  p99 {latency['p99_us']:7.1f} us"
+        if previous and name in previous["latency"]:
+            line += f"  (p50 was {previous['latency'][name]['p50_us']:.1f} us)"
+        print(line)
+    for kind, counts in sorted(report["kinds"].items()):
+        print(f"  {kind:12} {counts['moves']:7} moves, {counts['misdetected']} misdetected from reads, "
+              f"{counts['misdetected_events']} from events ({counts['inferred']} inferred without a read)")
+    for name, mismatches in report["helper_mismatches"].items():
+        if mismatches:
+            print(f"  {name} disagreed with the board read {mismatches} times")
+    for misdetection in report["misdetections"][:10]:
+        print(f"  game {misdetection['game']} ply {misdetection['ply']} ({misdetection['path']}): expected "
+              f"{misdetection['expected']}, detected {misdetection['detected']}")
+
+async def run(corpus, name):
+    benchmark = DetectionBenchmark()
+    try:
+        for board, moves in corpus:
+            await benchmark.replay_game(board, moves)
+    finally:
+        await benchmark.close()
+    return benchmark.report(name)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark move detection over a PGN corpus.")
+    parser.add_argument("pgn", nargs="?", help="PGN corpus to replay")
+    parser.add_argument("--random", type=int, default=0, help="Replay this many random games instead")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for random games")
+    parser.add_argument("--output", default="detection.json", help="JSON report to write")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+
+    if args.random:
+        corpus, name = random_corpus(args.random, args.seed), f"{args.random} random games (seed {args.seed})"
+    elif args.pgn:
+        corpus, name = read_corpus(args.pgn), args.pgn
+    else:
+        parser.error("a PGN corpus or --random is required")
+
+    report = asyncio.run(run(corpus, name))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+    print_report(report, previous)
+
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Checks FrameParser against randomly fragmented and coalesced notification
+streams, and measures its throughput compared to decoding and matching
+every notification as a whole (which only works when notifications and
+messages line up).
+Run from the repository root: python -m Benchmarks.frame_parser
+"""
+
+import random
+import time
+
+import chess
+
+import FrameParser
+import GeneralHelpers
+
+FUZZ_ROUNDS = 2000
+MESSAGES = 20000
+
+def random_message(rng):
+    kind = rng.random()
+    square = chess.square_name(rng.randrange(64))
+    if kind < 0.4:
+        return f"0#{square}u*".encode()
+    if kind < 0.8:
+        return f"0#{square}d*".encode()
+    return f"30#{GeneralHelpers.mask_to_occupation_string(rng.getrandbits(64))}*".encode()
+
+# Splits a byte stream in notifications of random size, from single bytes to several messages
+def random_chunks(rng, stream, max_size):
+    chunks = []
+    position = 0
+    while position < len(stream):
+        size = rng.randint(1, max_size)
+        chunks.append(stream[position:position + size])
+        position += size
+    return chunks
+
+def fuzz(rng):
+    for _ in range(FUZZ_ROUNDS):
+        messages = [random_message(rng) for _ in range(rng.randint(1, 20))]
+        stream = b"".join(message + rng.choice([b"", b"", b"\r\n"]) for message in messages)
+
+        parser = FrameParser.FrameParser()
+        frames = []
+        for chunk in random_chunks(rng, stream, rng.choice([3, 20, 100, 300])):
+            frames += [frame.tobytes() for frame in parser.feed(bytearray(chunk))]
+
+        assert frames == messages, (messages, frames)
+        assert not parser.partial and not parser.dropped
+
+    # Garbage without terminators is dropped instead of growing the buffer
+    parser = FrameParser.FrameParser(max_length=64)
+    for _ in range(100):
+        parser.feed(bytearray(b"x" * 20))
+    assert len(parser.partial) <= 64 and parser.dropped
+    parser.reset()
+    assert [frame.tobytes() for frame in parser.feed(b"0#e2u*")] == [b"0#e2u*"]
+
+def legacy_dispatch(chunks):
+    handled = 0
+    for chunk in chunks:
+        decoded = chunk.decode("utf-8")
+        if decoded.startswith("0#") and decoded.endswith("u*"):
+            handled += 1
+        elif decoded.startswith("0#") and decoded.endswith("d*"):
+            handled += 1
+        elif decoded.startswith("30#") and decoded.endswith("*"):
+            handled += 1
+    return handled
+
+def parser_dispatch(chunks):
+    handlers = {b"0": 1, b"30": 1}
+    parser = FrameParser.FrameParser()
+    handled = 0
+    for chunk in chunks:
+        for frame in parser.feed(chunk):
+            if handlers.get(FrameParser.prefix(frame)):
+                str(frame, "utf-8")
+                handled += 1
+    return handled
+
+def measure(name, function, chunks, total_bytes, expected):
+    start = time.perf_counter()
+    handled = function(chunks)
+    elapsed = time.perf_counter() - start
+    status = "" if handled == expected else f" ({expected - handled} messages missed)"
+    print(f"  {name:8} {handled / elapsed / 1000:8.0f} k messages/s {total_bytes / elapsed / 1e6:7.1f} MB/s{status}")
+
+def main():
+    rng = random.Random(1)
+    fuzz(rng)
+    print(f"Fuzz check passed ({FUZZ_ROUNDS} random streams)")
+
+    messages = [random_message(rng) for _ in range(MESSAGES)]
+    stream = b"".join(messages)
+    cases = {
+        "one message per notification": [bytearray(message) for message in messages],
+        "20 byte notifications": [bytearray(chunk) for chunk in random_chunks(rng, stream, 20)],
+        "244 byte notifications": [bytearray(stream[i:i + 244]) for i in range(0, len(stream), 244)],
+    }
+    for case, chunks in cases.items():
+        print(case)
+        measure("legacy", legacy_dispatch, chunks, len(stream), len(messages))
+        measure("parser", parser_dispatch, chunks, len(stream), len(messages))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compares matching a physical board read with ChessboardInstance.matching_moves
+against the previous approach of walking board.legal_moves for every read.
+A game sees about one read per ply, so the first (cold) lookup of a ply is
+what counts; repeated reads of the same change are a dict lookup.
+Run from the repository root: python -m Benchmarks.move_index
+"""
+
+import time
+
+import chess
+
+from ChessboardInstance import ChessboardInstance
+
+# Middlegame positions with 40+ legal moves
+POSITIONS = [
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r2q1rk1/ppp2ppp/2npbn2/2b1p3/2B1P3/2NPBN2/PPPQ1PPP/R3K2R w KQ - 0 9",
+    "r1bq1rk1/pp1nbppp/2p1pn2/3p2B1/2PP4/2N1PN2/PPQ2PPP/R3KB1R w KQ - 0 8",
+    "r2q1rk1/pp1bbppp/2n1pn2/3p4/2PP4/P1N1PN2/1PQ1BPPP/R1B1K2R w KQ - 0 10",
+    "r3kb1r/pp1q1ppp/2n1pn2/3p1b2/3P1B2/2N1PN2/PP2BPPP/R2QK2R w KQkq - 0 9",
+]
+
+ROUNDS = 200
+
+
+# The matching loop as it was before the index was introduced
+def legacy_match(board, vacated, newly_occupied):
+    moved_from = list(chess.scan_forward(vacated))
+    moved_to = list(chess.scan_forward(newly_occupied))
+    if len(moved_from) == 1:
+        for move in board.legal_moves:
+            if move.from_square == moved_from[0]:
+                if len(moved_to) == 1 and move.to_square == moved_to[0]:
+                    board.is_capture(move)
+                    board.is_castling(move)
+                    return move
+                elif len(moved_to) == 0 and board.occupied & chess.BB_SQUARES[move.to_square]:
+                    board.is_capture(move)
+                    return move
+    if len(moved_from) == 2 and len(moved_to) == 1:
+        for move in board.legal_moves:
+            if board.is_en_passant(move) and move.to_square == moved_to[0] and move.from_square in moved_from:
+                return move
+    return None
+
+
+def indexed_match(chessboardInstance, vacated, newly_occupied):
+    for move, kind in chessboardInstance.matching_moves(vacated, newly_occupied):
+        return move
+    return None
+
+
+# Occupation change of every legal move in the position, as seen by the SquareOff Pro
+def board_reads(board):
+    reads = []
+    for move in board.legal_moves:
+        after = board.copy(stack=False)
+        after.push(move)
+        reads.append((board.occupied & ~after.occupied, after.occupied & ~board.occupied))
+    return reads
+
+
+def bench(label, function, reads):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for vacated, newly_occupied in reads:
+            function(vacated, newly_occupied)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / (ROUNDS * len(reads)) * 1e6
+    print(f"  {label:<28} {per_call:8.2f} us/match")
+    return per_call
+
+
+def main():
+    for fen in POSITIONS:
+        chessboardInstance = ChessboardInstance(initial_fen=fen)
+        board = chessboardInstance.board
+        reads = board_reads(board)
+        print(f"{fen} ({board.legal_moves.count()} legal moves)")
+
+        legacy = bench("legal_moves scan", lambda v, n: legacy_match(board, v, n), reads)
+        # A new ply for every read, as in a game: nothing is cached yet
+        def cold_match(v, n):
+            chessboardInstance._move_index_key = None
+            return indexed_match(chessboardInstance, v, n)
+        cold = bench("first read of a ply", cold_match, reads)
+        cached = bench("repeated read", lambda v, n: indexed_match(chessboardInstance, v, n), reads)
+
+        print(f"  speedup: {legacy / cold:.1f}x (first read of a ply), {legacy / cached:.1f}x (repeated read)")
+
+
+if __name__ == "__main__":
+    main()
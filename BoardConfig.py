@@ -0,0 +1,52 @@
+"""
+Settings of a single board. Every setting not overridden for the board
+is taken from env.py, so a BoardConfig can be used anywhere env is.
+
+    config = BoardConfig(BOARD_NAME="Board 2", ENGINE_ELO=1800)
+    config.ENGINE_ELO        # 1800
+    config.STARTING_FEN      # env.STARTING_FEN
+"""
+
+import os
+
+import env
+
+class BoardConfig:
+    def __init__(self, parent=env, **overrides):
+        self._parent = parent
+        self.__dict__.update(overrides)
+
+    # Only called for settings not overridden for this board
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._parent, name)
+
+    def __repr__(self):
+        overrides = {name: value for name, value in self.__dict__.items() if name != "_parent"}
+        return f"BoardConfig({overrides})"
+
+# Configs for every board listed in env.BOARDS, a list of dicts with the settings to override per board. With more
+# than one board, boards without a GAME_JOURNAL_PATH of their own get one derived from env.GAME_JOURNAL_PATH.
+def from_env():
+    boards = getattr(env, "BOARDS", None) or [{}]
+    configs = []
+    for number, overrides in enumerate(boards, 1):
+        defaults = {"BOARD_NAME": f"Board {number}"}
+        journal_path = getattr(env, "GAME_JOURNAL_PATH", None)
+        if len(boards) > 1 and journal_path:
+            root, extension = os.path.splitext(journal_path)
+            defaults["GAME_JOURNAL_PATH"] = f"{root}-{number}{extension}"
+        configs.append(BoardConfig(**{**defaults, **overrides}))
+
+    # Boards sharing a journal would resume each other's games
+    journal_paths = [os.path.abspath(config.GAME_JOURNAL_PATH) for config in configs
+                     if getattr(config, "GAME_JOURNAL_PATH", None)]
+    if len(journal_paths) != len(set(journal_paths)):
+        raise ValueError("Every board in BOARDS needs its own GAME_JOURNAL_PATH.")
+    return configs
+
+# Name for board specific statistics, prefixed with the board name in multi-board mode
+def qualified_name(config, name):
+    board_name = getattr(config, "BOARD_NAME", None)
+    return f"{board_name}/{name}" if board_name else name
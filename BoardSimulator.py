@@ -0,0 +1,233 @@
+"""
+Simulated SquareOff Pro, usable as a transport for ChessBoardUARTHandler.
+The simulator keeps track of its own physical occupation, sends the same
+notifications as the real board when pieces are picked up and put down,
+answers board state requests and records every command it receives.
+
+Running this file replays the games in a PGN file through the real
+ChessBoardUARTHandler and reports throughput and move latency:
+
+    python BoardSimulator.py games.pgn --latency 0.02 --jitter 0.01
+"""
+
+import argparse
+import asyncio
+import inspect
+import random
+import statistics
+import time
+
+import chess
+import chess.pgn
+
+import GeneralHelpers
+import Log
+import env
+
+class SimulatedBoard:
+    def __init__(self, occupancy=GeneralHelpers.STARTING_OCCUPATION, latency=0.0, jitter=0.0, seed=None, fragment=0.0):
+        self.occupancy = occupancy
+
+        # Delay of every notification sent by the board, in seconds
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+        # Probability of a notification being split over two BLE notifications
+        self.fragment = fragment
+
+        self.callback = None
+        self.rx_buffer = b""
+        self.outbox = asyncio.Queue()
+        self.delivery_task = None
+        self.tasks = set()
+
+        # Every command received, and the LED/status commands separately
+        self.commands = []
+        self.led_commands = []
+        self.status_commands = []
+        self.pending_reads = 0
+
+    # Transport interface
+
+    async def write(self, data: bytes):
+        self.rx_buffer += data
+        while b"*" in self.rx_buffer:
+            command, self.rx_buffer = self.rx_buffer.split(b"*", 1)
+            self.handle_command(command.strip().decode() + "*")
+
+    async def start_notify(self, callback):
+        self.callback = callback
+
+    def handle_command(self, command: str):
+        self.commands.append(command)
+        if command.startswith("30#"):
+            self.pending_reads += 1
+            self.notify(f"30#{GeneralHelpers.mask_to_occupation_string(self.occupancy)}*", read=True)
+        elif command.startswith("25#"):
+            self.led_commands.append(command)
+        elif command.startswith("26#"):
+            self.status_commands.append(command)
+
+    # Queues a notification, delivered after the configured latency. Notifications never overtake each other.
+    def notify(self, message: str, read=False):
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        at = asyncio.get_running_loop().time() + delay
+        data = message.encode()
+        if self.fragment and self.random.random() < self.fragment:
+            split = self.random.randrange(1, len(data))
+            self.outbox.put_nowait((at, data[:split], False))
+            data = data[split:]
+        self.outbox.put_nowait((at, data, read))
+        if self.delivery_task is None or self.delivery_task.done():
+            self.delivery_task = asyncio.create_task(self.deliver())
+
+    async def deliver(self):
+        loop = asyncio.get_running_loop()
+        while not self.outbox.empty():
+            at, data, read = self.outbox.get_nowait()
+            if at > loop.time():
+                await asyncio.sleep(at - loop.time())
+            if read:
+                self.pending_reads -= 1
+            if self.callback is None:
+                continue
+
+            # Like bleak, coroutine callbacks run as tasks of their own
+            if inspect.iscoroutinefunction(self.callback):
+                task = asyncio.create_task(self.callback(None, bytearray(data)))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            else:
+                self.callback(None, bytearray(data))
+
+    # Physical actions on the board
+
+    def pick_up(self, square):
+        self.occupancy &= ~chess.BB_SQUARES[square]
+        self.notify(f"0#{chess.square_name(square)}u*")
+
+    def put_down(self, square):
+        self.occupancy |= chess.BB_SQUARES[square]
+        self.notify(f"0#{chess.square_name(square)}d*")
+
+    # The sequence of pickups and putdowns a player uses to make a move, as described in the README. Castling is
+    # split in the king move and the rook move, the board is expected to settle in between.
+    def move_steps(self, board, move):
+        if board.is_castling(move):
+            rank = chess.square_rank(move.from_square)
+            kingside = board.is_kingside_castling(move)
+            king_to = chess.square(6 if kingside else 2, rank)
+            rook_from = chess.square(7 if kingside else 0, rank)
+            rook_to = chess.square(5 if kingside else 3, rank)
+            return [[(self.pick_up, move.from_square), (self.put_down, king_to)],
+                    [(self.pick_up, rook_from), (self.put_down, rook_to)]]
+
+        steps = []
+        if board.is_en_passant(move):
+            steps.append((self.pick_up, chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square))))
+        elif board.piece_at(move.to_square):
+            steps.append((self.pick_up, move.to_square))
+        steps += [(self.pick_up, move.from_square), (self.put_down, move.to_square)]
+        return [steps]
+
+    # True once every notification has been delivered and handled, and (optionally) the handler has nothing left to send
+    def idle(self, handler=None):
+        return self.outbox.empty() and not self.tasks and not self.pending_reads and \
+            (self.delivery_task is None or self.delivery_task.done()) and \
+            (handler is None or not handler.scheduler.depth())
+
+    async def wait_idle(self, handler=None, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while not self.idle(handler):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Simulated board did not settle")
+            await asyncio.sleep(0.001)
+
+# Plays a game through a ChessBoardUARTHandler connected to a simulated board. Returns the latency of every move,
+# measured from the final putdown to the move being pushed to the ChessboardInstance. config holds the settings of
+# the board, env.py by default.
+async def play_game(game, latency=0.0, jitter=0.0, seed=None, config=env, fragment=0.0):
+    from BoardConfig import BoardConfig
+    from UartComm import ChessBoardUARTHandler
+
+    # Both sides are played on the board, without opponents, broadcasting or journaling
+    config = BoardConfig(parent=config, STARTING_FEN=game.board().fen(), ENGINE_PLAYERS=[], PLAY_LICHESS_GAME=False,
+                         ENABLE_LICHESS_BROADCAST=False, GAME_JOURNAL_PATH=None)
+
+    simulator = SimulatedBoard(occupancy=game.board().occupied, latency=latency, jitter=jitter, seed=seed,
+                               fragment=fragment)
+    handler = ChessBoardUARTHandler(transport=simulator, config=config)
+    await simulator.start_notify(handler.handle_rx)
+
+    try:
+        await handler.start_game()
+        latencies = await play_moves(handler, simulator, game)
+    finally:
+        await handler.stop_game()
+
+    return latencies, simulator
+
+# Makes the moves of a game on a simulated board connected to a started handler, optionally stopping after max_moves
+async def play_moves(handler, simulator, game, max_moves=None):
+    board = game.board()
+    latencies = []
+    await simulator.wait_idle(handler)
+
+    for number, move in enumerate(game.mainline_moves()):
+        if max_moves is not None and number >= max_moves:
+            break
+        chessboardInstance = handler.chessboardInstance
+        expected = len(chessboardInstance.board.move_stack) + 1
+        chessboardInstance.pending_promotion = move.promotion
+
+        for steps in simulator.move_steps(board, move):
+            for action, square in steps:
+                action(square)
+            start = time.perf_counter()
+            while len(chessboardInstance.board.move_stack) < expected and not simulator.idle(handler):
+                await asyncio.sleep(0)
+            latencies.append(time.perf_counter() - start)
+            await simulator.wait_idle(handler)
+
+        # Castling is pushed after the king move, only count that step
+        if board.is_castling(move):
+            latencies.pop()
+
+        if chessboardInstance.board.move_stack[-1:] != [move]:
+            raise RuntimeError(f"Move {board.san(move)} was not detected, board has {chessboardInstance.board.move_stack[-1:]}")
+        board.push(move)
+
+    return latencies
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay PGN games through a simulated SquareOff Pro.")
+    parser.add_argument("pgn", help="PGN file with the games to play")
+    parser.add_argument("--latency", type=float, default=0.0, help="Notification latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Notification jitter in seconds")
+    parser.add_argument("--fragment", type=float, default=0.0, help="Probability of a notification being split in two")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    Log.setup(env)
+
+    all_latencies = []
+    started = time.perf_counter()
+    with open(args.pgn) as pgn:
+        while (game := chess.pgn.read_game(pgn)) is not None:
+            latencies, simulator = await play_game(game, latency=args.latency, jitter=args.jitter, seed=args.seed,
+                                                     fragment=args.fragment)
+            all_latencies += latencies
+            print(f"{game.headers.get('White', '?')} - {game.headers.get('Black', '?')}: {len(latencies)} moves, "
+                  f"{len(simulator.commands)} commands, {len(simulator.led_commands)} LED updates")
+    elapsed = time.perf_counter() - started
+
+    if all_latencies:
+        all_latencies.sort()
+        percentile = lambda p: all_latencies[min(len(all_latencies) - 1, int(p * len(all_latencies)))] * 1000
+        print(f"{len(all_latencies)} moves in {elapsed:.2f} s ({len(all_latencies) / elapsed:.1f} moves/s)")
+        print(f"Move latency: mean {statistics.mean(all_latencies) * 1000:.1f} ms, p50 {percentile(0.5):.1f} ms, "
+              f"p95 {percentile(0.95):.1f} ms, max {all_latencies[-1] * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    asyncio.run(main())
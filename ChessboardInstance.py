@@ -1,19 +1,61 @@
 import chess
 import chess.pgn
 
+import GeneralHelpers
 import env
 
+# Kinds of moves returned by matching_moves, so the type of a move only has to be determined once
+MOVE_NORMAL = 0
+MOVE_CAPTURE = 1
+MOVE_EN_PASSANT = 2
+MOVE_CASTLING = 3
+
 class ChessboardInstance:
-    def __init__(self, initial_fen="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"):
-        self.board = chess.Board(fen=initial_fen)
+    def __init__(self, initial_fen="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", config=None):
+        self.config = config if config is not None else env
+
+        # Objects following the game, notified through on_move_pushed(move, san), on_game_reset() and
+        # on_node_changed(node)
+        self.listeners = []
+
+        self.reset_game(initial_fen)
+
+        # Promotion piece to use for the next promotion instead of prompting, for instance when replaying games
+        self.pending_promotion = None
+
+        self._move_index = None
+        self._move_index_key = None
+
+    # Starts a new game from the given position
+    def reset_game(self, fen):
+        self.board = chess.Board(fen=fen)
         self.game = chess.pgn.Game.from_board(self.board)
 
-        self.game.headers['Event'] = env.PGN_EVENT_NAME
-        self.game.headers['White'] = env.PGN_WHITE_PLAYER
-        self.game.headers['Black'] = env.PGN_BLACK_PLAYER
+        self.game.headers['Event'] = self.config.PGN_EVENT_NAME
+        self.game.headers['White'] = self.config.PGN_WHITE_PLAYER
+        self.game.headers['Black'] = self.config.PGN_BLACK_PLAYER
 
         self.current_node = self.game
 
+        for listener in self.listeners:
+            listener.on_game_reset()
+
+    # Pushes a move to the board and the PGN tree. Every move of the game should be pushed through here.
+    def push_move(self, move):
+        san = self.board.san(move) if self.listeners else None
+
+        self.board.push(move)
+        if self.current_node is not None:
+            self.current_node = self.current_node.add_variation(move)
+
+        for listener in self.listeners:
+            listener.on_move_pushed(move, san)
+
+    # To be called after changing the comment or NAGs of a node of the game
+    def node_changed(self, node):
+        for listener in self.listeners:
+            listener.on_node_changed(node)
+
     def is_promotion_move(self, move):
         piece = self.board.piece_at(move.from_square)
         if piece and piece.piece_type == chess.PAWN:
@@ -29,6 +71,10 @@ class ChessboardInstance:
         return False
 
     def prompt_for_promotion(self):
+        if self.pending_promotion:
+            piece, self.pending_promotion = self.pending_promotion, None
+            return piece
+
         promotion_map = {
             'q': chess.QUEEN,
             'r': chess.ROOK,
@@ -41,10 +87,70 @@ class ChessboardInstance:
                 return promotion_map[choice]
             print("Invalid choice. Please enter q, r, b, or n.")  
     
+    # Occupied squares as a python-chess mask. python-chess updates this on every push and pop, so it is
+    # effectively cached per ply and cheap enough to be used in the notification hot path.
+    def occupation_mask(self) -> int:
+        return self.board.occupied
+
+    # Squares where the given (physical) occupation differs from the ChessboardInstance
+    def occupation_diff(self, occupation_mask: int) -> int:
+        return occupation_mask ^ self.board.occupied
+
     def board_to_occupation_string(self) -> str:
-        occupation = ""
-        for file in range(8):
-            for rank in range(8):
-                square = chess.square(file, rank)
-                occupation += "1" if self.board.piece_at(square) else "0"
-        return occupation
\ No newline at end of file
+        return GeneralHelpers.mask_to_occupation_string(self.board.occupied)
+
+    # Identifies the current position, regardless of which chess.Board object it lives in
+    def position_key(self, board=None):
+        if board is None:
+            board = self.board
+        return (board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK], board.pawns, board.knights, board.bishops,
+                board.rooks, board.queens, board.kings, board.turn, board.castling_rights, board.ep_square)
+
+    # The legal moves causing the given occupation change, as (move, kind). Only the moves of the pieces on the vacated
+    # squares are generated, and the result is kept per occupation change until a move is pushed, so repeated reads
+    # of the same change within a ply are a dict lookup.
+    def matching_moves(self, vacated: int, newly_occupied: int):
+        key = self.position_key()
+        if key != self._move_index_key:
+            self._move_index = {}
+            self._move_index_key = key
+
+        signature = (vacated, newly_occupied)
+        moves = self._move_index.get(signature)
+        if moves is None:
+            moves = self._move_index[signature] = self._find_matching_moves(vacated, newly_occupied)
+        return moves
+
+    def _find_matching_moves(self, vacated, newly_occupied):
+        board = self.board
+        moves = []
+        for move in board.generate_legal_moves(vacated, chess.BB_ALL):
+            signature, kind = self._move_signature(board, move)
+            if signature == (vacated, newly_occupied):
+                moves.append((move, kind))
+        return moves
+
+    # The occupation change a legal move causes on the physical board, as (vacated squares mask, newly occupied
+    # squares mask), and the kind of move
+    @staticmethod
+    def _move_signature(board, move):
+        from_mask = chess.BB_SQUARES[move.from_square]
+        to_mask = chess.BB_SQUARES[move.to_square]
+
+        # Promotions share their occupation change, the piece is prompted for once the move is pushed
+        if move.promotion and move.promotion != chess.QUEEN:
+            return None, MOVE_NORMAL
+
+        # Only pawn moves onto the en passant square and king moves can be special, skip the checks otherwise
+        if move.to_square == board.ep_square and board.pawns & from_mask and board.is_en_passant(move):
+            captured_square = chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square))
+            return (from_mask | chess.BB_SQUARES[captured_square], to_mask), MOVE_EN_PASSANT
+        if board.kings & from_mask and board.is_castling(move):
+            # The king is moved first, the rook move is synced afterwards
+            king_file = 6 if board.is_kingside_castling(move) else 2
+            return (from_mask, chess.BB_SQUARES[chess.square(king_file, chess.square_rank(move.from_square))]), \
+                MOVE_CASTLING
+        if board.occupied & to_mask:
+            # Captured piece is lifted and replaced, so the target square stays occupied
+            return (from_mask, 0), MOVE_CAPTURE
+        return (from_mask, to_mask), MOVE_NORMAL
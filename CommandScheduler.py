@@ -0,0 +1,231 @@
+"""
+Outbound command queue for the SquareOff Pro. Every write to the board
+goes through a single writer task, which sends commands by priority,
+coalesces superseded LED/status commands and paces writes based on how
+quickly the board answers board state requests.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from Transport import TRANSPORT_ERRORS
+
+log = logging.getLogger(__name__)
+
+# Command priorities, lower values are written first
+PRIORITY_CONTROL = 0    # Game start/reset and game results
+PRIORITY_READ = 1       # 30#R* board state requests
+PRIORITY_FEEDBACK = 2   # 25# square LEDs and 26# status LED
+PRIORITY_DEFAULT = 3
+
+# Pending commands of these kinds are replaced by newer ones of the same kind
+COALESCED_KINDS = {b"25", b"26", b"30"}
+
+# Commands of these kinds are dropped when they match what the board is already showing
+STATEFUL_KINDS = {b"25", b"26"}
+
+# Pacing between writes, adjusted using the response times of board state requests
+MIN_GAP = 0.02
+MAX_GAP = 0.5
+GAP_STEP = 0.01
+
+# Board state requests without a response after this many seconds are considered lost and sent again
+MIN_READ_TIMEOUT = 1.0
+
+def command_kind(data: bytes) -> bytes:
+    return data.strip().split(b"#", 1)[0]
+
+def command_priority(kind: bytes) -> int:
+    if kind in (b"!", b"27"):
+        return PRIORITY_CONTROL
+    if kind == b"30":
+        return PRIORITY_READ
+    if kind in (b"25", b"26"):
+        return PRIORITY_FEEDBACK
+    return PRIORITY_DEFAULT
+
+class CommandScheduler:
+    def __init__(self, write):
+        # Coroutine function performing the actual write to the board
+        self.write = write
+
+        self.queue = []
+        self.pending = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.writer_task = None
+
+        # Last state written for stateful commands, used to drop duplicates
+        self.last_sent = {}
+
+        self.gap = MAX_GAP
+        self.last_write = 0.0
+        self.read_sent_at = None
+        self.read_timeout = None
+        self.read_rtt = None
+
+        self.started_at = time.monotonic()
+        self.commands_written = 0
+        self.bytes_written = 0
+        self.coalesced = 0
+        self.duplicates_dropped = 0
+        self.reads_lost = 0
+
+    # Queues a command and returns immediately. The command is written by the writer task.
+    def submit(self, data: bytes, priority=None):
+        kind = command_kind(data)
+        command = data.strip()
+
+        if kind == b"!":
+            # Nothing the board showed before the reset can be a duplicate of what is sent after it
+            self.last_sent.clear()
+        elif kind in STATEFUL_KINDS:
+            pending = self.pending.get(kind)
+            if pending is None and self.last_sent.get(kind) == command:
+                self.duplicates_dropped += 1
+                return
+
+        if kind in COALESCED_KINDS and kind in self.pending:
+            # Invalidate the superseded entry, it is skipped once popped from the queue
+            self.pending.pop(kind)[-1] = None
+            self.coalesced += 1
+
+        entry = [command_priority(kind) if priority is None else priority, next(self.counter), kind, data]
+        heapq.heappush(self.queue, entry)
+        if kind in COALESCED_KINDS:
+            self.pending[kind] = entry
+
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.create_task(self.run())
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            while not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            # Pace writes, the board can miss commands that follow each other too quickly
+            delay = self.last_write + self.gap - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if not self.queue:
+                    continue
+
+            entry = heapq.heappop(self.queue)
+            _, _, kind, data = entry
+            if data is None:
+                continue
+            if self.pending.get(kind) is entry:
+                del self.pending[kind]
+
+            # A pending stateful command may have become a duplicate of the current state in the meantime
+            command = data.strip()
+            if kind in STATEFUL_KINDS and self.last_sent.get(kind) == command:
+                self.duplicates_dropped += 1
+                continue
+
+            try:
+                await self.write(data)
+            except TRANSPORT_ERRORS:
+                # The board is disconnected, it is read again once reconnected
+                log.exception("Writing %r failed", data)
+                continue
+            self.last_write = time.monotonic()
+            self.commands_written += 1
+            self.bytes_written += len(data)
+
+            if kind == b"!":
+                # The board is reset, it no longer shows any earlier LED state and needs time to settle
+                self.last_sent.clear()
+                self.gap = MAX_GAP
+            elif kind in STATEFUL_KINDS:
+                self.last_sent[kind] = command
+            elif kind == b"30":
+                self.read_sent_at = self.last_write
+                self.schedule_read_timeout(data)
+
+    def schedule_read_timeout(self, data):
+        if self.read_timeout is not None:
+            self.read_timeout.cancel()
+        timeout = max(MIN_READ_TIMEOUT, 4 * self.read_rtt) if self.read_rtt else MIN_READ_TIMEOUT
+        self.read_timeout = asyncio.get_running_loop().call_later(timeout, self.on_read_lost, data)
+
+    # No response to a board state request, slow down and request the board state again
+    def on_read_lost(self, data):
+        self.read_timeout = None
+        self.read_sent_at = None
+        self.reads_lost += 1
+        self.gap = min(MAX_GAP, self.gap * 2)
+        self.submit(data)
+
+    # Called whenever the board answers a board state request
+    def on_board_response(self):
+        if self.read_timeout is not None:
+            self.read_timeout.cancel()
+            self.read_timeout = None
+
+        if self.read_sent_at is not None:
+            rtt = time.monotonic() - self.read_sent_at
+            self.read_rtt = rtt if self.read_rtt is None else 0.8 * self.read_rtt + 0.2 * rtt
+            self.read_sent_at = None
+
+            # The board keeps up, speed up again towards the observed response time
+            self.gap = max(MIN_GAP, min(self.gap - GAP_STEP, self.read_rtt))
+
+    # The board reconnected, it may not show the LED state written before and any outstanding read is lost
+    def on_reconnect(self):
+        if self.read_timeout is not None:
+            self.read_timeout.cancel()
+            self.read_timeout = None
+        self.read_sent_at = None
+        self.last_sent.clear()
+        self.gap = MAX_GAP
+
+    def depth(self) -> int:
+        return sum(1 for entry in self.queue if entry[-1] is not None)
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "queue_depth": self.depth(),
+            "commands_written": self.commands_written,
+            "bytes_written": self.bytes_written,
+            "commands_per_second": self.commands_written / elapsed,
+            "bytes_per_second": self.bytes_written / elapsed,
+            "coalesced": self.coalesced,
+            "duplicates_dropped": self.duplicates_dropped,
+            "reads_lost": self.reads_lost,
+            "gap_ms": self.gap * 1000,
+            "read_rtt_ms": self.read_rtt * 1000 if self.read_rtt is not None else None,
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        rtt = f"{stats['read_rtt_ms']:.0f} ms" if stats["read_rtt_ms"] is not None else "n/a"
+        return (f"queue depth {stats['queue_depth']}, {stats['commands_written']} commands written "
+                f"({stats['commands_per_second']:.2f}/s, {stats['bytes_per_second']:.0f} B/s), "
+                f"{stats['coalesced']} coalesced, {stats['duplicates_dropped']} duplicates dropped, "
+                f"{stats['reads_lost']} reads lost, gap {stats['gap_ms']:.0f} ms, read rtt {rtt}")
+
+    # Writes out whatever is still queued (bounded by timeout) and stops the writer task
+    async def close(self, timeout=2.0):
+        if self.writer_task is None:
+            return
+        if self.read_timeout is not None:
+            self.read_timeout.cancel()
+            self.read_timeout = None
+
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline and not self.writer_task.done():
+            await asyncio.sleep(0.01)
+
+        self.writer_task.cancel()
+        try:
+            await self.writer_task
+        except asyncio.CancelledError:
+            pass
+        self.writer_task = None
@@ -0,0 +1,244 @@
+"""
+Remembers the moves the engine played, keyed by the Zobrist hash of the
+position and the engine settings, so positions seen before (in this or an
+earlier session) are answered without a new search. Recent moves are kept
+in an in-memory LRU, all moves in an SQLite file that persists across
+runs. Optionally a Polyglot opening book is consulted first.
+
+Writes to the file are collected every FLUSH_INTERVAL seconds and on
+close, and committed together by a writer thread with a connection of its
+own, so neither a bot move nor the board notifications wait for the disk
+to sync. The file is in WAL mode, so lookups don't wait for a write in
+progress either.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import random
+import sqlite3
+import time
+
+import chess
+import chess.polyglot
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 5.0
+
+# Least recently used moves are evicted from the file after this many stored moves
+EVICT_INTERVAL = 100
+
+class EngineCache:
+    def __init__(self, settings, path=None, memory_size=1024, disk_size=100000, book_path=None):
+        # Moves are only shared between searches with the same settings, e.g. engine, ELO and search limit
+        self.settings = settings
+
+        self.memory = collections.OrderedDict()
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+
+        # Lookups read through database, all writes go through the writer connection on the writer thread
+        self.database = None
+        self.writer = None
+        self.executor = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.database = sqlite3.connect(path)
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="EngineCache")
+            self.executor.submit(self.open_writer, path)
+
+        # Moves to store and moves used since the last flush, by (settings, hash), and the moves handed to the writer
+        # thread, which are looked up until the next flush
+        self.pending_moves = {}
+        self.pending_used = set()
+        self.writing = []
+        self.flush_handle = None
+        self.last_flush = time.monotonic()
+
+        self.book = chess.polyglot.open_reader(book_path) if book_path else None
+        self.random = random.Random()
+
+        self.counts = collections.Counter()
+
+    # SQLite integers are signed 64-bit
+    @staticmethod
+    def position_hash(board):
+        key = chess.polyglot.zobrist_hash(board)
+        return key - (1 << 64) if key >= 1 << 63 else key
+
+    # Settings of a single search, such as its time limit, added to the settings of the cache
+    def search_settings(self, limit=None):
+        return self.settings if limit is None else f"{self.settings};{limit}"
+
+    # Returns a cached or book move for the position, or None. limit describes the search when it differs per search.
+    def lookup(self, board, limit=None) -> chess.Move | None:
+        if self.book is not None:
+            try:
+                move = self.book.weighted_choice(board, random=self.random).move
+            except IndexError:
+                pass
+            else:
+                self.counts["book_hits"] += 1
+                return move
+
+        # The hash ignores the move history, so positions that occurred before in the game (where repetition matters)
+        # are always searched
+        if board.is_repetition(2):
+            self.counts["skipped"] += 1
+            return None
+
+        settings = self.search_settings(limit)
+        key = (settings, self.position_hash(board))
+        uci = self.memory.get(key)
+        if uci is not None:
+            self.memory.move_to_end(key)
+            self.counts["memory_hits"] += 1
+        elif (uci := self.unwritten(key)) is not None:
+            self.remember(key, uci)
+            self.counts["memory_hits"] += 1
+        elif self.database is not None:
+            try:
+                row = self.database.execute("SELECT move FROM moves WHERE settings = ? AND hash = ?", key).fetchone()
+            except sqlite3.OperationalError:
+                # The writer thread is still creating the table
+                row = None
+            if row is not None:
+                uci = row[0]
+                self.remember(key, uci)
+                self.pending_used.add(key)
+                self.schedule_flush()
+                self.counts["disk_hits"] += 1
+
+        if uci is None:
+            self.counts["misses"] += 1
+            return None
+
+        # Guard against hash collisions and stale entries
+        move = chess.Move.from_uci(uci)
+        if not board.is_legal(move):
+            self.counts["misses"] += 1
+            return None
+        return move
+
+    def store(self, board, move, limit=None):
+        if board.is_repetition(2):
+            return
+        key = (self.search_settings(limit), self.position_hash(board))
+        self.remember(key, move.uci())
+
+        if self.database is not None:
+            self.pending_moves[key] = move.uci()
+            self.counts["stored"] += 1
+            self.schedule_flush()
+
+    # A stored move that may not be in the file yet
+    def unwritten(self, key):
+        if key in self.pending_moves:
+            return self.pending_moves[key]
+        for moves, _ in reversed(self.writing):
+            if key in moves:
+                return moves[key]
+        return None
+
+    # Flushes once FLUSH_INTERVAL has passed since the last flush. Within an event loop this happens in a callback of
+    # its own rather than during the lookup or store.
+    def schedule_flush(self):
+        if self.flush_handle is not None:
+            return
+        delay = max(0.0, self.last_flush + FLUSH_INTERVAL - time.monotonic())
+        try:
+            self.flush_handle = asyncio.get_running_loop().call_later(delay, self.flush)
+        except RuntimeError:
+            if not delay:
+                self.flush()
+
+    # Hands the collected moves and usage times to the writer thread, which writes them in a single transaction
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.last_flush = time.monotonic()
+        self.writing = [(moves, written) for moves, written in self.writing if not written.done()]
+        if self.executor is None or not (self.pending_moves or self.pending_used):
+            return
+
+        # Evict the least recently used moves once the file grows past its limit
+        stored = len(self.pending_moves)
+        evict = self.counts["stored"] // EVICT_INTERVAL != (self.counts["stored"] - stored) // EVICT_INTERVAL
+
+        moves, used = self.pending_moves, self.pending_used
+        self.pending_moves, self.pending_used = {}, set()
+        self.writing.append((moves, self.executor.submit(self.write, moves, used, evict)))
+        self.counts["flushes"] += 1
+
+    # On the writer thread
+    def open_writer(self, path):
+        try:
+            writer = sqlite3.connect(path)
+            writer.execute("PRAGMA journal_mode=WAL")
+            writer.execute("CREATE TABLE IF NOT EXISTS moves (settings TEXT, hash INTEGER, move TEXT, "
+                           "used INTEGER, PRIMARY KEY (settings, hash))")
+            writer.commit()
+        except sqlite3.Error as e:
+            log.warning("Could not open the engine cache %s: %r", path, e)
+            return
+        self.writer = writer
+
+    # On the writer thread
+    def write(self, moves, used, evict):
+        if self.writer is None:
+            return
+        started = time.perf_counter()
+        try:
+            with self.writer:
+                self.writer.executemany("INSERT OR REPLACE INTO moves VALUES (?, ?, ?, strftime('%s'))",
+                                        [(*key, uci) for key, uci in moves.items()])
+                self.writer.executemany("UPDATE moves SET used = strftime('%s') WHERE settings = ? AND hash = ?",
+                                        used)
+                if evict:
+                    self.writer.execute("DELETE FROM moves WHERE rowid IN (SELECT rowid FROM moves ORDER BY used "
+                                        "LIMIT max(0, (SELECT count(*) FROM moves) - ?))", (self.disk_size,))
+        except sqlite3.Error as e:
+            log.warning("Could not write the engine cache: %r", e)
+        self.counts["flush_time"] += time.perf_counter() - started
+
+    def remember(self, key, uci):
+        self.memory[key] = uci
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        hits = self.counts["book_hits"] + self.counts["memory_hits"] + self.counts["disk_hits"]
+        lookups = hits + self.counts["misses"]
+        return {**self.counts, "memory_entries": len(self.memory), "hit_rate": hits / lookups if lookups else 0.0}
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"Engine cache: {stats['hit_rate']:.0%} hit rate ({stats.get('book_hits', 0)} book, "
+                f"{stats.get('memory_hits', 0)} memory, {stats.get('disk_hits', 0)} disk, {stats.get('misses', 0)} misses)")
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    # Waits for the remaining moves to be written
+    def close(self):
+        if self.executor is not None:
+            self.flush()
+            self.executor.submit(self.close_writer)
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.writing = []
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+        if self.book is not None:
+            self.book.close()
+            self.book = None
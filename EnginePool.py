@@ -0,0 +1,259 @@
+"""
+A fixed number of UCI engine processes shared by every game in the
+process, instead of one engine per game. Searches are queued per game and
+handed out round-robin, so a busy game can't starve the others, and the
+strength settings of a game are applied to each of its searches.
+Background searches (pondering) only run when no game is waiting.
+
+Engines are started on demand, up to ENGINE_POOL_SIZE processes with
+ENGINE_THREADS threads each.
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import time
+
+import chess.engine
+
+import Metrics
+
+log = logging.getLogger(__name__)
+
+class EngineRequest:
+    def __init__(self, board, limit, game, options, stop=None):
+        self.board = board
+        self.limit = limit
+        self.game = game
+        self.options = options
+        self.stop = stop
+        self.queued_at = time.perf_counter()
+        self.future = asyncio.get_running_loop().create_future()
+        self.search = None
+
+        # A cancelled request also aborts its search, if it already started
+        self.future.add_done_callback(self.on_done)
+
+    def on_done(self, future):
+        if future.cancelled() and self.search is not None:
+            self.search.cancel()
+
+class EnginePool:
+    def __init__(self, path, size, threads=1):
+        self.path = path
+        self.size = max(1, size)
+        self.threads = threads
+
+        # Pending requests per game, in the order games are served
+        self.queues = collections.OrderedDict()
+        self.background = collections.OrderedDict()
+        self.work = asyncio.Condition()
+
+        self.engines = []
+        self.workers = []
+        self.busy = 0
+        self.starting = 0
+
+        self.users = 0
+        self.started = time.perf_counter()
+        self.counts = collections.Counter()
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+    # Searches the position on the next free engine. options are engine options used for this search only. stop is
+    # called with every info the engine sends and ends the search early once it returns True. Searches are served
+    # round-robin per client, background searches only when nothing else is queued.
+    async def play(self, board, limit, game=None, options=None, client=None, background=False,
+                   stop=None) -> chess.engine.PlayResult:
+        request = EngineRequest(board, limit, game, options or {}, stop)
+        queues = self.background if background else self.queues
+        queues.setdefault(client, collections.deque()).append(request)
+        self.counts["background_requests" if background else "requests"] += 1
+
+        # Start another engine if every engine is busy, up to the size of the pool
+        if self.queued() > len(self.engines) + self.starting - self.busy and len(self.engines) + self.starting < self.size:
+            self.starting += 1
+            self.workers.append(asyncio.create_task(self.run_engine()))
+
+        async with self.work:
+            self.work.notify()
+        return await request.future
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values()) + sum(len(queue) for queue in self.background.values())
+
+    # Takes the first request of the next client in turn, skipping requests cancelled while queued
+    def next_request(self):
+        for queues in (self.queues, self.background):
+            for client in list(queues):
+                queue = queues[client]
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if not queue:
+                    del queues[client]
+                    continue
+                request = queue.popleft()
+                queues.move_to_end(client)
+                return request
+        return None
+
+    # Fails every queued request with the error, for when no engine is left to serve them
+    def fail_queued(self, error):
+        for queues in (self.queues, self.background):
+            for queue in queues.values():
+                for request in queue:
+                    if not request.future.done():
+                        request.future.set_exception(error)
+            queues.clear()
+
+    # Starting an engine failed, for instance because STOCKFISH_LOCATION is wrong. Unless another engine is still
+    # running, the error is passed to every waiting request instead of leaving them queued forever.
+    def on_start_failed(self, error):
+        self.counts["start_failures"] += 1
+        log.error("Could not start engine %s: %r", self.path, error)
+        if not self.engines and not self.starting:
+            self.fail_queued(error)
+
+    async def start_engine(self):
+        _, engine = await chess.engine.popen_uci(self.path)
+        if "Threads" in engine.options:
+            await engine.configure({"Threads": self.threads})
+        return engine
+
+    # Only pass options the engine knows about, and keep the ELO within the range the engine accepts
+    @staticmethod
+    def engine_options(engine, options):
+        options = {name: value for name, value in options.items() if name in engine.options and name != "Threads"}
+        if "UCI_Elo" in options:
+            elo_option = engine.options["UCI_Elo"]
+            options["UCI_Elo"] = min(max(options["UCI_Elo"], elo_option.min), elo_option.max)
+        return options
+
+    async def search(self, engine, request):
+        options = self.engine_options(engine, request.options)
+        if request.stop is None:
+            return await engine.play(request.board, request.limit, game=request.game, options=options)
+
+        with await engine.analysis(request.board, request.limit, game=request.game, options=options) as analysis:
+            async for info in analysis:
+                if request.stop(info):
+                    self.counts["stopped_early"] += 1
+                    analysis.stop()
+                    break
+            best = await analysis.wait()
+            return chess.engine.PlayResult(best.move, best.ponder, dict(analysis.info))
+
+    async def run_engine(self):
+        try:
+            engine = await self.start_engine()
+        except Exception as e:
+            self.starting -= 1
+            self.on_start_failed(e)
+            return
+        self.starting -= 1
+        self.engines.append(engine)
+
+        try:
+            while True:
+                async with self.work:
+                    request = None
+                    while request is None:
+                        request = self.next_request()
+                        if request is None:
+                            await self.work.wait()
+
+                wait = time.perf_counter() - request.queued_at
+                self.wait_time += wait
+                Metrics.observe("engine_queue_wait", wait)
+
+                self.busy += 1
+                started = time.perf_counter()
+                request.search = asyncio.ensure_future(self.search(engine, request))
+                try:
+                    result = await request.search
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        raise
+                    self.counts["cancelled"] += 1
+                except chess.engine.EngineTerminatedError as e:
+                    # Replace the engine that died, the request is failed
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                    self.counts["restarts"] += 1
+                    self.engines.remove(engine)
+                    try:
+                        engine = await self.start_engine()
+                    except Exception as restart_error:
+                        self.on_start_failed(restart_error)
+                        return
+                    self.engines.append(engine)
+                except Exception as e:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                else:
+                    if not request.future.done():
+                        request.future.set_result(result)
+                finally:
+                    self.busy -= 1
+                    self.busy_time += time.perf_counter() - started
+                    self.counts["searches"] += 1
+        finally:
+            if engine in self.engines:
+                self.engines.remove(engine)
+            try:
+                await asyncio.wait_for(engine.quit(), timeout=2.0)
+            except (asyncio.TimeoutError, chess.engine.EngineError):
+                pass
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        searches = self.counts["searches"]
+        return {
+            "engines": len(self.engines),
+            "size": self.size,
+            "busy": self.busy,
+            "queued": self.queued(),
+            **self.counts,
+            "searches": searches,
+            "mean_wait_ms": self.wait_time / searches * 1000 if searches else 0.0,
+            "utilisation": self.busy_time / (elapsed * self.size) if elapsed else 0.0,
+        }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"Engine pool: {stats['engines']}/{stats['size']} engines, {stats['searches']} searches, "
+                f"mean queue wait {stats['mean_wait_ms']:.1f} ms, {stats['utilisation']:.0%} utilisation")
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for queues in (self.queues, self.background):
+            for queue in queues.values():
+                for request in queue:
+                    request.future.cancel()
+            queues.clear()
+
+_pools = {}
+
+# Returns the pool for the engine in the config, shared with every other game using the same engine. Every
+# acquire should be followed by a release once the game is over.
+def acquire(config) -> EnginePool:
+    path = os.path.realpath(config.STOCKFISH_LOCATION)
+    pool = _pools.get(path)
+    if pool is None:
+        threads = getattr(config, "ENGINE_THREADS", 4)
+        size = getattr(config, "ENGINE_POOL_SIZE", None) or max(1, (os.cpu_count() or 1) // threads)
+        pool = _pools[path] = EnginePool(path, size=size, threads=threads)
+        Metrics.add_source(f"engine_pool/{os.path.basename(path)}", pool.stats)
+    pool.users += 1
+    return pool
+
+async def release(pool):
+    pool.users -= 1
+    if pool.users <= 0:
+        _pools.pop(pool.path, None)
+        log.info("%s", pool.summary())
+        await pool.close()
@@ -0,0 +1,77 @@
+"""
+Splits the notifications of the SquareOff Pro into messages. Every
+message ends with '*', but BLE notifications don't line up with messages:
+a board read can arrive in several notifications, and one notification
+can hold several messages.
+
+Messages that are complete within a notification are returned as
+memoryview slices of it without copying. Only a message spanning
+notifications is collected in a buffer.
+"""
+
+TERMINATOR = b"*"
+SEPARATOR = ord("#")
+
+# Bytes that can precede a message and are not part of it
+WHITESPACE = b"\r\n\x00 "
+
+class FrameParser:
+    def __init__(self, max_length=256):
+        # Longest accepted message, a partial message growing past it is dropped
+        self.max_length = max_length
+        self.partial = bytearray()
+
+        self.frames = 0
+        self.dropped = 0
+
+    # Returns the messages completed by this notification, including the terminator
+    def feed(self, data) -> list:
+        # Common case, the notification is exactly one message
+        end = data.find(TERMINATOR)
+        if 0 <= end == len(data) - 1 and not self.partial and data[0] not in WHITESPACE:
+            self.frames += 1
+            return [memoryview(data)]
+
+        view = memoryview(data)
+        frames = []
+        start = 0
+
+        if self.partial:
+            if end < 0:
+                self.buffer(view)
+                return frames
+            self.partial += view[:end + 1]
+            frames.append(memoryview(bytes(self.partial)))
+            self.partial.clear()
+            start = end + 1
+
+        while True:
+            # Skip line endings and padding between messages
+            while start < len(data) and data[start] in WHITESPACE:
+                start += 1
+            end = data.find(TERMINATOR, start)
+            if end < 0:
+                break
+            frames.append(view[start:end + 1])
+            start = end + 1
+
+        if start < len(data):
+            self.buffer(view[start:])
+
+        self.frames += len(frames)
+        return frames
+
+    def buffer(self, view):
+        self.partial += view
+        if len(self.partial) > self.max_length:
+            self.partial.clear()
+            self.dropped += 1
+
+    def reset(self):
+        self.partial.clear()
+
+# The command of a message, the part before '#' (b"30" for a board read). Empty if there is none.
+def prefix(frame) -> bytes:
+    head = frame[:8].tobytes()
+    index = head.find(SEPARATOR)
+    return head[:index] if index >= 0 else b""
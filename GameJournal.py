@@ -0,0 +1,169 @@
+"""
+Append-only journal of the ongoing game, so a game survives the process
+stopping. Every pushed move is appended as a line of text; lines are
+written in batches and synced to disk with fsync, so a burst of moves
+costs a single sync.
+
+    F <fen>       a game starting from this position
+    M <uci>       a move of the game
+    E <result>    the game finished
+
+On startup an unfinished game is rebuilt from the journal (see
+restore_game) and the board is read to verify the pieces still match.
+The journal is rewritten to only the current game when it is opened and
+when the game finishes, so it never grows beyond a single game.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+import chess
+
+log = logging.getLogger(__name__)
+
+START = "F"
+MOVE = "M"
+END = "E"
+
+class GameJournal:
+    def __init__(self, chessboardInstance, path, flush_interval=0.2):
+        self.chessboardInstance = chessboardInstance
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self.buffer = []
+        self.flush_handle = None
+        self.finished = False
+        self.result = None
+        self.records = 0
+        self.syncs = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Start from the game as it is now, either new or restored from this journal
+        self.compact()
+        self.file = open(path, "a")
+        chessboardInstance.listeners.append(self)
+
+    def on_game_reset(self):
+        self.finished = False
+        self.append(f"{START} {self.chessboardInstance.board.fen()}")
+
+    def on_move_pushed(self, move, san):
+        self.append(f"{MOVE} {move.uci()}")
+
+    # Annotations are not journaled, they can be recreated
+    def on_node_changed(self, node):
+        pass
+
+    def append(self, record):
+        self.buffer.append(record + "\n")
+        self.records += 1
+        if self.flush_handle is None:
+            try:
+                self.flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+            except RuntimeError:
+                self.flush()
+
+    # Writes and syncs all buffered records
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.buffer:
+            return
+
+        self.file.write("".join(self.buffer))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.buffer.clear()
+        self.syncs += 1
+
+    # Marks the game as finished, so it is not resumed on the next start
+    def finish(self, result):
+        if self.finished:
+            return
+        self.finished = True
+        self.result = result
+        self.append(f"{END} {result}")
+        self.flush()
+        self.compact()
+
+    # Rewrites the journal to only the records of the current game, replacing the file in one go
+    def compact(self):
+        board = self.chessboardInstance.board
+        records = [f"{START} {board.root().fen()}"]
+        records += [f"{MOVE} {move.uci()}" for move in board.move_stack]
+        if self.finished:
+            records.append(f"{END} {self.result}")
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as journal_file:
+            journal_file.write("".join(record + "\n" for record in records))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self.path)
+
+        # Reopen, the old file object refers to the replaced file
+        if getattr(self, "file", None) is not None:
+            self.file.close()
+            self.file = open(self.path, "a")
+
+    def summary(self) -> str:
+        return f"{self.records} records, {self.syncs} syncs"
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# Reads the last game in a journal. Returns (fen, moves, result), with result None for an unfinished game, or None
+# if the journal holds no game. A record cut off by a crash is ignored.
+def read_journal(path):
+    if not os.path.exists(path):
+        return None
+
+    game = None
+    with open(path) as journal_file:
+        for line in journal_file:
+            if not line.endswith("\n"):
+                break
+            kind, _, value = line.rstrip("\n").partition(" ")
+            if kind == START:
+                game = (value, [], None)
+            elif kind == MOVE and game is not None:
+                game[1].append(value)
+            elif kind == END and game is not None:
+                game = (game[0], game[1], value)
+    return game
+
+# Rebuilds an unfinished game from the journal on the ChessboardInstance. Returns the number of moves restored.
+def restore_game(chessboardInstance, path) -> int:
+    started = time.perf_counter()
+    game = read_journal(path)
+    if game is None or game[2] is not None:
+        return 0
+
+    fen, moves, _ = game
+    try:
+        chessboardInstance.reset_game(fen)
+    except ValueError:
+        log.warning("Ignoring %s, it does not start from a valid position.", path)
+        return 0
+
+    for uci in moves:
+        try:
+            move = chess.Move.from_uci(uci)
+        except ValueError:
+            move = None
+        if move is None or not chessboardInstance.board.is_legal(move):
+            log.warning("Journal %s has an illegal move %s, resuming before it.", path, uci)
+            break
+        chessboardInstance.push_move(move)
+
+    restored = len(chessboardInstance.board.move_stack)
+    log.info("Resumed game from %s: %d moves in %.1f ms", path, restored, (time.perf_counter() - started) * 1000)
+    return restored
@@ -1,6 +1,8 @@
 from itertools import count, takewhile
 from typing import Iterator
 
+import chess
+
 # UART service UUID's for the SquareOff Pro
 UART_SERVICE_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
 UART_RX_CHAR_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
@@ -9,10 +11,35 @@ UART_TX_CHAR_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
 def sliced(data: bytes, n: int) -> Iterator[bytes]:
     return takewhile(len, (data[i: i + n] for i in count(0, n)))
 
+# The SquareOff Pro reports occupation file-major (a1, a2, ..., a8, b1, ...), python-chess uses rank-major
+# square indexes (a1, b1, ..., h1, a2, ...). These tables translate between both orders.
+FILE_MAJOR_TO_SQUARE = tuple(chess.square(i // 8, i % 8) for i in range(64))
+SQUARE_TO_FILE_MAJOR = tuple(chess.square_file(square) * 8 + chess.square_rank(square) for square in chess.SQUARES)
+
+# Spreads one byte of the file-major bitmap (the eight ranks of a single file) over the a-file of a mask.
+FILE_BYTE_TO_MASK = tuple(sum(chess.BB_SQUARES[chess.square(0, rank)] for rank in range(8) if byte >> rank & 1) for byte in range(256))
+
+# Occupation of the physical board at the start of a regular game
+STARTING_OCCUPATION = chess.BB_RANK_1 | chess.BB_RANK_2 | chess.BB_RANK_7 | chess.BB_RANK_8
+
 def bitboard_index_to_squares(bitboard_indexes):
-    squares = []
-    for i in bitboard_indexes:
-        letter = list(map(chr, range(97, 105)))[i // 8]
-        number = (i % 8) + 1
-        squares.append(f"{letter}{number}")
-    return squares
\ No newline at end of file
+    return [chess.square_name(FILE_MAJOR_TO_SQUARE[i]) for i in bitboard_indexes]
+
+# Parses the payload of a 30# response into an occupation mask using python-chess square indexes
+def occupation_string_to_mask(occupation: str) -> int:
+    if len(occupation) != 64 or occupation.strip("01"):
+        raise ValueError(f"Invalid occupation string: {occupation!r}")
+
+    # Reversing the string puts a1 in the lowest bit, so every file ends up in its own byte
+    file_major = int(occupation[::-1], 2)
+    mask = 0
+    for file in range(8):
+        mask |= FILE_BYTE_TO_MASK[(file_major >> (file * 8)) & 0xFF] << file
+    return mask
+
+# Inverse of occupation_string_to_mask, produces the file-major string as sent by the SquareOff Pro
+def mask_to_occupation_string(mask: int) -> str:
+    return "".join("1" if mask >> square & 1 else "0" for square in FILE_MAJOR_TO_SQUARE)
+
+def mask_to_square_names(mask: int) -> list:
+    return [chess.square_name(square) for square in chess.scan_forward(mask)]
\ No newline at end of file
@@ -0,0 +1,40 @@
+"""
+Shared HTTP client for everything that talks to Lichess. All requests
+(game streams, moves, PGN exports) go over the same pooled connections
+on the main event loop.
+"""
+
+import importlib.util
+import httpx
+
+import env
+
+LICHESS_BASE_URL = "https://lichess.org"
+
+# Streams stay open for the whole game, so they should never time out while waiting for the next line
+STREAM_TIMEOUT = httpx.Timeout(10.0, read=None)
+
+_client = None
+
+def base_url(config=env):
+    return getattr(config, "LICHESS_BASE_URL", LICHESS_BASE_URL).rstrip("/")
+
+def auth_headers(token=None):
+    return {"Authorization": f"Bearer {token if token is not None else env.LICHESS_TOKEN}"}
+
+# Returns the shared client, creating it on first use. HTTP/2 is only enabled when the h2 package is installed.
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=120.0),
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
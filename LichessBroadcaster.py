@@ -1,23 +1,152 @@
 """
-For now, this class simply writes the PGN to a file (games.pgn) after
-each move. This file can be used in combination with the Lichess
-broadcaster application.
+Publishes the ongoing game. The PGN is always written to a file
+(games.pgn) that can be used in combination with the Lichess broadcaster
+application. The PGN is kept up to date incrementally and written
+atomically, see PgnWriter.py.
+
+With LICHESS_BROADCAST_PUSH enabled, the broadcast and round are created
+on Lichess and the PGN is pushed to the round directly. Pushes are
+debounced, skipped when the PGN did not change and retried with backoff
+in the background, so the board never waits for Lichess. Only connection
+errors, rate limiting (429) and server errors are retried; other
+responses, such as a bad token or round id, drop the push.
 """
 
+import asyncio
+import logging
+import time
+
+import httpx
+
+from BoardConfig import qualified_name
+from PgnWriter import PgnWriter
+import LichessApi
+import Metrics
 import env
 
+log = logging.getLogger(__name__)
+
+PUSH_RETRY_MIN = 1.0
+PUSH_RETRY_MAX = 60.0
+
 class LichessBroadcaster:
-    def __init__(self):
-        return
+    def __init__(self, chessboardInstance, config=None):
+        self.config = config if config is not None else env
+        self.pgnWriter = PgnWriter(chessboardInstance, path=self.config.PGN_WRITE_LOCATION)
 
-    def create_broadcast(self, name, description):
-        # TODO: Implement more robust Lichess integration. For now, works fine for use with Lichess broadcaster app.
+        self.push_enabled = getattr(self.config, "LICHESS_BROADCAST_PUSH", False)
+        self.push_debounce = getattr(self.config, "LICHESS_BROADCAST_DEBOUNCE", 1.0)
+        self.tour_id = None
+        self.round_id = getattr(self.config, "LICHESS_BROADCAST_ROUND_ID", None)
+
+        self.push_handle = None
+        self.push_task = None
+        self.last_pushed = None
+        self.counts = {"pushes": 0, "failed_pushes": 0, "dropped_pushes": 0, "skipped_pushes": 0}
+
+        if self.push_enabled:
+            self.client = LichessApi.get_client()
+            self.baseUrl = LichessApi.base_url(self.config)
+            self.headers = LichessApi.auth_headers(self.config.LICHESS_TOKEN)
+            Metrics.add_source(qualified_name(self.config, "lichess_broadcast"), self.stats)
+
+    # Creates the broadcast (tournament) on Lichess, unless pushing to an existing round
+    async def create_broadcast(self, name, description):
+        if not self.push_enabled or self.round_id:
+            return True
+
+        try:
+            response = await self.client.post(f"{self.baseUrl}/broadcast/new", headers=self.headers,
+                                              data={"name": name, "markdown": description})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            return self.disable_push(f"Could not create Lichess broadcast: {e!r}")
+        self.tour_id = response.json()["tour"]["id"]
+        log.info("Created Lichess broadcast %s", self.tour_id)
         return True
 
-    def create_round(self, name):
-        # TODO: Implement more robust Lichess integration. For now, works fine for use with Lichess broadcaster app.
+    async def create_round(self, name):
+        if not self.push_enabled or self.round_id:
+            return True
+
+        try:
+            response = await self.client.post(f"{self.baseUrl}/broadcast/{self.tour_id}/new", headers=self.headers,
+                                              data={"name": name})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            return self.disable_push(f"Could not create Lichess broadcast round: {e!r}")
+        self.round_id = response.json()["round"]["id"]
+        log.info("Created Lichess broadcast round %s", self.round_id)
         return True
 
-    def update_round(self, pgn):
-        # TODO: Implement more robust Lichess integration. For now, works fine for use with Lichess broadcaster app.
-        print(pgn, file=open(env.PGN_WRITE_LOCATION, "w"), end="\n\n")
+    # Without a round to push to, the game is only written to the PGN file
+    def disable_push(self, reason):
+        log.warning("%s, only writing %s", reason, self.config.PGN_WRITE_LOCATION)
+        self.push_enabled = False
+        return False
+
+    # Publishes the current state of the game. Writes and pushes are debounced and skipped if the PGN did not change.
+    def update_round(self):
+        self.pgnWriter.publish()
+
+        if self.push_enabled and self.round_id and self.push_handle is None:
+            self.push_handle = asyncio.get_running_loop().call_later(self.push_debounce, self.start_push)
+
+    def start_push(self):
+        self.push_handle = None
+
+        # A push in progress picks up the latest PGN when it is done
+        if self.push_task is None or self.push_task.done():
+            self.push_task = asyncio.create_task(self.push())
+
+    # Pushes the PGN until Lichess has the latest version, retrying failed pushes with backoff. A push Lichess refuses
+    # is dropped, the next update tries again.
+    async def push(self):
+        delay = PUSH_RETRY_MIN
+        while True:
+            pgn = self.pgnWriter.text()
+            if pgn == self.last_pushed:
+                self.counts["skipped_pushes"] += 1
+                return
+
+            started = time.perf_counter()
+            try:
+                response = await self.client.post(f"{self.baseUrl}/api/broadcast/round/{self.round_id}/push",
+                                                  headers=self.headers, content=pgn.encode())
+                response.raise_for_status()
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                self.counts["failed_pushes"] += 1
+                status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                if status is not None and status != 429 and status < 500:
+                    self.counts["dropped_pushes"] += 1
+                    log.error("Lichess refused the broadcast push (%d), not retrying: %s", status, e.response.text)
+                    return
+                log.warning("Lichess broadcast push failed, retrying in %.1f s: %r", delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, PUSH_RETRY_MAX)
+                continue
+
+            Metrics.observe("broadcast_push", time.perf_counter() - started)
+            self.counts["pushes"] += 1
+            self.last_pushed = pgn
+            delay = PUSH_RETRY_MIN
+
+    def stats(self) -> dict:
+        return {**self.counts, "round_id": self.round_id}
+
+    # Writes the final PGN and, when pushing, gives the last push a moment to complete
+    async def close(self, timeout=5.0):
+        self.pgnWriter.flush()
+
+        if self.push_handle is not None:
+            self.push_handle.cancel()
+            self.push_handle = None
+        if self.push_enabled and self.round_id:
+            if self.push_task is None or self.push_task.done():
+                self.push_task = asyncio.create_task(self.push())
+            try:
+                await asyncio.wait_for(self.push_task, timeout)
+            except asyncio.TimeoutError:
+                log.warning("Final Lichess broadcast push did not complete.")
+            log.info("Lichess broadcast: %d pushes, %d failed, %d dropped", self.counts["pushes"],
+                     self.counts["failed_pushes"], self.counts["dropped_pushes"])
@@ -0,0 +1,170 @@
+"""
+One Lichess event stream (/api/stream/event) per account, shared by every
+game in the process. gameStart and gameFinish events are fanned out to the
+boards, and board game streams are opened on demand for the games that are
+being played. Streams that drop are reconnected with backoff, and only
+moves that weren't seen before the reconnect are passed on.
+"""
+
+import asyncio
+import json
+import logging
+import random
+
+import httpx
+
+import LichessApi
+
+log = logging.getLogger(__name__)
+
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 30.0
+
+# Reads an NDJSON stream until it is closed, reconnecting with exponential backoff when it ends or fails.
+# Stops once stop() returns True.
+async def follow_stream(client, url, headers, handle_line, name, stop=lambda: False):
+    delay = RECONNECT_MIN
+    while not stop():
+        try:
+            async with client.stream("GET", url, headers=headers, timeout=LichessApi.STREAM_TIMEOUT) as response:
+                response.raise_for_status()
+                delay = RECONNECT_MIN
+                async for line in response.aiter_lines():
+                    if line.strip():
+                        await handle_line(json.loads(line))
+                    if stop():
+                        return
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            log.warning("Lichess %s stream failed: %r", name, e)
+
+        if stop():
+            return
+        log.info("Lichess %s stream closed, reconnecting in %.1f s", name, delay)
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * 2, RECONNECT_MAX)
+
+# Board stream of a single game. callback(data, moves) is called for every gameFull/gameState with the list of moves
+# played, but only when the moves or the status changed, so a reconnect doesn't repeat moves.
+class GameStream:
+    def __init__(self, session, game_id, callback):
+        self.session = session
+        self.game_id = game_id
+        self.callback = callback
+
+        self.moves = None
+        self.status = None
+        self.finished = False
+        self.reconnects = -1
+
+        self.task = asyncio.create_task(follow_stream(
+            session.client, f"{session.base_url}/api/board/game/stream/{game_id}", session.headers, self.handle_line,
+            name=f"game {game_id}", stop=lambda: self.finished))
+
+    async def handle_line(self, data):
+        if data.get("type") == "gameFull":
+            self.reconnects += 1
+            state = data.get("state", {})
+        elif data.get("type") == "gameState":
+            state = data
+        else:
+            return
+
+        moves = state.get("moves", "").split()
+        status = state.get("status")
+        if moves == self.moves and status == self.status:
+            return
+        self.moves = moves
+        self.status = status
+        await self.callback(data, moves)
+
+    def close(self):
+        self.finished = True
+        self.task.cancel()
+
+class LichessSession:
+    def __init__(self, base_url, token):
+        self.base_url = base_url
+        self.token = token
+        self.headers = LichessApi.auth_headers(token)
+        self.client = LichessApi.get_client()
+
+        # Ongoing games by id, as sent in gameStart events, and the ids of the games a board is playing
+        self.games = {}
+        self.claimed = set()
+        self.changed = asyncio.Condition()
+
+        self.streams = {}
+        self.finish_callbacks = {}
+        self.users = 0
+
+        self.event_task = asyncio.create_task(follow_stream(
+            self.client, f"{base_url}/api/stream/event", self.headers, self.handle_event, name="event"))
+
+    async def handle_event(self, data):
+        game = data.get("game", {})
+        game_id = game.get("gameId") or game.get("id")
+
+        if data.get("type") == "gameStart":
+            self.games[game_id] = game
+        elif data.get("type") == "gameFinish":
+            self.games.pop(game_id, None)
+            stream = self.streams.get(game_id)
+            if stream is not None:
+                stream.finished = True
+            callback = self.finish_callbacks.pop(game_id, None)
+            if callback is not None:
+                await callback(game)
+        else:
+            return
+
+        async with self.changed:
+            self.changed.notify_all()
+
+    # Waits for an ongoing game that no other board is playing yet, and reserves it
+    async def claim_game(self) -> dict:
+        async with self.changed:
+            while True:
+                for game_id, game in self.games.items():
+                    if game_id not in self.claimed:
+                        self.claimed.add(game_id)
+                        return game
+                log.info("Waiting for a Lichess game to start...")
+                await self.changed.wait()
+
+    # Follows the board stream of a game, see GameStream. on_finish(game) is called on the gameFinish event.
+    def follow_game(self, game_id, callback, on_finish=None) -> GameStream:
+        stream = self.streams[game_id] = GameStream(self, game_id, callback)
+        if on_finish is not None:
+            self.finish_callbacks[game_id] = on_finish
+        return stream
+
+    def release_game(self, game_id):
+        self.claimed.discard(game_id)
+        self.finish_callbacks.pop(game_id, None)
+        stream = self.streams.pop(game_id, None)
+        if stream is not None:
+            stream.close()
+
+    async def close(self):
+        for game_id in list(self.streams):
+            self.release_game(game_id)
+        self.event_task.cancel()
+        await asyncio.gather(self.event_task, return_exceptions=True)
+
+_sessions = {}
+
+# Returns the session for the account in the config, shared with every other game using that account. Every
+# acquire should be followed by a release once the game is over.
+def acquire(config) -> LichessSession:
+    key = (LichessApi.base_url(config), config.LICHESS_TOKEN)
+    session = _sessions.get(key)
+    if session is None:
+        session = _sessions[key] = LichessSession(*key)
+    session.users += 1
+    return session
+
+async def release(session):
+    session.users -= 1
+    if session.users <= 0:
+        _sessions.pop((session.base_url, session.token), None)
+        await session.close()
@@ -0,0 +1,377 @@
+"""
+Local stand-in for the parts of the Lichess API the board uses, so the
+Lichess code can be run without an account or network. The stub is a
+small HTTP/1.1 server on the running event loop; point LICHESS_BASE_URL
+at stub.url to use it. Games are added with add_game, and the opponent
+answers every posted move with the next of its replies.
+
+Broadcasts and rounds can be created and PGNs pushed to them. Streams
+can be dropped (drop_streams) and requests failed (fail_next) to exercise
+reconnecting and retrying. Running this file plays a short game through
+LichessInstance against the stub, checks that dropped streams are
+reconnected with backoff without repeating moves, and that broadcast
+pushes are retried only when that can help:
+
+    python LichessStub.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import chess
+
+from BoardConfig import BoardConfig
+from ChessboardInstance import ChessboardInstance
+from SquareOffInstance import SquareOffInstance
+import LichessApi
+import LichessBroadcaster
+import LichessSession
+import Log
+
+TOKEN = "stub-token"
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 429: "Too Many Requests",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+class StubGame:
+    def __init__(self, game_id, color, fen, replies, reply_delay):
+        self.game_id = game_id
+        self.color = color
+        self.fen = fen
+        self.replies = list(replies)
+        self.reply_delay = reply_delay
+        self.moves = []
+        self.status = "started"
+
+    def info(self) -> dict:
+        return {"gameId": self.game_id, "id": self.game_id, "color": self.color, "fen": self.fen}
+
+    def state(self) -> dict:
+        return {"type": "gameState", "moves": " ".join(self.moves), "status": self.status}
+
+# An NDJSON stream to a client. Lines are queued by the stub and written by the request handler.
+class StubStream:
+    def __init__(self):
+        self.lines = asyncio.Queue()
+
+    def send(self, data):
+        self.lines.put_nowait(data)
+
+    # Ends the stream, the client sees the connection close
+    def drop(self):
+        self.lines.put_nowait(None)
+
+class LichessStub:
+    def __init__(self, token=TOKEN):
+        self.token = token
+        self.games = {}
+        self.streams = {}
+        self.server = None
+        self.url = None
+
+        # Every request as (time, method, path), in the order received
+        self.requests = []
+
+        # Number of upcoming requests per path to answer with an error, and the status to answer with
+        self.failures = {}
+
+        # Broadcast ids, and the PGNs pushed per round id
+        self.broadcasts = []
+        self.rounds = {}
+
+    async def start(self, host="127.0.0.1", port=0) -> str:
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        self.url = f"http://{host}:{self.server.sockets[0].getsockname()[1]}"
+        return self.url
+
+    async def close(self):
+        for streams in self.streams.values():
+            for stream in streams:
+                stream.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def add_game(self, game_id, color="white", fen=chess.STARTING_FEN, replies=(), reply_delay=0.01) -> StubGame:
+        game = self.games[game_id] = StubGame(game_id, color, fen, replies, reply_delay)
+        self.broadcast("/api/stream/event", {"type": "gameStart", "game": game.info()})
+        return game
+
+    # A move made on Lichess, for instance by the opponent
+    def push_move(self, game_id, uci):
+        game = self.games[game_id]
+        game.moves.append(uci)
+        self.broadcast(f"/api/board/game/stream/{game_id}", game.state())
+
+    def finish_game(self, game_id, status="resign"):
+        game = self.games[game_id]
+        game.status = status
+        self.broadcast(f"/api/board/game/stream/{game_id}", game.state())
+        self.broadcast("/api/stream/event", {"type": "gameFinish", "game": game.info()})
+
+    # Sends a line to every open stream of the path
+    def broadcast(self, path, data):
+        for stream in self.streams.get(path, ()):
+            stream.send(data)
+
+    # Closes every open stream of the path, as when the connection drops
+    def drop_streams(self, path):
+        for stream in self.streams.pop(path, ()):
+            stream.drop()
+
+    # Answers the next count requests to the path with the status
+    def fail_next(self, path, count, status=500):
+        self.failures[path] = (count, status)
+
+    def open_stream(self, path, *lines) -> StubStream:
+        stream = StubStream()
+        for line in lines:
+            stream.send(line)
+        self.streams.setdefault(path, []).append(stream)
+        return stream
+
+    # Returns (status, body) for a regular request, or (200, StubStream) for a stream
+    async def route(self, method, path, body):
+        count, status = self.failures.get(path, (0, None))
+        if count:
+            self.failures[path] = (count - 1, status)
+            return status, {"error": "Stub failure"}
+
+        game_id = path.rsplit("/", 1)[-1]
+        if method == "GET" and path == "/api/account/playing":
+            return 200, {"nowPlaying": [game.info() for game in self.games.values() if game.status == "started"]}
+        if method == "GET" and path == "/api/stream/event":
+            return 200, self.open_stream(path, *({"type": "gameStart", "game": game.info()}
+                                                 for game in self.games.values() if game.status == "started"))
+        if method == "GET" and path.startswith("/api/board/game/stream/") and game_id in self.games:
+            game = self.games[game_id]
+            return 200, self.open_stream(path, {"type": "gameFull", "state": game.state()})
+        if method == "GET" and path.startswith("/game/export/") and game_id in self.games:
+            game = self.games[game_id]
+            return 200, f'[Event "Stub game"]\n[White "White"]\n[Black "Black"]\n\n{" ".join(game.moves)} *\n'
+        if method == "POST" and path == "/broadcast/new":
+            self.broadcasts.append(f"tour{len(self.broadcasts) + 1}")
+            return 200, {"tour": {"id": self.broadcasts[-1]}}
+        if method == "POST" and path.startswith("/broadcast/") and path.endswith("/new"):
+            if path.split("/")[2] not in self.broadcasts:
+                return 404, {"error": "Not found"}
+            round_id = f"round{len(self.rounds) + 1}"
+            self.rounds[round_id] = []
+            return 200, {"round": {"id": round_id}}
+        if method == "POST" and path.startswith("/api/broadcast/round/") and path.endswith("/push"):
+            round_id = path.split("/")[4]
+            if round_id not in self.rounds:
+                return 404, {"error": "Not found"}
+            self.rounds[round_id].append(body.decode())
+            return 200, {"games": [{"moves": body.decode().count(".")}]}
+        if method == "POST" and path.startswith("/api/board/game/") and "/move/" in path:
+            game = self.games.get(path.split("/")[4])
+            if game is None or game.status != "started":
+                return 400, {"error": "Not your turn, or game already over"}
+            self.push_move(game.game_id, game_id)
+            if game.replies:
+                asyncio.get_running_loop().call_later(game.reply_delay, self.reply, game)
+            return 200, {"ok": True}
+        return 404, {"error": "Not found"}
+
+    def reply(self, game):
+        self.push_move(game.game_id, game.replies.pop(0))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                path = urllib.parse.urlsplit(target).path
+                self.requests.append((time.monotonic(), method, path))
+                if headers.get("authorization") != f"Bearer {self.token}":
+                    status, response = 401, {"error": "No such token"}
+                else:
+                    status, response = await self.route(method, path, body)
+
+                if isinstance(response, StubStream):
+                    await self.write_stream(writer, response)
+                    return
+                self.write_response(writer, status, response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def write_response(writer, status, body):
+        if isinstance(body, str):
+            content, content_type = body.encode(), "application/x-chess-pgn"
+        else:
+            content, content_type = json.dumps(body).encode(), "application/json"
+        writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(content)}\r\n\r\n".encode() + content)
+
+    async def write_stream(self, writer, stream):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+                     b"Connection: close\r\n\r\n")
+        try:
+            while (data := await stream.lines.get()) is not None:
+                line = json.dumps(data).encode() + b"\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+                await writer.drain()
+        finally:
+            for streams in self.streams.values():
+                if stream in streams:
+                    streams.remove(stream)
+
+# Stands in for ChessBoardUARTHandler, the opponent only sends LED commands through it
+class CommandSink:
+    async def send_command(self, data, priority=None):
+        pass
+
+def stub_config(stub, **overrides):
+    return BoardConfig(LICHESS_BASE_URL=stub.url, LICHESS_TOKEN=stub.token, GAME_JOURNAL_PATH=None, **overrides)
+
+# Plays the first moves of a game through LichessInstance: the human moves are posted and the stub's replies come
+# back through the game stream
+async def check_game(stub):
+    from Opponents.LichessInstance import LichessInstance
+
+    game = stub.add_game("stubgame1", color="white", replies=["e7e5", "b8c6"])
+    config = stub_config(stub)
+    chessboardInstance = ChessboardInstance(config=config)
+    squareOffInstance = SquareOffInstance(chessboardInstance, config=config)
+    lichessInstance = LichessInstance(chessboardInstance, squareOffInstance, config=config)
+    lichessInstance.uart_handler = CommandSink()
+
+    await asyncio.wait_for(lichessInstance.start(), 5.0)
+    replies = []
+    for move in ("e2e4", "g1f3"):
+        chessboardInstance.push_move(chess.Move.from_uci(move))
+        reply = await asyncio.wait_for(lichessInstance.pass_boardstate(), 5.0)
+        await lichessInstance._pass_and_return(reply)
+        replies.append(reply)
+    await lichessInstance.close()
+
+    assert replies == ["e7e5", "b8c6"], replies
+    assert game.moves == ["e2e4", "e7e5", "g1f3", "b8c6"], game.moves
+    assert [move.uci() for move in chessboardInstance.board.move_stack] == game.moves
+    return f"{len(game.moves)} moves exchanged"
+
+async def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError(f"timed out waiting for {predicate.__code__.co_names}")
+        await asyncio.sleep(0.01)
+
+# Drops the game and event streams of a LichessSession: the game stream fails twice more before it is back, which
+# should be retried with growing delays, and no move or game may be reported twice
+async def check_reconnect(stub):
+    game_path = "/api/board/game/stream/stubgame2"
+    reconnect_min = LichessSession.RECONNECT_MIN
+    LichessSession.RECONNECT_MIN = 0.05
+    stub.add_game("stubgame2")
+    session = LichessSession.acquire(stub_config(stub))
+    try:
+        await asyncio.wait_for(session.claim_game(), 5.0)
+
+        states = []
+        async def on_game_state(data, moves):
+            states.append(moves)
+        stream = session.follow_game("stubgame2", on_game_state)
+        await wait_until(lambda: len(states) == 1)
+        stub.push_move("stubgame2", "e2e4")
+        await wait_until(lambda: len(states) == 2)
+
+        dropped_at = time.monotonic()
+        stub.fail_next(game_path, 2)
+        stub.drop_streams(game_path)
+        await wait_until(lambda: stream.reconnects == 1)
+        stub.push_move("stubgame2", "e7e5")
+        await wait_until(lambda: len(states) == 3)
+        assert states == [[], ["e2e4"], ["e2e4", "e7e5"]], states
+
+        attempts = [at for at, _, path in stub.requests if path == game_path and at > dropped_at]
+        gaps = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+        assert len(attempts) == 3 and gaps[1] > gaps[0], gaps
+
+        # The event stream resends gameStart for the ongoing game after reconnecting
+        stub.drop_streams("/api/stream/event")
+        await wait_until(lambda: sum(path == "/api/stream/event" for _, _, path in stub.requests) == 2)
+        await asyncio.sleep(0.05)
+        assert list(session.games) == ["stubgame2"] and session.claimed == {"stubgame2"}
+    finally:
+        await LichessSession.release(session)
+        LichessSession.RECONNECT_MIN = reconnect_min
+    return f"reconnected after {len(attempts)} attempts, retry gaps {', '.join(f'{gap * 1000:.0f} ms' for gap in gaps)}"
+
+# Pushes a broadcast through LichessBroadcaster: a push failing with a server error is retried, a push to a round
+# Lichess doesn't know is dropped instead of retried forever
+async def check_broadcast(stub):
+    retry_min = LichessBroadcaster.PUSH_RETRY_MIN
+    LichessBroadcaster.PUSH_RETRY_MIN = 0.05
+    with tempfile.TemporaryDirectory() as directory:
+        config = stub_config(stub, LICHESS_BROADCAST_PUSH=True, LICHESS_BROADCAST_DEBOUNCE=0.01,
+                             PGN_WRITE_LOCATION=os.path.join(directory, "games.pgn"))
+        chessboardInstance = ChessboardInstance(config=config)
+        broadcaster = LichessBroadcaster.LichessBroadcaster(chessboardInstance, config=config)
+        try:
+            assert await broadcaster.create_broadcast("Stub broadcast", "Pushed by LichessStub.py")
+            assert await broadcaster.create_round("Round 1")
+            pushes = stub.rounds[broadcaster.round_id]
+            push_path = f"/api/broadcast/round/{broadcaster.round_id}/push"
+
+            stub.fail_next(push_path, 2, status=503)
+            chessboardInstance.push_move(chess.Move.from_uci("e2e4"))
+            broadcaster.update_round()
+            await wait_until(lambda: pushes)
+            assert "1. e4" in pushes[-1] and broadcaster.counts["failed_pushes"] == 2, broadcaster.counts
+            retries = broadcaster.counts["failed_pushes"]
+
+            # An unknown round answers 404, which has to be dropped after a single attempt
+            broadcaster.round_id = "missing"
+            chessboardInstance.push_move(chess.Move.from_uci("e7e5"))
+            broadcaster.update_round()
+            await wait_until(lambda: broadcaster.counts["dropped_pushes"] == 1)
+            await asyncio.sleep(0.2)
+            attempts = sum(path == "/api/broadcast/round/missing/push" for _, _, path in stub.requests)
+            assert attempts == 1, attempts
+        finally:
+            broadcaster.push_enabled = False
+            await broadcaster.close()
+            LichessBroadcaster.PUSH_RETRY_MIN = retry_min
+    return f"pushed after {retries} retries, refused push dropped after 1 attempt"
+
+CHECKS = [check_game, check_reconnect, check_broadcast]
+
+async def run_checks():
+    failed = 0
+    for check in CHECKS:
+        stub = LichessStub()
+        await stub.start()
+        try:
+            print(f"{check.__name__}: ok, {await check(stub)}")
+        except Exception as e:
+            failed += 1
+            print(f"{check.__name__}: FAILED {e!r}")
+        finally:
+            await stub.close()
+    await LichessApi.close_client()
+    return failed
+
+def main():
+    Log.setup(BoardConfig(LOG_LEVEL="WARNING"))
+    sys.exit(1 if asyncio.run(run_checks()) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Analyses the ongoing game in the background, so the game can be followed
+with evaluations. After every move the new position is analysed for at
+most LIVE_ANALYSIS_TIME seconds by an engine process of its own, and the
+evaluation and best line are added as a comment to the move:
+
+    12. Nf3 { [%eval 0.35,18] Best: 12... Nc6 13. d4 exd4 }
+
+Nothing here is awaited by move detection: moves only schedule an
+analysis. Positions are analysed one at a time, and a new move pre-empts
+the analysis of the previous position, keeping whatever result it had
+reached. Bursts of moves, such as the two steps of castling, are only
+analysed once they settle.
+"""
+
+import asyncio
+import logging
+
+import chess
+import chess.engine
+
+from BoardConfig import qualified_name
+import Metrics
+import env
+
+log = logging.getLogger(__name__)
+
+# Shortest analysis worth adding to a move when it is pre-empted
+MIN_DEPTH = 8
+
+# Moves of the best line shown in the comment
+BEST_LINE_LENGTH = 6
+
+class LiveAnalysis:
+    def __init__(self, chessboardInstance, config=None, on_annotated=None):
+        self.chessboardInstance = chessboardInstance
+        self.config = config if config is not None else env
+
+        self.time_limit = getattr(self.config, "LIVE_ANALYSIS_TIME", 1.0)
+        self.delay = getattr(self.config, "LIVE_ANALYSIS_DELAY", 0.2)
+        self.threads = getattr(self.config, "LIVE_ANALYSIS_THREADS", 1)
+
+        # Called after a move got annotated, for instance to publish the PGN again
+        self.on_annotated = on_annotated
+
+        self.engine = None
+        self.node = None
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.counts = {"analysed": 0, "preempted": 0, "annotated": 0}
+
+    async def start(self):
+        _, self.engine = await chess.engine.popen_uci(self.config.STOCKFISH_LOCATION)
+        if "Threads" in self.engine.options:
+            await self.engine.configure({"Threads": self.threads})
+
+        self.chessboardInstance.listeners.append(self)
+        self.task = asyncio.create_task(self.run())
+        Metrics.add_source(qualified_name(self.config, "live_analysis"), self.stats)
+
+        # The game may have been resumed, start with its last move
+        self.on_move_pushed(None, None)
+
+    def on_move_pushed(self, move, san):
+        self.node = self.chessboardInstance.current_node
+        self.wakeup.set()
+
+    def on_game_reset(self):
+        self.on_move_pushed(None, None)
+
+    def on_node_changed(self, node):
+        pass
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+
+            # Let bursts of moves settle, only the last position is analysed
+            await asyncio.sleep(self.delay)
+            self.wakeup.clear()
+
+            # Only positions reached by a move can be annotated
+            node = self.node
+            if node is None or node.parent is None:
+                continue
+            board = node.board()
+            if board.is_game_over():
+                continue
+
+            await self.analyse(node, board)
+
+    async def analyse(self, node, board):
+        started = Metrics.start()
+        self.counts["analysed"] += 1
+
+        with await self.engine.analysis(board, chess.engine.Limit(time=self.time_limit),
+                                        info=chess.engine.INFO_SCORE | chess.engine.INFO_PV) as analysis:
+            wakeup = asyncio.create_task(self.wakeup.wait())
+            finished = asyncio.create_task(analysis.wait())
+            await asyncio.wait([wakeup, finished], return_when=asyncio.FIRST_COMPLETED)
+            wakeup.cancel()
+            finished.cancel()
+
+            # A newer position is waiting, stop with what was found so far
+            if self.wakeup.is_set():
+                self.counts["preempted"] += 1
+                analysis.stop()
+                if analysis.info.get("depth", 0) < MIN_DEPTH:
+                    return
+            info = analysis.info
+
+        Metrics.stop("live_analysis", started)
+        if "score" in info:
+            self.annotate(node, board, info)
+
+    # Adds the evaluation and best line to the move that led to the analysed position
+    def annotate(self, node, board, info):
+        node.comment = ""
+        node.set_eval(info["score"], info.get("depth"))
+        pv = info.get("pv", [])[:BEST_LINE_LENGTH]
+        if pv:
+            node.comment += f" Best: {board.variation_san(pv)}"
+
+        self.counts["annotated"] += 1
+        self.chessboardInstance.node_changed(node)
+        if self.on_annotated:
+            self.on_annotated()
+
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+    async def close(self):
+        if self in self.chessboardInstance.listeners:
+            self.chessboardInstance.listeners.remove(self)
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.engine:
+            try:
+                await asyncio.wait_for(self.engine.quit(), 5.0)
+            except (asyncio.TimeoutError, chess.engine.EngineError):
+                pass
+        log.info("Live analysis: %d moves annotated, %d analyses pre-empted", self.counts["annotated"],
+                 self.counts["preempted"])
@@ -0,0 +1,57 @@
+"""
+Logging for the board handling code. Messages are handed to a queue and
+formatted and written by a background thread, so logging never waits on
+the terminal (a Pi's serial console or an SSH session can take
+milliseconds per line). Every module logs through logging.getLogger with
+its own name (UartComm, SquareOffInstance, Opponents.EngineInstance, ...),
+and levels can be set per module in env.py:
+
+    LOG_LEVEL="INFO"
+    LOG_LEVELS={"UartComm": "DEBUG"}
+
+Raw notifications, board reads and square lists are logged at DEBUG, so
+with the default levels they are never formatted at all. Without setup()
+only warnings and errors are shown, which suits benchmarks.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+_listener = None
+
+# Hands records to the listener as they are. The default QueueHandler formats every message in the calling thread,
+# which is exactly the work to keep out of the notification handlers. Arguments passed to a log call should
+# therefore not be changed afterwards.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Starts the background writer and applies the configured levels. Safe to call more than once.
+def setup(config):
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(getattr(config, "LOG_FORMAT", "%(message)s")))
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    atexit.register(stop)
+
+    root = logging.getLogger()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(getattr(config, "LOG_LEVEL", "INFO"))
+    for name, level in (getattr(config, "LOG_LEVELS", None) or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+# Writes everything still queued and stops the background writer
+def stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,139 @@
+"""
+Timing of the stages between a piece being put down and the board
+showing the result: board read, move matching, opponent reply and LED
+command. Collection is off by default. While disabled every call returns
+right after checking a single flag.
+
+Spans are recorded by marking the start of a stage (mark) and observing
+the time since that mark later on (since), or with start/stop around a
+block of code. Per-stage histograms are available as a periodic summary
+line, a JSON dump at exit and an optional local HTTP endpoint.
+"""
+
+import asyncio
+import atexit
+import collections
+import json
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+ENABLED = False
+
+# Most recent samples kept per stage
+MAX_SAMPLES = 10000
+
+_samples = {}
+_counts = collections.Counter()
+_marks = {}
+_sources = {}
+_tasks = []
+
+def start():
+    return time.perf_counter() if ENABLED else None
+
+def stop(stage, started):
+    if ENABLED and started is not None:
+        observe(stage, time.perf_counter() - started)
+
+# Remembers the start of a span. key separates spans of different boards.
+def mark(name, key=None):
+    if ENABLED:
+        _marks[(key, name)] = time.perf_counter()
+
+# Records the time since mark(name). With clear=True only the first observation after a mark is recorded.
+def since(stage, name, key=None, clear=False):
+    if not ENABLED:
+        return
+    started = _marks.pop((key, name), None) if clear else _marks.get((key, name))
+    if started is not None:
+        observe(stage, time.perf_counter() - started)
+
+def observe(stage, seconds):
+    if not ENABLED:
+        return
+    samples = _samples.get(stage)
+    if samples is None:
+        samples = _samples[stage] = collections.deque(maxlen=MAX_SAMPLES)
+    samples.append(seconds)
+    _counts[stage] += 1
+
+# Adds a callable returning a dict of additional statistics to the reports, such as queue depths
+def add_source(name, function):
+    if ENABLED:
+        _sources[name] = function
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * (len(samples) - 1) + 0.5))]
+
+def histograms() -> dict:
+    stages = {}
+    for stage, samples in _samples.items():
+        if not samples:
+            continue
+        ordered = sorted(samples)
+        stages[stage] = {
+            "count": _counts[stage],
+            "mean_ms": sum(ordered) / len(ordered) * 1000,
+            "p50_ms": percentile(ordered, 0.50) * 1000,
+            "p95_ms": percentile(ordered, 0.95) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000,
+            "max_ms": ordered[-1] * 1000,
+        }
+    return stages
+
+def report() -> dict:
+    sources = {}
+    for name, function in _sources.items():
+        try:
+            sources[name] = function()
+        except Exception as e:
+            sources[name] = {"error": str(e)}
+    return {"stages": histograms(), "sources": sources}
+
+def summary_line() -> str:
+    parts = [f"{stage} p50 {h['p50_ms']:.1f}/p95 {h['p95_ms']:.1f}/p99 {h['p99_ms']:.1f} ms (n={h['count']})"
+             for stage, h in sorted(histograms().items())]
+    return "Metrics: " + ("; ".join(parts) if parts else "no samples")
+
+def dump(path):
+    with open(path, "w") as dump_file:
+        json.dump(report(), dump_file, indent=2)
+
+async def _log_summaries(interval):
+    while True:
+        await asyncio.sleep(interval)
+        log.info("%s", summary_line())
+
+# Answers every request with the current report as JSON
+async def _serve(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    body = json.dumps(report()).encode()
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                 + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    writer.close()
+
+# Enables collection using the METRICS_* settings. Must be called from the running event loop.
+async def start_from_config(config):
+    global ENABLED
+    if not getattr(config, "METRICS_ENABLED", False):
+        return
+    ENABLED = True
+
+    interval = getattr(config, "METRICS_SUMMARY_INTERVAL", None)
+    if interval:
+        _tasks.append(asyncio.create_task(_log_summaries(interval)))
+
+    dump_path = getattr(config, "METRICS_DUMP_PATH", None)
+    if dump_path:
+        atexit.register(dump, dump_path)
+
+    port = getattr(config, "METRICS_PORT", None)
+    if port:
+        server = await asyncio.start_server(_serve, "127.0.0.1", port)
+        _tasks.append(asyncio.create_task(server.serve_forever()))
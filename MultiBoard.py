@@ -0,0 +1,179 @@
+"""
+Drives several SquareOff Pro boards from one process. Every board gets
+its own ChessBoardUARTHandler, game and opponent, using the settings of
+its entry in env.BOARDS (see BoardConfig.py). Boards are connected
+concurrently, and a board disconnecting only ends the game on that board.
+
+    python MultiBoard.py
+    python MultiBoard.py --simulate games.pgn --boards 4 [--disconnect 10]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import chess.pgn
+from bleak import BleakClient, BleakScanner
+
+from BoardConfig import BoardConfig, from_env
+from GeneralHelpers import UART_SERVICE_UUID, UART_RX_CHAR_UUID
+from Transport import BleTransport
+from UartComm import ChessBoardUARTHandler
+import LichessApi
+import Log
+import Metrics
+import env
+
+DEVICE_NAME = "Squareoff Pro"
+
+# A game on one board, from connecting until the board disconnects
+class BoardSession:
+    def __init__(self, config):
+        self.config = config
+        self.name = config.BOARD_NAME
+        self.handler = None
+        self.state = "waiting"
+        self.connected_at = None
+
+        self.ready = asyncio.Event()
+        self.disconnected = asyncio.Event()
+
+    async def run(self, transport):
+        self.handler = ChessBoardUARTHandler(transport=transport, config=self.config)
+        await transport.start_notify(self.handler.handle_rx)
+        self.connected_at = time.monotonic()
+        self.state = "playing"
+
+        try:
+            await self.handler.start_game()
+            self.ready.set()
+            await self.disconnected.wait()
+            print(f"{self.name} was disconnected.")
+        finally:
+            self.state = "disconnected"
+            # The shared Lichess client is closed once every board is done
+            await self.handler.stop_game(close_client=False)
+
+    def stats(self) -> dict:
+        if self.handler is None:
+            return {"board": self.name, "state": self.state}
+        return {**self.handler.stats(), "state": self.state,
+                "connected_s": time.monotonic() - self.connected_at if self.connected_at else None}
+
+# Finds a device for every board. Boards with an ADDRESS setting get that device, the others get the remaining
+# SquareOff Pro boards in the order they are found.
+async def discover(configs, timeout=10.0):
+    devices = await BleakScanner.discover(timeout=timeout, cb={"use_bdaddr": True})
+    by_address = {device.address.upper(): device for device in devices}
+    unassigned = [device for device in devices if device.name == DEVICE_NAME]
+
+    assigned = []
+    for config in configs:
+        address = getattr(config, "ADDRESS", None)
+        device = by_address.get(address.upper()) if address else None
+        if device in unassigned:
+            unassigned.remove(device)
+        assigned.append(device)
+
+    for number, config in enumerate(configs):
+        if assigned[number] is None and not getattr(config, "ADDRESS", None) and unassigned:
+            assigned[number] = unassigned.pop(0)
+    return assigned
+
+async def run_ble_board(session, device):
+    def handle_disconnect(_: BleakClient):
+        session.disconnected.set()
+
+    async with BleakClient(address_or_ble_device=device, disconnected_callback=handle_disconnect) as client:
+        print(f"{session.name} connected to {device.address}")
+        nus = client.services.get_service(UART_SERVICE_UUID)
+        rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
+        await session.run(BleTransport(client=client, rx_char=rx_char))
+
+# Plays a game on a simulated board. With disconnect_after set, the board disconnects after that many moves.
+async def run_simulated_board(session, game, latency=0.0, jitter=0.0, disconnect_after=None):
+    from BoardSimulator import SimulatedBoard, play_moves
+
+    session.config = BoardConfig(parent=session.config, STARTING_FEN=game.board().fen(), ENGINE_PLAYERS=[],
+                                 PLAY_LICHESS_GAME=False, ENABLE_LICHESS_BROADCAST=False,
+                                 GAME_JOURNAL_PATH=None)
+    simulator = SimulatedBoard(occupancy=game.board().occupied, latency=latency, jitter=jitter)
+    session_task = asyncio.create_task(session.run(simulator))
+
+    try:
+        await session.ready.wait()
+        return await play_moves(session.handler, simulator, game, max_moves=disconnect_after)
+    finally:
+        session.disconnected.set()
+        await session_task
+
+# Runs every session and waits for all of them, a failing board is reported without stopping the others
+async def run_sessions(sessions, coroutines):
+    Metrics.add_source("boards", lambda: [session.stats() for session in sessions])
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+
+    for session, result in zip(sessions, results):
+        if isinstance(result, BaseException):
+            print(f"{session.name} stopped: {result!r}")
+        print(json.dumps(session.stats()))
+
+    if any(session.config.PLAY_LICHESS_GAME or getattr(session.config, "LICHESS_BROADCAST_PUSH", False)
+           for session in sessions):
+        await LichessApi.close_client()
+    return results
+
+async def run_boards(configs):
+    sessions = [BoardSession(config) for config in configs]
+    print(f"Looking for {len(sessions)} boards...")
+    devices = await discover(configs)
+
+    connected = []
+    for session, device in zip(sessions, devices):
+        if device is None:
+            print(f"No device found for {session.name}.")
+        else:
+            connected.append((session, device))
+
+    if connected:
+        await run_sessions([session for session, _ in connected],
+                           [run_ble_board(session, device) for session, device in connected])
+
+async def run_simulated(pgn_path, boards, latency, jitter, disconnect_after):
+    with open(pgn_path) as pgn:
+        games = []
+        while (game := chess.pgn.read_game(pgn)) is not None:
+            games.append(game)
+
+    configs = from_env()
+    configs += [BoardConfig(BOARD_NAME=f"Board {number}") for number in range(len(configs) + 1, boards + 1)]
+    sessions = [BoardSession(config) for config in configs[:boards]]
+
+    started = time.perf_counter()
+    results = await run_sessions(sessions, [
+        run_simulated_board(session, games[number % len(games)], latency, jitter,
+                            disconnect_after=disconnect_after if number == 0 else None)
+        for number, session in enumerate(sessions)])
+    elapsed = time.perf_counter() - started
+
+    moves = sum(len(result) for result in results if isinstance(result, list))
+    print(f"{len(sessions)} boards, {moves} moves in {elapsed:.2f} s ({moves / elapsed:.1f} moves/s)")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Play on several SquareOff Pro boards from one process.")
+    parser.add_argument("--simulate", metavar="PGN", help="Use simulated boards replaying the games in this PGN file")
+    parser.add_argument("--boards", type=int, default=2, help="Number of simulated boards")
+    parser.add_argument("--latency", type=float, default=0.0, help="Notification latency of simulated boards")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Notification jitter of simulated boards")
+    parser.add_argument("--disconnect", type=int, default=None, help="Disconnect the first simulated board after this many moves")
+    args = parser.parse_args()
+
+    Log.setup(env)
+    await Metrics.start_from_config(env)
+    if args.simulate:
+        await run_simulated(args.simulate, args.boards, args.latency, args.jitter, args.disconnect)
+    else:
+        await run_boards(from_env())
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,204 @@
+"""
+Compact, append-only binary log of the traffic between CircleOn and the
+SquareOff Pro, and a replayer feeding recorded notifications back
+through ChessBoardUARTHandler.handle_rx.
+
+Every record is a 7-byte header (direction, microseconds since the
+previous record, payload length) followed by the raw payload. Each run
+appending to a log starts with a session record. Promotions are recorded
+with the piece promoted to (q, r, b or n) after the notification that
+made the move, so a replay promotes to the same piece without asking.
+
+    python NotificationLog.py dump board.log
+    python NotificationLog.py replay board.log [--speed 4 | --fast]
+"""
+
+import argparse
+import asyncio
+import os
+import struct
+import time
+
+import chess
+
+MAGIC = b"CIRCLEON-LOG\x01"
+
+INBOUND = 0
+OUTBOUND = 1
+SESSION = 2
+PROMOTION = 3
+
+RECORD = struct.Struct("<BIH")
+MAX_DELTA = 0xFFFFFFFF
+
+class NotificationRecorder:
+    def __init__(self, path, flush_interval=1.0, buffer_limit=64 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+        self.flush_interval = flush_interval
+        self.buffer_limit = buffer_limit
+        self.buffer = bytearray()
+        self.flush_handle = None
+        self.last = time.monotonic_ns()
+        self.record(SESSION, b"")
+
+    # Only appends to an in-memory buffer, writing to disk happens in batches
+    def record(self, direction, data):
+        now = time.monotonic_ns()
+        delta = min((now - self.last) // 1000, MAX_DELTA)
+        self.last = now
+
+        self.buffer += RECORD.pack(direction, delta, len(data))
+        self.buffer += data
+
+        if len(self.buffer) >= self.buffer_limit:
+            self.flush()
+        elif self.flush_handle is None:
+            try:
+                self.flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+            except RuntimeError:
+                self.flush()
+
+    # Listener of the ChessboardInstance, only promotions are recorded
+    def on_game_reset(self):
+        pass
+
+    def on_move_pushed(self, move, san):
+        if move.promotion:
+            self.record(PROMOTION, chess.piece_symbol(move.promotion).encode())
+
+    def on_node_changed(self, node):
+        pass
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# Yields (direction, microseconds since previous record, payload) for every record in the log
+def read_log(path):
+    with open(path, "rb") as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a CircleOn notification log")
+        while True:
+            header = log.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            direction, delta, length = RECORD.unpack(header)
+            data = log.read(length)
+            if len(data) < length:
+                return
+            yield direction, delta, data
+
+# Feeds the inbound notifications of a log through handler.handle_rx. With speed=None notifications are handled as
+# fast as possible one after another, otherwise the recorded timing is kept (divided by speed) and every
+# notification is handled in its own task, as bleak does. Recorded promotions are used instead of asking.
+async def replay(path, handler, speed=1.0):
+    records = list(read_log(path))
+    tasks = set()
+    pending_delay = 0
+    count = 0
+    for number, (direction, delta, data) in enumerate(records):
+        pending_delay += delta
+        if direction == SESSION:
+            pending_delay = 0
+            continue
+        if direction != INBOUND:
+            continue
+
+        promotion = next_promotion(records, number)
+        if promotion is not None:
+            handler.chessboardInstance.pending_promotion = promotion
+
+        if speed is None:
+            await handler.handle_rx(None, bytearray(data))
+        else:
+            if pending_delay:
+                await asyncio.sleep(pending_delay / 1e6 / speed)
+            task = asyncio.create_task(handler.handle_rx(None, bytearray(data)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        pending_delay = 0
+        count += 1
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    return count
+
+# The piece of a promotion recorded after the inbound record at index number and before the next inbound one
+def next_promotion(records, number):
+    for direction, _, data in records[number + 1:]:
+        if direction == INBOUND:
+            return None
+        if direction == PROMOTION:
+            return chess.Piece.from_symbol(data.decode()).piece_type
+    return None
+
+def dump(path):
+    elapsed = 0
+    for direction, delta, data in read_log(path):
+        elapsed += delta
+        if direction == SESSION:
+            elapsed = 0
+            print("--- session ---")
+            continue
+        if direction == PROMOTION:
+            print(f"{elapsed / 1e6:10.3f} = promotion to {data.decode()}")
+            continue
+        print(f"{elapsed / 1e6:10.3f} {'<' if direction == INBOUND else '>'} {data!r}")
+
+async def replay_to_sink(path, speed):
+    from BoardConfig import BoardConfig
+    import Log
+    from Transport import NullTransport
+    from UartComm import ChessBoardUARTHandler
+
+    # Both sides are replayed from the board, without opponents, broadcasting or journaling
+    config = BoardConfig(ENGINE_PLAYERS=[], PLAY_LICHESS_GAME=False, ENABLE_LICHESS_BROADCAST=False,
+                         RECORD_NOTIFICATIONS=None, GAME_JOURNAL_PATH=None)
+    Log.setup(config)
+
+    handler = ChessBoardUARTHandler(transport=NullTransport(), config=config)
+    await handler.start_game()
+
+    try:
+        start = time.perf_counter()
+        count = await replay(path, handler, speed=speed)
+        elapsed = time.perf_counter() - start
+    finally:
+        await handler.stop_game()
+
+    recorded = sum(1 for direction, _, _ in read_log(path) if direction == OUTBOUND)
+    print(f"Replayed {count} notifications in {elapsed:.3f} s ({count / max(elapsed, 1e-9):.0f}/s)")
+    print(f"Commands: {recorded} recorded, {len(handler.transport.commands)} produced by replay")
+    print(handler.chessboardInstance.board.fen())
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay a SquareOff Pro notification log.")
+    parser.add_argument("command", choices=["dump", "replay"])
+    parser.add_argument("log")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor, 1 is real time")
+    parser.add_argument("--fast", action="store_true", help="Replay as fast as possible")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        dump(args.log)
+    else:
+        asyncio.run(replay_to_sink(args.log, None if args.fast else args.speed))
+
+if __name__ == "__main__":
+    main()
@@ -4,53 +4,335 @@ This class is able to talk to UartComm directly for LED-control.
 """
 
 import os
-from stockfish import Stockfish
-import GeneralHelpers as GeneralHelpers
+import asyncio
+import logging
+import time
 import chess
+import chess.engine
+import GeneralHelpers as GeneralHelpers
 
+from BoardConfig import qualified_name
+from EngineCache import EngineCache
+import EnginePool
+import Metrics
+import SearchBudget
+import Tablebase
 import env
 
+log = logging.getLogger(__name__)
+
 class EngineInstance:
-    def __init__(self, chessboardInstance, squareoffInstance):
+    def __init__(self, chessboardInstance, squareoffInstance, config=None):
         self.uart_handler = None
+        self.config = config if config is not None else env
         self.chessboardInstance = chessboardInstance
         self.squareoffInstance = squareoffInstance
         
         # This is now Windows-specific, however I highly encourage you to download your own copy of stockfish (for your own platform) and use that
-        self.stockfishPath = os.path.realpath(env.STOCKFISH_LOCATION)   
+        self.stockfishPath = os.path.realpath(self.config.STOCKFISH_LOCATION)   
 
-        # Stockfish init, can be set to any value deemed fit
-        self.stockfish = Stockfish(path=self.stockfishPath, depth=20, parameters={
-            "Threads": 4, "Minimum Thinking Time": 20})
-        
-        self.stockfish.set_elo_rating(env.ENGINE_ELO)
+        # Stockfish settings, can be set to any value deemed fit. The number of threads is set for the whole engine pool
+        # (ENGINE_THREADS), these options are applied to every search of this game.
+        self.limit = chess.engine.Limit(depth=20)
+        self.options = {"Minimum Thinking Time": 20, "UCI_LimitStrength": True, "UCI_Elo": self.config.ENGINE_ELO}
+
+        # With ENGINE_SEARCH_BUDGET every search gets a time budget from the strength, the position and the clock
+        # instead of the fixed depth above, and stops once the best move is stable, see SearchBudget.py. ENGINE_CLOCK
+        # is (seconds, increment) when the bot plays with a clock.
+        self.search_budget = getattr(self.config, "ENGINE_SEARCH_BUDGET", False)
+        clock = getattr(self.config, "ENGINE_CLOCK", None)
+        self.clock, self.clock_increment = clock if clock else (None, 0.0)
+        self.search_counts = {"searches": 0, "stopped_early": 0, "forced": 0, "search_time": 0.0, "budget_time": 0.0,
+                              "time_saved": 0.0}
+        Metrics.add_source(qualified_name(self.config, "engine_search"), self.search_stats)
+
+        # Moves found before for the same position and settings are reused instead of searching again. On a budget, the
+        # configured move time is part of the settings as well, see SearchBudget.
+        search_settings = "budget" if self.search_budget else self.limit
+        self.cache = EngineCache(
+            settings=f"{os.path.basename(self.stockfishPath)};elo={self.config.ENGINE_ELO};{search_settings}",
+            path=getattr(self.config, "ENGINE_CACHE_PATH", None),
+            memory_size=getattr(self.config, "ENGINE_CACHE_SIZE", 1024),
+            disk_size=getattr(self.config, "ENGINE_CACHE_DISK_SIZE", 100000),
+            book_path=getattr(self.config, "OPENING_BOOK_PATH", None))
+        Metrics.add_source(qualified_name(self.config, "engine_cache"), self.cache.stats)
+
+        # Searches run on the engine processes shared by all games, see EnginePool.py
+        self.pool = None
+        self.search = None
+
+        # While the human is moving, the engine searches the reply it expects in the background. A ponder is
+        # (position key, search task, start time) and is used if the human plays the predicted move.
+        self.ponder_enabled = getattr(self.config, "ENGINE_PONDER", True)
+        self.ponder = None
+        self.ponder_time = 0.0
+        self.predicted_reply = None
+        self.ponder_counts = {"hits": 0, "misses": 0, "time_saved": 0.0}
+        Metrics.add_source(qualified_name(self.config, "engine_ponder"), self.ponder_stats)
+
+        # Endgames within the Syzygy tables (SYZYGY_PATH) are played from the tables without searching. At or above
+        # SYZYGY_OPTIMAL_ELO the fastest win is played, see Tablebase.py.
+        self.tablebase = None
+        self.tablebase_optimal = self.config.ENGINE_ELO >= getattr(self.config, "SYZYGY_OPTIMAL_ELO", 2000)
+        self.tablebase_counts = {"probes": 0, "hits": 0, "probe_time": 0.0}
+        Metrics.add_source(qualified_name(self.config, "tablebase"), self.tablebase_stats)
         
-        self.originalBitboard = "11000011" * 8
+        self.originalBitboard = GeneralHelpers.STARTING_OCCUPATION
+
+    # Joins the engine pool, if not done already
+    async def start(self):
+        if self.pool is None:
+            self.pool = EnginePool.acquire(self.config)
+            self.tablebase = Tablebase.acquire(self.config)
+
+    async def close(self):
+        self.cancel_search()
+        self.stop_ponder()
+        if self.pool is not None:
+            await EnginePool.release(self.pool)
+            self.pool = None
+        if self.tablebase is not None:
+            Tablebase.release(self.tablebase)
+            self.tablebase = None
+        if self.tablebase_counts["probes"]:
+            log.info("%s", self.tablebase_summary())
+        if self.search_counts["searches"] or self.search_counts["forced"]:
+            log.info("%s", self.search_summary())
+        log.info("%s", self.cache.summary())
+        if self.ponder_counts["hits"] or self.ponder_counts["misses"]:
+            log.info("%s", self.ponder_summary())
+        self.cache.close()
+
+    # Aborts a running search, for instance when the board changed while the engine was thinking
+    def cancel_search(self):
+        if self.search is not None and not self.search.done():
+            self.search.cancel()
     
     # Is called whenever engine needs to be aware of the new boardstate
-    # Boardstate is a valid FEN-string
+    # Boardstate is a valid FEN-string. Returns None if the search was cancelled.
 
-    def pass_boardstate(self, input_fen=None, input_move=None):
+    async def pass_boardstate(self, input_fen=None, input_move=None):
+        started = time.perf_counter()
+        move = await self.find_move(input_fen)
+
+        # The time taken comes off the clock of the bot, if it plays with one
+        if move is not None and self.clock is not None:
+            self.clock = max(0.0, self.clock - (time.perf_counter() - started)) + self.clock_increment
+        return move
+
+    async def find_move(self, input_fen):
         self.input_fen = input_fen
-        if self.input_fen:
-            self.stockfish.set_fen_position(self.input_fen)
-            return self.stockfish.get_best_move()
+        if not self.input_fen:
+            return None
+
+        await self.start()
+
+        # Pass the game including its move stack, so the engine receives the starting position and the moves played
+        # since, instead of a new FEN every move.
+        board = self.chessboardInstance.board.copy()
+        if board.fen() != self.input_fen:
+            board = chess.Board(fen=self.input_fen)
+
+        tablebase_move = self.probe_tablebase(board)
+        if tablebase_move is not None:
+            self.stop_ponder()
+            self.predicted_reply = None
+            log.info("Engine move from tablebase: %s", tablebase_move)
+            return tablebase_move.uci()
+
+        position = self.chessboardInstance.position_key()
+        started = Metrics.start()
+        search_started = time.perf_counter()
+        budget = self.plan_search(board)
+        self.search = self.take_ponder(position)
+        pondered = self.search is not None
+        if not pondered:
+            cached = self.cache.lookup(board, limit=budget and budget.key)
+            if cached is not None:
+                self.predicted_reply = None
+                log.info("Engine move from cache: %s", cached)
+                return cached.uci()
+
+            forced = self.forced_move(board)
+            if forced is not None:
+                self.predicted_reply = None
+                log.info("Engine move forced: %s", forced)
+                return forced.uci()
+
+            self.search = asyncio.ensure_future(self.pool.play(board, budget.limit if budget else self.limit,
+                                                               game=self.chessboardInstance.game, options=self.options,
+                                                               client=self, stop=budget and budget.should_stop))
+        try:
+            result = await self.search
+        except asyncio.CancelledError:
+            # Only swallow the cancellation of the search itself, not of the task awaiting it
+            if asyncio.current_task().cancelling():
+                raise
+            log.info("Engine search cancelled.")
+            return None
+        finally:
+            self.search = None
+        Metrics.stop("engine_search", started)
+        if budget is not None and not pondered:
+            self.count_search(budget, time.perf_counter() - search_started)
+
+        if result.move is not None and not pondered and (budget is None or budget.cacheable):
+            self.cache.store(board, result.move, limit=budget and budget.key)
+
+        if result.move is None or position != self.chessboardInstance.position_key():
+            log.info("Board changed during engine search, discarding result.")
+            return None
+
+        self.predicted_reply = result.ponder
+        return result.move.uci()
+
+    # Starts searching the position after the expected reply of the human, so a correct prediction is answered
+    # (almost) right away
+    def start_ponder(self, reply):
+        self.stop_ponder()
+        if not self.ponder_enabled or self.pool is None or reply is None:
+            return
+
+        board = self.chessboardInstance.board.copy()
+        if not board.is_legal(reply):
+            return
+        board.push(reply)
+        if board.is_game_over():
+            return
+
+        task = asyncio.ensure_future(self.ponder_search(board))
+        self.ponder = (self.chessboardInstance.position_key(board), task, time.perf_counter())
+
+    async def ponder_search(self, board):
+        started = time.perf_counter()
+        budget = self.plan_search(board)
+        result = await self.pool.play(board, budget.limit if budget else self.limit, game=self.chessboardInstance.game,
+                                      options=self.options, client=self, background=True,
+                                      stop=budget and budget.should_stop)
+        self.ponder_time = time.perf_counter() - started
+        if result.move is not None and (budget is None or budget.cacheable):
+            self.cache.store(board, result.move, limit=budget and budget.key)
+        return result
+
+    def stop_ponder(self):
+        if self.ponder is not None:
+            _, task, _ = self.ponder
+            if not task.done():
+                task.cancel()
+            self.ponder = None
+
+    # Returns the ponder search if it was for this position, otherwise aborts it
+    def take_ponder(self, position):
+        if self.ponder is None:
+            return None
+        key, task, started = self.ponder
+        self.ponder = None
+
+        if key != position or task.cancelled():
+            task.cancel()
+            self.ponder_counts["misses"] += 1
+            return None
+
+        # Everything searched before the human completed the move is time saved
+        self.ponder_counts["hits"] += 1
+        self.ponder_counts["time_saved"] += self.ponder_time if task.done() else time.perf_counter() - started
+        log.debug("Ponder hit.")
+        return task
+
+    # The time budget for searching the position, None when searching to the fixed depth
+    def plan_search(self, board):
+        if not self.search_budget:
+            return None
+        return SearchBudget.plan(board, self.config, clock=self.clock, increment=self.clock_increment)
+
+    # The only legal move, which is played without searching when searching on a budget
+    def forced_move(self, board):
+        if not self.search_budget:
+            return None
+        moves = iter(board.legal_moves)
+        move = next(moves, None)
+        if move is None or next(moves, None) is not None:
+            return None
+
+        self.search_counts["forced"] += 1
+        self.search_counts["time_saved"] += self.plan_search(board).hard
+        return move
+
+    # Everything the search did not need of the longest it was allowed to take is time saved
+    def count_search(self, budget, elapsed):
+        saved = max(0.0, budget.hard - elapsed)
+        self.search_counts["searches"] += 1
+        self.search_counts["stopped_early"] += budget.stopped_early
+        self.search_counts["search_time"] += elapsed
+        self.search_counts["budget_time"] += budget.hard
+        self.search_counts["time_saved"] += saved
+        log.info("Searched %.2f s of %.2f s (budget %.2f s) to depth %d, %.2f s saved", elapsed, budget.hard,
+                  budget.soft, budget.depth, saved)
+
+    def search_stats(self) -> dict:
+        searches = self.search_counts["searches"]
+        return {**self.search_counts, "clock": self.clock,
+                "mean_search_s": self.search_counts["search_time"] / searches if searches else 0.0,
+                "mean_saved_s": self.search_counts["time_saved"] / searches if searches else 0.0}
+
+    def search_summary(self) -> str:
+        stats = self.search_stats()
+        return f"Engine search: {stats['searches']} searches, {stats['stopped_early']} stopped early, " \
+               f"{stats['forced']} forced moves, {stats['mean_search_s']:.2f} s per search, " \
+               f"{stats['time_saved']:.1f} s saved ({stats['mean_saved_s']:.2f} s per search)"
+
+    # Looks the move up in the Syzygy tables, None if the position is not covered by them
+    def probe_tablebase(self, board):
+        if self.tablebase is None or not self.tablebase.covers(board):
+            return None
+
+        started = time.perf_counter()
+        move = self.tablebase.probe(board, optimal=self.tablebase_optimal)
+        elapsed = time.perf_counter() - started
+
+        self.tablebase_counts["probes"] += 1
+        self.tablebase_counts["hits"] += move is not None
+        self.tablebase_counts["probe_time"] += elapsed
+        Metrics.observe("tablebase_probe", elapsed)
+        return move
+
+    def tablebase_stats(self) -> dict:
+        probes = self.tablebase_counts["probes"]
+        return {**self.tablebase_counts,
+                "mean_probe_ms": self.tablebase_counts["probe_time"] / probes * 1000 if probes else 0.0}
+
+    def tablebase_summary(self) -> str:
+        stats = self.tablebase_stats()
+        return f"Tablebase: {stats['probes']} probes, {stats['hits']} moves from the tables, " \
+               f"{stats['mean_probe_ms']:.2f} ms per probe"
+
+    def ponder_stats(self) -> dict:
+        ponders = self.ponder_counts["hits"] + self.ponder_counts["misses"]
+        return {**self.ponder_counts, "hit_rate": self.ponder_counts["hits"] / ponders if ponders else 0.0}
+
+    def ponder_summary(self) -> str:
+        stats = self.ponder_stats()
+        return f"Engine ponder: {stats['hit_rate']:.0%} hit rate ({stats['hits']} hits, {stats['misses']} misses), " \
+               f"{stats['time_saved']:.1f} s saved"
     
     # Function is called to send the move to the chessboardInstance. Should preferably be called from UartComm, as it allows
     # for additional control over what move is ultimately sent to the chessboardInstance. 
     # Input move is UCI-move.
     async def _pass_and_return(self, move):
-        print(move)
+        if not move:
+            return
+
+        Metrics.mark("opponent_move", self.uart_handler)
+        log.info("Engine move: %s", move)
         # Make change to chessboardInstance
-        self.chessboardInstance.board.push_san(move)
-        if self.chessboardInstance.current_node is not None:
-            self.chessboardInstance.current_node = self.chessboardInstance.current_node.add_variation(chess.Move.from_uci(move))
+        self.chessboardInstance.push_move(self.chessboardInstance.board.parse_uci(move))
+        self.start_ponder(self.predicted_reply)
 
         # Triggers on mismatch (which should be every move made by the engine)
-        if self.originalBitboard != self.chessboardInstance.board_to_occupation_string():
+        if self.chessboardInstance.occupation_diff(self.originalBitboard):
 
             # As seen in similar functions, indicate differences
-            diff_squares = GeneralHelpers.bitboard_index_to_squares([i for i in range(len(self.originalBitboard)) if self.originalBitboard[i] != self.chessboardInstance.board_to_occupation_string()[i]])
+            diff_squares = GeneralHelpers.mask_to_square_names(self.chessboardInstance.occupation_diff(self.originalBitboard))
             if move:
 
                 # Also append UCI move to LED-control if exists
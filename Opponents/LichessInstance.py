@@ -7,51 +7,59 @@ settings passed from Lichess instead of env.py.
 import GeneralHelpers as GeneralHelpers
 import chess
 import chess.pgn
-import httpx
 import io
-from threading import Thread
+import logging
+import time
 import asyncio
 
+import LichessApi
+import LichessSession
+import Metrics
 import env
 
+log = logging.getLogger(__name__)
+
 class LichessInstance:
-    def __init__(self, chessboardInstance, squareoffInstance):
+    def __init__(self, chessboardInstance, squareoffInstance, config=None):
 
         # Default settings
         self.uart_handler = None
+        self.config = config if config is not None else env
         self.chessboardInstance = chessboardInstance
         self.squareoffInstance = squareoffInstance
         
-        self.originalBitboard = "11000011" * 8
+        self.originalBitboard = GeneralHelpers.STARTING_OCCUPATION
 
         # Lichess specific settings
-        self.baseUrl = "https://lichess.org"
+        self.baseUrl = LichessApi.base_url(self.config)
         self.gameId = None
         self.opponentColor = None
-        self.lichessToken = env.LICHESS_TOKEN
+        self.lichessToken = self.config.LICHESS_TOKEN
         self.last_seen_move = None
 
         # Set auth headers for use with Lichess
-        self.headers = {
-            "Authorization": f"Bearer {self.lichessToken}" 
-        }
+        self.headers = LichessApi.auth_headers(self.lichessToken)
+
+        # All requests share one pooled client. Games are found through the event stream of the account, which is
+        # shared with the other boards (see LichessSession.py).
+        self.client = None
+        self.session = None
+        self.stream = None
+        self.move_ready_event = asyncio.Event()
+        self.opponentMove = None
 
-        # Get ongoing games
-        response = httpx.get(f'{self.baseUrl}/api/account/playing', headers=self.headers)
-        ongoingGames = response.json()
+    # Waits for an ongoing game not played on another board and starts following it. Called once from the running
+    # event loop.
+    async def start(self):
+        self.session = LichessSession.acquire(self.config)
+        self.client = self.session.client
 
-        self.mostRecent = ongoingGames['nowPlaying'][0]
+        self.mostRecent = await self.session.claim_game()
         self.gameState = self.mostRecent['fen']
         self.gameId = self.mostRecent['gameId']
 
-        # Create event loop for keeping track of new moves in NDJSON-response        
-        self.loop = asyncio.new_event_loop()
-        self.move_ready_event = asyncio.Event()
-        self.opponentMove = None
-
-        # Start event loop in background
-        Thread(target=self.loop.run_forever, daemon=True).start()
-        asyncio.run_coroutine_threadsafe(self.stream_game(), self.loop)
+        # Keep track of new moves in NDJSON-response
+        self.stream = self.session.follow_game(self.gameId, self.on_game_state, on_finish=self.on_game_finish)
 
         # Overwrite engine color based on ongoing game.
         if self.mostRecent['color'] == 'white':
@@ -61,7 +69,7 @@ class LichessInstance:
         self.squareoffInstance.bots = [self.opponentColor]
 
         # Get PGN of selected game
-        pgnResponse = httpx.get(f"{self.baseUrl}/game/export/{self.gameId}?evals=false", headers=self.headers)
+        pgnResponse = await self.client.get(f"{self.baseUrl}/game/export/{self.gameId}?evals=false", headers=self.headers)
         self.tempGame = chess.pgn.read_game(io.StringIO(pgnResponse.text))
         self.lichessPgnHeaders = dict(self.tempGame.headers)
 
@@ -69,8 +77,7 @@ class LichessInstance:
         # I would rather instantiate the chessboardInstance using the FEN instead of overwriting, but it
         # should work reliably.
 
-        self.chessboardInstance.board = chess.Board(fen=self.gameState)
-        self.chessboardInstance.game = chess.pgn.Game.from_board(self.chessboardInstance.board)
+        self.chessboardInstance.reset_game(self.gameState)
 
         self.chessboardInstance.game.headers['White'] = self.lichessPgnHeaders['White']
         self.chessboardInstance.game.headers['Black'] = self.lichessPgnHeaders['Black']
@@ -81,10 +88,17 @@ class LichessInstance:
         elif self.chessboardInstance.board.turn == chess.BLACK:
             self.squareoffInstance.turn = "black"
 
-        self.chessboardInstance.current_node = self.chessboardInstance.game
-
-    async def wait_for_opponent_move(self):
-        current_last_move = self.last_seen_move
+    async def close(self):
+        if self.session is not None:
+            if self.gameId is not None:
+                self.session.release_game(self.gameId)
+            await LichessSession.release(self.session)
+            self.session = None
+            self.stream = None
+
+    async def wait_for_opponent_move(self, current_last_move=None):
+        if current_last_move is None:
+            current_last_move = self.last_seen_move
     
         while True:
             await self.move_ready_event.wait()
@@ -96,68 +110,66 @@ class LichessInstance:
             # Spurious wakeup or same move, keep waiting
 
     
-    async def stream_game(self):
-        url = f"{self.baseUrl}/api/board/game/stream/{self.gameId}"
-    
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("GET", url, headers=self.headers) as response:
-                async for line in response.aiter_lines():
-                    if not line.strip():
-                        continue
-                    data = httpx.Response(200, content=line).json()
-
-                    if data["type"] in ["gameFull", "gameState"]:
-
-                        # Detect end of game due to other reasons then mate
-                        status = data.get("status")
-                        if status and status not in ("started", "created", "mate"):
-                            print(f"Game ended by Lichess. Status: {status}")
-                            await self.uart_handler.send_command(b"27#dw*\r\n")
-
-                        # Get made moves from gamestate
-                        moves = data.get("state", {}).get("moves") if data["type"] == "gameFull" else data.get("moves")
-                        if moves:
-                            moves_list = moves.strip().split()
-                            if not moves_list:
-                                continue
-                            
-                            # Only look at the *newest* move
-                            latest_move = moves_list[-1]
-                        
-                            # If it's your opponent's turn and it's a new move
-                            if (self.mostRecent['color'] == "white" and len(moves_list) % 2 == 0) or \
-                               (self.mostRecent['color'] == "black" and len(moves_list) % 2 == 1):
-                        
-                                if latest_move != self.last_seen_move:
-                                    self.opponentMove = latest_move
-                                    self.last_seen_move = latest_move
-                                    print(f"New opponent move detected: {latest_move}")
-                                    self.loop.call_soon_threadsafe(self.move_ready_event.set)
+    # Called by the game stream for every new state of the game, with the moves played so far
+    async def on_game_state(self, data, moves_list):
+        # Detect end of game due to other reasons then mate
+        status = data.get("status")
+        if status and status not in ("started", "created", "mate"):
+            log.info("Game ended by Lichess. Status: %s", status)
+            await self.uart_handler.send_command(b"27#dw*\r\n")
+
+        if not moves_list:
+            return
+
+        # Only look at the *newest* move
+        latest_move = moves_list[-1]
+
+        # If it's your opponent's turn and it's a new move
+        if (self.mostRecent['color'] == "white" and len(moves_list) % 2 == 0) or \
+           (self.mostRecent['color'] == "black" and len(moves_list) % 2 == 1):
+
+            if latest_move != self.last_seen_move:
+                self.opponentMove = latest_move
+                self.last_seen_move = latest_move
+                log.info("New opponent move detected: %s", latest_move)
+                self.move_ready_event.set()
+
+    async def on_game_finish(self, game):
+        log.info("Lichess game %s finished.", self.gameId)
                         
     
     # Is called whenever engine needs to be aware of the new boardstate
     # Boardstate is a valid FEN-string (or UCI move)
 
-    def pass_boardstate(self, input_fen=None, input_move=None):     
+    async def pass_boardstate(self, input_fen=None, input_move=None):     
         if input_fen:
             self.chessboardInstance.board.set_fen(input_fen)
 
         if not input_move:
             input_move = self.chessboardInstance.board.peek()
 
-        print(f"{input_move.uci()} was passed to Lichess")
-        response = httpx.post(
+        # Remember the last opponent move before posting, so a fast reply can not be missed
+        current_last_move = self.last_seen_move
+
+        log.info("%s was passed to Lichess", input_move)
+        start = time.perf_counter()
+        response = await self.client.post(
             f'{self.baseUrl}/api/board/game/{self.gameId}/move/{input_move.uci()}',
             headers=self.headers
         )
 
         moveResponse = response.json()
-        print(moveResponse)
+        log.debug("%s (%.0f ms round-trip, %s)", moveResponse, (time.perf_counter() - start) * 1000, response.http_version)
+        Metrics.observe("lichess_post", time.perf_counter() - start)
 
-        future = asyncio.run_coroutine_threadsafe(self.wait_for_opponent_move(), self.loop)
-        opponent_uci = future.result()
+        opponent_uci = await self.wait_for_opponent_move(current_last_move)
+        Metrics.observe("lichess_reply", time.perf_counter() - start)
         return opponent_uci
 
+    # Moves are made remotely, there is no local search to abort
+    def cancel_search(self):
+        return
+
 
 
     
@@ -166,17 +178,16 @@ class LichessInstance:
     # Input move is UCI-move.
     async def _pass_and_return(self, move):
         if move:
+            Metrics.mark("opponent_move", self.uart_handler)
 
             # Make change to chessboardInstance
-            self.chessboardInstance.board.push_san(move)
-            if self.chessboardInstance.current_node is not None:
-                self.chessboardInstance.current_node = self.chessboardInstance.current_node.add_variation(chess.Move.from_uci(move))
+            self.chessboardInstance.push_move(self.chessboardInstance.board.parse_uci(move))
 
             # Triggers on mismatch (which should be every move made by the engine)
-            if self.originalBitboard != self.chessboardInstance.board_to_occupation_string():
+            if self.chessboardInstance.occupation_diff(self.originalBitboard):
 
                 # As seen in similar functions, indicate differences
-                diff_squares = GeneralHelpers.bitboard_index_to_squares([i for i in range(len(self.originalBitboard)) if self.originalBitboard[i] != self.chessboardInstance.board_to_occupation_string()[i]])
+                diff_squares = GeneralHelpers.mask_to_square_names(self.chessboardInstance.occupation_diff(self.originalBitboard))
                 if move:
 
                     # Also append UCI move to LED-control if exists
@@ -0,0 +1,147 @@
+"""
+Keeps the PGN of the ongoing game up to date incrementally, instead of
+exporting the whole game tree after every move. Only the new SAN tokens
+are appended to the buffered movetext, and writes to disk are debounced,
+skipped when nothing changed and published by atomic rename, so readers
+never see a half-written file.
+
+The output matches chess.pgn.StringExporter for the mainline, including
+comments and NAGs. Annotating a move that was already written (see
+LiveAnalysis.py) rewrites the movetext from that move on, which is
+usually only the last move or two.
+"""
+
+import asyncio
+import os
+
+import chess
+
+class PgnWriter:
+    def __init__(self, chessboardInstance, path=None, debounce=0.5, columns=80):
+        self.chessboardInstance = chessboardInstance
+        self.path = path
+        self.debounce = debounce
+        self.columns = columns
+
+        self.write_handle = None
+        self.last_written = None
+        self.writes = 0
+
+        # Includes moves pushed before the writer was created, such as those of a game resumed from the journal
+        self.rebuild()
+        chessboardInstance.listeners.append(self)
+
+    def on_game_reset(self):
+        board = self.chessboardInstance.game.board()
+        self.turn = board.turn
+        self.fullmove_number = board.fullmove_number
+
+        self.lines = []
+        self.current_line = ""
+        self.force_movenumber = True
+
+        # For every move written, the state before writing it, its SAN and its node
+        self.moves = []
+
+    def on_move_pushed(self, move, san):
+        self.write_move(san, self.chessboardInstance.current_node)
+
+    # A move already written got a comment or NAG, the movetext is written again from that move on
+    def on_node_changed(self, node):
+        start = node.ply() - self.chessboardInstance.game.ply() - 1
+        if not 0 <= start < len(self.moves) or self.moves[start][2] is not node:
+            self.rebuild()
+            return
+
+        rewritten = self.moves[start:]
+        line_count, self.current_line, self.turn, self.fullmove_number, self.force_movenumber = rewritten[0][0]
+        del self.lines[line_count:]
+        del self.moves[start:]
+        for _, san, node in rewritten:
+            self.write_move(san, node)
+
+    # Writes the movetext of the mainline from scratch
+    def rebuild(self):
+        self.on_game_reset()
+        board = self.chessboardInstance.game.board()
+        for node in self.chessboardInstance.game.mainline():
+            self.write_move(board.san(node.move), node)
+            board.push(node.move)
+
+    def write_move(self, san, node):
+        self.moves.append(((len(self.lines), self.current_line, self.turn, self.fullmove_number, self.force_movenumber),
+                           san, node))
+        if self.turn == chess.WHITE:
+            self.write_token(f"{self.fullmove_number}. ")
+        elif self.force_movenumber:
+            self.write_token(f"{self.fullmove_number}... ")
+        self.write_token(san + " ")
+        self.force_movenumber = False
+
+        if node is not None:
+            for nag in sorted(node.nags):
+                self.write_token(f"${nag} ")
+            if node.comment:
+                self.write_token("{ " + node.comment.replace("}", "").strip() + " } ")
+                self.force_movenumber = True
+
+        if self.turn == chess.BLACK:
+            self.fullmove_number += 1
+        self.turn = not self.turn
+
+    # Same line wrapping as chess.pgn.StringExporter
+    def write_token(self, token):
+        if self.columns is not None and self.columns - len(self.current_line) < len(token):
+            self.lines.append(self.current_line.rstrip())
+            self.current_line = ""
+        self.current_line += token
+
+    def text(self) -> str:
+        headers = self.chessboardInstance.game.headers
+        result = headers.get("Result", "*") + " "
+
+        lines = self.lines
+        current_line = self.current_line
+        if self.columns is not None and current_line and self.columns - len(current_line) < len(result):
+            lines = lines + [current_line.rstrip()]
+            current_line = ""
+        movetext = "\n".join(lines + [(current_line + result).rstrip()])
+
+        if not headers:
+            return movetext
+        header_block = "\n".join(f"[{name} \"{value}\"]" for name, value in headers.items())
+        return f"{header_block}\n\n{movetext}"
+
+    # Schedules a write, bursts of changes within the debounce interval result in a single write
+    def publish(self):
+        if self.write_handle is not None:
+            return
+        try:
+            self.write_handle = asyncio.get_running_loop().call_later(self.debounce, self.flush)
+        except RuntimeError:
+            self.flush()
+
+    # Writes the PGN right away if it changed since the last write
+    def flush(self):
+        if self.write_handle is not None:
+            self.write_handle.cancel()
+            self.write_handle = None
+        if self.path is None:
+            return
+
+        pgn = self.text()
+        if pgn == self.last_written:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Write next to the destination and rename, so the file is replaced in one go
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as pgn_file:
+            pgn_file.write(pgn + "\n\n")
+        os.replace(temp_path, self.path)
+
+        self.last_written = pgn
+        self.writes += 1
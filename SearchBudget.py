@@ -0,0 +1,92 @@
+"""
+Time budget for a bot move, instead of a fixed search depth. The budget
+follows from the strength of the bot (ENGINE_ELO, or ENGINE_MOVE_TIME
+when set), the complexity of the position and, when the bot plays with a
+clock (ENGINE_CLOCK), the time it has left.
+
+The search may use up to twice its budget, but stops as soon as the best
+move is stable: once the budget is used and the best move did not change
+for a few depths, or earlier when it stayed the same for many depths.
+Positions with a single legal move are not searched at all.
+"""
+
+import chess
+import chess.engine
+
+# Seconds per move at the lowest and highest strength, interpolated in between
+MIN_MOVE_TIME = 0.1
+MAX_MOVE_TIME = 2.0
+MIN_ELO = 1200
+MAX_ELO = 2800
+
+# Legal moves of a typical middlegame position, more moves means more time
+TYPICAL_MOVES = 30
+
+# Depths the best move has to stay the same, once the budget is used and before
+STABLE_DEPTHS = 2
+VERY_STABLE_DEPTHS = 5
+
+# Part of the budget searched before stopping on a very stable best move
+MIN_BUDGET_FRACTION = 0.3
+
+class SearchBudget:
+    def __init__(self, soft, hard, key=None, cacheable=True):
+        self.soft = soft
+        self.hard = hard
+        self.limit = chess.engine.Limit(time=hard)
+
+        # Identifies the configured budget in the engine cache, moves searched with a different one are not reused.
+        # Searches cut short by the clock are not stored, as they may be weaker than the configured budget.
+        self.key = key
+        self.cacheable = cacheable
+
+        self.best_move = None
+        self.stable_depths = 0
+        self.depth = 0
+        self.stopped_early = False
+
+    # Called with every info of the running search, True once the search can stop
+    def should_stop(self, info) -> bool:
+        pv = info.get("pv")
+        depth = info.get("depth")
+        if not pv or depth is None or depth <= self.depth:
+            return False
+
+        self.depth = depth
+        if pv[0] == self.best_move:
+            self.stable_depths += 1
+        else:
+            self.best_move = pv[0]
+            self.stable_depths = 0
+
+        elapsed = info.get("time", 0.0)
+        if elapsed >= self.soft and self.stable_depths >= STABLE_DEPTHS or \
+                elapsed >= self.soft * MIN_BUDGET_FRACTION and self.stable_depths >= VERY_STABLE_DEPTHS:
+            self.stopped_early = True
+        return self.stopped_early
+
+# Seconds per move for the strength of the bot
+def move_time(config) -> float:
+    configured = getattr(config, "ENGINE_MOVE_TIME", None)
+    if configured:
+        return configured
+
+    strength = (min(max(config.ENGINE_ELO, MIN_ELO), MAX_ELO) - MIN_ELO) / (MAX_ELO - MIN_ELO)
+    return MIN_MOVE_TIME + strength * (MAX_MOVE_TIME - MIN_MOVE_TIME)
+
+# The budget for searching the position. clock is the time the bot has left and increment its increment per move,
+# both in seconds, or None when playing without a clock.
+def plan(board, config, clock=None, increment=0.0) -> SearchBudget:
+    legal_moves = board.legal_moves.count()
+    complexity = min(max(legal_moves / TYPICAL_MOVES, 0.5), 1.5)
+    base = move_time(config)
+    soft = base * complexity
+    key = f"time={base:.2f}"
+
+    if clock is not None:
+        # Spread the remaining time over the moves still to come, never risking more than a quarter of it
+        moves_to_go = max(20, 50 - board.fullmove_number // 2)
+        clocked = min(soft, clock / moves_to_go + increment * 0.75)
+        hard = min(clocked * 2, clock / 4)
+        return SearchBudget(clocked, hard, key=key, cacheable=hard >= soft * 2)
+    return SearchBudget(soft, soft * 2, key=key)
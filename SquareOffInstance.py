@@ -3,63 +3,103 @@ Contains logic for parsing SquareOff events, and
 preventing false positives.
 """
 
+import logging
+
 import chess
-import asyncio
 
+from ChessboardInstance import MOVE_CAPTURE, MOVE_CASTLING, MOVE_EN_PASSANT
 import GeneralHelpers as GeneralHelpers 
+import Metrics
 import env
 
+log = logging.getLogger(__name__)
+
 class SquareOffInstance:
-    def __init__(self, chessboardInstance):
+    def __init__(self, chessboardInstance, config=None):
         self.chessboardInstance = chessboardInstance
+        self.config = config if config is not None else env
         self.uart_handler = None
 
         # By default, don't use the engine if not needed
         self.engineInstance = None
 
-        # Assuming default bitboard unless explicitely set
-        self.bitboardState = "11000011" * 8
+        # Assuming default occupation unless explicitely set
+        self.bitboardState = GeneralHelpers.STARTING_OCCUPATION
         self.picked_up_squares = set()
 
+        # Physical occupation as tracked from pickup and putdown events since the last board read. Only trusted while
+        # every event was consistent with it, otherwise the next board read resynchronises it.
+        self.physical_occupancy = GeneralHelpers.STARTING_OCCUPATION
+        self.physical_in_sync = False
+
         self.skip_next_diff = False
         self.set_castling_move = False
         self.turn = "white"
+        self.bot_move_pending = False
 
-        if env.PLAY_LICHESS_GAME:    
+        if self.config.PLAY_LICHESS_GAME:    
             self.bots = []
-        self.bots = env.ENGINE_PLAYERS
+        self.bots = self.config.ENGINE_PLAYERS
 
-    async def lightNonmatchingSquares(self, new_boardstate):
+    async def lightNonmatchingSquares(self, new_occupancy):
         if not self.set_castling_move:
-            await asyncio.sleep(0.3)
             await self.uart_handler.send_command(b"26#ISR*")
-            await asyncio.sleep(0.3)
-    
-        diff_squares = GeneralHelpers.bitboard_index_to_squares([i for i in range(len(new_boardstate)) if new_boardstate[i] != self.chessboardInstance.board_to_occupation_string()[i]])
-        print(diff_squares)
+
+        diff_squares = GeneralHelpers.mask_to_square_names(self.chessboardInstance.occupation_diff(new_occupancy))
+        log.debug("Mismatching squares: %s", diff_squares)
 
         # Light up mismatching LED's on the SquareOff board
-        await self.uart_handler.send_command(f"25#{"".join(diff_squares)}*".encode())
-        diff_squares = []
+        await self.uart_handler.send_command(f"25#{''.join(diff_squares)}*".encode())
 
     def reorder_file_major_to_rank_major(self, bitboard_string):
         assert len(bitboard_string) == 64, "Bitboard must be exactly 64 characters"
-        squares = [''] * 64
-        for file in range(8):
-            for rank in range(8):
-                src_index = file * 8 + rank
-                dst_index = rank * 8 + file
-                squares[dst_index] = bitboard_string[src_index]
-        return ''.join(squares)
-
-    # Converts bitboard string to a valid uci move
-    async def find_uci_move(self, new_board_bits):
-        self.bitboardState = new_board_bits
+        return ''.join(bitboard_string[GeneralHelpers.SQUARE_TO_FILE_MAJOR[square]] for square in chess.SQUARES)
+
+    def set_physical_occupancy(self, occupancy):
+        self.physical_occupancy = occupancy
+        self.physical_in_sync = True
+
+    def track_pickup(self, square_name):
+        square_mask = chess.BB_SQUARES[chess.parse_square(square_name)]
+        if not self.physical_occupancy & square_mask:
+            self.physical_in_sync = False
+        self.physical_occupancy &= ~square_mask
+
+    # Returns the predicted physical occupation after the putdown, or None if it can't be trusted
+    def track_putdown(self, square_name):
+        square_mask = chess.BB_SQUARES[chess.parse_square(square_name)]
+        if self.physical_occupancy & square_mask:
+            self.physical_in_sync = False
+        self.physical_occupancy |= square_mask
+        return self.physical_occupancy if self.physical_in_sync else None
+
+    # Whether a predicted occupation can be handled without reading the board: it either matches the game (a piece
+    # was put back, or the rook of a castling move was placed) or identifies exactly one legal move.
+    def can_infer(self, new_occupancy):
+        if not self.chessboardInstance.occupation_diff(new_occupancy):
+            return True
         if self.skip_next_diff:
-            print("Skipping move detection due to castling sync.")
+            return False
+
+        old_occupied = self.chessboardInstance.occupation_mask()
+        vacated = old_occupied & ~new_occupancy
+        newly_occupied = new_occupancy & ~old_occupied
+
+        if vacated.bit_count() == 1 and chess.square_name(chess.lsb(vacated)) not in self.picked_up_squares:
+            return False
+
+        candidates = [move for move, kind in self.chessboardInstance.matching_moves(vacated, newly_occupied)
+                      if kind != MOVE_CAPTURE or chess.square_name(move.to_square) in self.picked_up_squares]
+        return len(candidates) == 1
 
-            if new_board_bits != self.chessboardInstance.board_to_occupation_string():
-                await self.lightNonmatchingSquares(new_board_bits)
+    # Converts the occupation mask of the physical board to a valid uci move
+    async def find_uci_move(self, new_occupancy):
+        self.bitboardState = new_occupancy
+        if self.skip_next_diff:
+            log.debug("Skipping move detection due to castling sync.")
+
+            if self.chessboardInstance.occupation_diff(new_occupancy):
+                await self.lightNonmatchingSquares(new_occupancy)
             
             self.skip_next_diff = False
 
@@ -68,92 +108,89 @@ class SquareOffInstance:
 
             return None
 
-        def bitboard_to_set(bits):
-            return {i for i, b in enumerate(bits) if b == '1'}
+        old_occupied = self.chessboardInstance.occupation_mask()
+        vacated = old_occupied & ~new_occupancy
+        newly_occupied = new_occupancy & ~old_occupied
 
-        converted_bits = self.reorder_file_major_to_rank_major(new_board_bits)
-        old_occupied = set(chess.SquareSet(self.chessboardInstance.board.occupied))
-        new_occupied = bitboard_to_set(converted_bits)
+        moved_from = list(chess.scan_forward(vacated))
 
-        moved_from = list(old_occupied - new_occupied)
-        moved_to = list(new_occupied - old_occupied)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Moved from: %s", GeneralHelpers.mask_to_square_names(vacated))
+            log.debug("Moved to: %s", GeneralHelpers.mask_to_square_names(newly_occupied))
 
-        print(f"Moved from: {[chess.square_name(sq) for sq in moved_from]}")
-        print(f"Moved to: {[chess.square_name(sq) for sq in moved_to]}")
-
-        if len(moved_from) == 1:
+        if vacated.bit_count() == 1:
             moved_from_square_name = chess.square_name(moved_from[0])
             if moved_from_square_name not in self.picked_up_squares:
-                print(f"Blocked move from {moved_from_square_name}: Not picked up.")
+                log.info("Blocked move from %s: Not picked up.", moved_from_square_name)
                 return None
 
-            for move in self.chessboardInstance.board.legal_moves:
-                if move.from_square == moved_from[0]:
-                    if len(moved_to) == 1 and move.to_square == moved_to[0]:
-                        if self.chessboardInstance.board.is_capture(move):
-                            capture_square_name = chess.square_name(move.to_square)
-                            if capture_square_name not in self.picked_up_squares:
-                                print(f"Blocked capture on {capture_square_name}: Target not picked up.")
-                                continue
-
-                        if self.chessboardInstance.is_castling_move(move):
-                            print("Castling detected, waiting for rook move.")
-                            self.set_castling_move = move
-                            self.skip_next_diff = True
-                        return move
-                    
-                    elif len(moved_to) == 0 and move.to_square in old_occupied:
-                        if self.chessboardInstance.board.is_capture(move):
-                            capture_square_name = chess.square_name(move.to_square)
-                            if capture_square_name not in self.picked_up_squares:
-                                print(f"Blocked capture on {capture_square_name}: Target not picked up.")
-                                continue
-                        return move
-
-        if len(moved_from) == 2 and len(moved_to) == 1:
-            for move in self.chessboardInstance.board.legal_moves:
-                if self.chessboardInstance.board.is_en_passant(move):
-                    if move.to_square == moved_to[0] and move.from_square in moved_from:
-                        print("En Passant detected.")
-                        return move
+        # Every legal move causing exactly this occupation change, validated against the picked up squares
+        for move, kind in self.chessboardInstance.matching_moves(vacated, newly_occupied):
+            if kind == MOVE_CAPTURE:
+                capture_square_name = chess.square_name(move.to_square)
+                if capture_square_name not in self.picked_up_squares:
+                    log.info("Blocked capture on %s: Target not picked up.", capture_square_name)
+                    continue
+
+            elif kind == MOVE_CASTLING:
+                log.info("Castling detected, waiting for rook move.")
+                self.set_castling_move = move
+                self.skip_next_diff = True
+
+            elif kind == MOVE_EN_PASSANT:
+                log.info("En Passant detected.")
+
+            return move
 
         if self.turn in self.bots:
-            print(f"Bot turn for {self.turn}, not taken into consideration as player move")
+            log.debug("Bot turn for %s, not taken into consideration as player move", self.turn)
             return
         
-        print("No legal move found matching diff.")
+        log.info("No legal move found matching diff.")
         return None
 
     def _push_and_return(self, move):
         if self.chessboardInstance.is_promotion_move(move):
             move.promotion = self.chessboardInstance.prompt_for_promotion()
-        print(f"Matched move: {move.uci()}")
+        log.info("Matched move: %s", move)
 
-        self.chessboardInstance.board.push(move)
-        if self.chessboardInstance.current_node is not None:
-            self.chessboardInstance.current_node = self.chessboardInstance.current_node.add_variation(move)
+        self.chessboardInstance.push_move(move)
+        Metrics.since("putdown_to_match", "putdown", self.uart_handler)
 
         self.picked_up_squares.clear()
 
+        # The position changed underneath a running engine search, its result is no longer of use
+        if self.engineInstance:
+            self.engineInstance.cancel_search()
+
         return move.uci()
     
     async def check_turn(self, move=None):
         if self.chessboardInstance.board.turn == chess.WHITE:
             self.turn = "white"
-            print("White's turn")
+            log.info("White's turn")
         elif self.chessboardInstance.board.turn == chess.BLACK:
             self.turn = "black"
-            print("Black's turn")
+            log.info("Black's turn")
 
         if len(self.bots) > 0 and self.turn in self.bots:
-            # Make bot move
-            engineMove = self.engineInstance.pass_boardstate(input_fen=self.chessboardInstance.board.fen(), input_move=move)
-            await self.engineInstance._pass_and_return(engineMove)
+            # Board reads that arrive while the opponent is thinking should not start another bot move
+            if self.bot_move_pending:
+                return
+
+            # Make bot move. The opponent is awaited without blocking the event loop, so notifications from the board
+            # keep being handled in the meantime.
+            self.bot_move_pending = True
+            try:
+                engineMove = await self.engineInstance.pass_boardstate(input_fen=self.chessboardInstance.board.fen(), input_move=move)
+                await self.engineInstance._pass_and_return(engineMove)
+            finally:
+                self.bot_move_pending = False
             
     # Function called everytime a move is made
     async def on_move_made(self, move: None):
         if self.set_castling_move:
-            print("Skipping engine move after castling rook move.")
+            log.debug("Skipping engine move after castling rook move.")
             self.set_castling_move = False
 
         await self.check_turn(move=move)
\ No newline at end of file
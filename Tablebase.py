@@ -0,0 +1,140 @@
+"""
+Syzygy endgame tablebases. Once few enough pieces are left, the bot move
+is looked up instead of searched: the tables give the exact result of
+every position (WDL) and the distance to the next capture or pawn move
+(DTZ), which is enough to play perfectly.
+
+At full strength the DTZ-optimal move is played, winning as fast as the
+tables allow and holding out as long as possible when lost. Below
+SYZYGY_OPTIMAL_ELO any move keeping the result (win, draw or loss) is
+played, but when winning only moves that bring the next capture or pawn
+move closer (lower DTZ) and don't repeat a position. That way weaker bots
+still convert won endgames before the 50-move rule, just not in the most
+direct way. Once the 50-move counter gets close, they play the
+DTZ-optimal move as well.
+
+Tables are opened once per directory and shared by every game. The
+table files are memory mapped by python-chess and kept open.
+"""
+
+import logging
+import os
+import random
+import time
+
+import chess
+import chess.syzygy
+
+log = logging.getLogger(__name__)
+
+# Plies before the 50-move rule draws the game from which weaker bots play the DTZ-optimal move as well
+HALFMOVE_RESERVE = 10
+
+class Tablebase:
+    def __init__(self, path):
+        self.path = path
+
+        # max_fds=None keeps every table mapped once it has been used, instead of closing the least recently used
+        self.tablebase = chess.syzygy.open_tablebase(path, max_fds=None)
+        self.max_pieces = max((len(name) - 1 for name in self.tablebase.wdl), default=0)
+        self.users = 0
+
+    # Whether the position is within the tables. Positions with castling rights are never in the tables.
+    def covers(self, board) -> bool:
+        return not board.castling_rights and chess.popcount(board.occupied) <= self.max_pieces
+
+    # Rates a move for the side making it, higher is better: the result first, then the distance to zeroing the
+    # 50-move counter (short when winning, long when losing)
+    def rate(self, board, move):
+        board.push(move)
+        try:
+            if board.is_checkmate():
+                return (2, 1000)
+            wdl = -self.tablebase.probe_wdl(board)
+            dtz = abs(self.tablebase.probe_dtz(board))
+        finally:
+            zeroing = board.halfmove_clock == 0
+            board.pop()
+
+        # A capture or pawn move keeping the win restarts the count, that is always progress
+        if wdl > 0:
+            return (wdl, 500 if zeroing else -dtz)
+        if wdl < 0:
+            return (wdl, -500 if zeroing else dtz)
+        return (wdl, 0)
+
+    # Returns the move to play, or None if the position is not in the tables
+    def probe(self, board, optimal=True):
+        if not self.covers(board):
+            return None
+
+        # With the move stack, to recognise repetitions
+        board = board.copy()
+        try:
+            dtz = abs(self.tablebase.probe_dtz(board))
+            rated = [(self.rate(board, move), move) for move in board.legal_moves]
+        except KeyError:
+            # chess.syzygy.MissingTableError, a table for one of the positions is not available
+            return None
+        if not rated:
+            return None
+
+        best = max(rating for rating, _ in rated)
+        best_move = next(move for rating, move in rated if rating == best)
+        if optimal:
+            return best_move
+        if best[0] <= 0:
+            return random.choice([move for rating, move in rated if rating[0] == best[0]])
+
+        # Winning: lowering DTZ with every move (rating -dtz after the move, or a capture, pawn move or mate) converts
+        # within the 50-move rule
+        if board.halfmove_clock + dtz >= 100 - HALFMOVE_RESERVE:
+            return best_move
+        progress = [move for rating, move in rated if rating[0] == best[0] and rating[1] > -dtz
+                    and not self.repeats(board, move)]
+        return random.choice(progress) if progress else best_move
+
+    @staticmethod
+    def repeats(board, move) -> bool:
+        board.push(move)
+        try:
+            return board.is_repetition(2)
+        finally:
+            board.pop()
+
+    def close(self):
+        self.tablebase.close()
+
+_tablebases = {}
+
+# Returns the tablebase in the config (SYZYGY_PATH), shared with every other game, or None if not configured. Every
+# acquire should be followed by a release once the game is over.
+def acquire(config):
+    path = getattr(config, "SYZYGY_PATH", None)
+    if not path:
+        return None
+
+    path = os.path.realpath(path)
+    tablebase = _tablebases.get(path)
+    if tablebase is None:
+        started = time.perf_counter()
+        try:
+            tablebase = Tablebase(path)
+        except OSError as e:
+            log.warning("Could not open Syzygy tables: %s", e)
+            return None
+        if not tablebase.max_pieces:
+            log.warning("No Syzygy tables found in %s", path)
+            tablebase.close()
+            return None
+        _tablebases[path] = tablebase
+        log.info("Opened %d Syzygy tables up to %d pieces in %.0f ms", len(tablebase.tablebase.wdl),
+                 tablebase.max_pieces, (time.perf_counter() - started) * 1000)
+    tablebase.users += 1
+    return tablebase
+
+def release(tablebase):
+    tablebase.users -= 1
+    if tablebase.users <= 0:
+        _tablebases.pop(tablebase.path, None)
+        tablebase.close()
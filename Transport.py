@@ -0,0 +1,45 @@
+"""
+Transports carry commands to and notifications from a SquareOff Pro.
+ChessBoardUARTHandler only talks to a transport, so the same code can
+drive a real board over BLE or a simulated one (see BoardSimulator.py).
+
+A transport provides:
+- write(data): send a command to the board
+- start_notify(callback): deliver notifications as callback(characteristic, data)
+"""
+
+import asyncio
+
+from GeneralHelpers import UART_TX_CHAR_UUID, sliced
+
+try:
+    from bleak.exc import BleakError
+except ImportError:
+    BleakError = OSError
+
+# Errors a transport raises when the board can't be reached, for instance because it disconnected. BlueZ reports a
+# dropped D-Bus connection as EOFError.
+TRANSPORT_ERRORS = (BleakError, OSError, EOFError, asyncio.TimeoutError)
+
+class BleTransport:
+    def __init__(self, client, rx_char):
+        self.client = client
+        self.rx_char = rx_char
+
+    async def write(self, data: bytes):
+        for s in sliced(data, self.rx_char.max_write_without_response_size):
+            await self.client.write_gatt_char(self.rx_char, s, response=False)
+
+    async def start_notify(self, callback):
+        await self.client.start_notify(UART_TX_CHAR_UUID, callback)
+
+# Accepts and records commands without a board behind it, for instance when replaying recorded notifications
+class NullTransport:
+    def __init__(self):
+        self.commands = []
+
+    async def write(self, data: bytes):
+        self.commands.append(data)
+
+    async def start_notify(self, callback):
+        return
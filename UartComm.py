@@ -4,135 +4,281 @@ the SquareOff Pro board (pieces being moved, or the state
 of the board being communicated). 
 """
 
-import time
-import chess
-import chess.pgn
 import asyncio
+import logging
+import re
+import chess
 
 from ChessboardInstance import ChessboardInstance
 from SquareOffInstance import SquareOffInstance
+from CommandScheduler import CommandScheduler, PRIORITY_CONTROL
+from NotificationLog import NotificationRecorder, INBOUND, OUTBOUND
+from GameJournal import GameJournal, restore_game
+from BoardConfig import qualified_name
 
+import FrameParser
 import GeneralHelpers
+import Metrics
 import env
 
+log = logging.getLogger(__name__)
+
+# Move messages such as 0#a2h8, a pickup on the first square followed by a putdown on the second
+MOVE_MESSAGE = re.compile(r"0#([a-h][1-8])([a-h][1-8])\*?")
+
 class ChessBoardUARTHandler:
-    def __init__(self, client, rx_char):
-        self.client = client
-        self.rx_char = rx_char
+    def __init__(self, transport, config=None):
+        # BLE connection to the board, or a simulated board (see Transport.py)
+        self.transport = transport
+
+        # Settings of this board, env.py unless running several boards (see BoardConfig.py)
+        self.config = config if config is not None else env
+
+        # All outbound commands are queued, paced and coalesced by the scheduler
+        self.scheduler = CommandScheduler(write=self.write_command)
+
+        # Optionally record all traffic with the board, see NotificationLog.py
+        record_path = getattr(self.config, "RECORD_NOTIFICATIONS", None)
+        self.recorder = NotificationRecorder(record_path) if record_path else None
+
+        # Incoming messages are dispatched on their command, the part before '#'
+        self.parser = FrameParser.FrameParser()
+        self.message_handlers = {
+            b"0": self.handle_square_message,
+            b"30": self.handle_board_read,
+        }
+
+        # Moves are inferred from pickup/putdown events where possible, with a full board read every
+        # BOARD_VERIFY_INTERVAL inferred moves to check the physical board is still in sync.
+        self.infer_moves = getattr(self.config, "INFER_MOVES_FROM_EVENTS", True)
+        self.verify_interval = getattr(self.config, "BOARD_VERIFY_INTERVAL", 10)
+        self.inferred_since_read = 0
+        self.inferred_moves = 0
+        self.board_reads = 0
+
+        # Set once the board state has been read after starting or reconnecting
+        self.ready = asyncio.Event()
+
+        Metrics.add_source(qualified_name(self.config, "board_commands"), self.scheduler.stats)
+        Metrics.add_source(qualified_name(self.config, "move_inference"), self.inference_stats)
 
     # Function is called on succesful connection to the SquareOff board.
     async def CommSuccess(self):
 
-        if env.ENABLE_LICHESS_BROADCAST:
+        if self.config.ENABLE_LICHESS_BROADCAST:
             from LichessBroadcaster import LichessBroadcaster
-            self.lichessBroadcast = LichessBroadcaster()
-            self.lichessBroadcast.create_broadcast("SquareOff broadcast", "SquareOff broadcast of an OTB-game")
-            self.lichessBroadcast.create_round("Game 1")
-
-            pgn_text = self.chessboardInstance.game.accept(chess.pgn.StringExporter(headers=True, variations=True, comments=True))
-            self.lichessBroadcast.update_round(pgn_text)
+            self.lichessBroadcast = LichessBroadcaster(self.chessboardInstance, config=self.config)
+            await self.lichessBroadcast.create_broadcast("SquareOff broadcast", "SquareOff broadcast of an OTB-game")
+            await self.lichessBroadcast.create_round("Game 1")
+            self.lichessBroadcast.update_round()
 
     async def handle_rx(self, characteristic, data: bytearray):
-        decoded = data.decode("utf-8")
-        print("received:", decoded)
+        if self.recorder:
+            self.recorder.record(INBOUND, bytes(data))
 
-        # Called whenever a piece is picked up
-        if decoded.startswith("0#") and decoded.endswith("u*"):
-            square = decoded[2:-2]
+        # A notification can hold part of a message or several messages, see FrameParser.py
+        for frame in self.parser.feed(data):
+            message = str(frame, "utf-8", "replace")
+            log.debug("received: %s", message)
+
+            handler = self.message_handlers.get(FrameParser.prefix(frame))
+            if handler:
+                await handler(message)
 
-            # Logic is implemented to prevent rare edgecases where multiple moves can share the same
-            # occupied space states/bitboard.
-            self.squareOffInstance.last_pickup_square = square
-            self.squareOffInstance.picked_up_squares.add(square)
+    # Messages about single squares
+    async def handle_square_message(self, message):
+        # Called whenever a piece is picked up
+        if message.endswith("u*"):
+            self.handle_pickup(message[2:-2])
 
         # Called whenever a piece is placed down on the board
-        elif decoded.startswith("0#") and decoded.endswith("d*"):
+        elif message.endswith("d*"):
+            await self.handle_putdown(message[2:-2])
 
-            # Request current state of physical board from SquareOff Pro.
-            await self.send_command(b"30#R*\r\n")
+        # Move from one square to another, handled as a pickup and a putdown
+        elif move_message := MOVE_MESSAGE.fullmatch(message):
+            self.handle_pickup(move_message.group(1))
+            await self.handle_putdown(move_message.group(2))
 
-        # Triggers in response to current state request 
-        elif decoded.startswith("30#") and decoded.endswith("*"):
-            new_boardstate = decoded.split('#', 1)[1].rstrip('*')
-            
-            print(new_boardstate)
-            # Communicate the new state of the board as presented by SquareOff to the engine, to allow the engine to light up
-            # specific squares on the board.
-            if self.opponentInstance:
-                self.opponentInstance.originalBitboard = new_boardstate
+    # Triggers in response to current state request 
+    async def handle_board_read(self, message):
+        self.scheduler.on_board_response()
+        Metrics.since("putdown_to_read", "putdown", self)
+        new_boardstate = message.split('#', 1)[1].rstrip('*')
+        
+        log.debug("%s", new_boardstate)
+
+        # Parse the occupation string once, everything downstream works on the resulting mask
+        try:
+            new_occupancy = GeneralHelpers.occupation_string_to_mask(new_boardstate)
+        except ValueError as e:
+            log.warning("%s", e)
+            return
+
+        self.squareOffInstance.set_physical_occupancy(new_occupancy)
+        self.inferred_since_read = 0
+        self.board_reads += 1
+        self.ready.set()
+        await self.handle_board_state(new_occupancy)
+
+    def handle_pickup(self, square):
+        # Logic is implemented to prevent rare edgecases where multiple moves can share the same
+        # occupied space states/bitboard.
+        self.squareOffInstance.last_pickup_square = square
+        self.squareOffInstance.picked_up_squares.add(square)
+        self.squareOffInstance.track_pickup(square)
+
+    async def handle_putdown(self, square):
+        Metrics.mark("putdown", self)
+        predicted = self.squareOffInstance.track_putdown(square)
+
+        # Fast path: the pickups and putdowns since the last board read identify the move (or confirm the board
+        # is in sync), so there is no need to wait for the full board state.
+        if self.infer_moves and predicted is not None and self.inferred_since_read < self.verify_interval \
+                and self.squareOffInstance.can_infer(predicted):
+            self.inferred_since_read += 1
+            self.inferred_moves += 1
+            await self.handle_board_state(predicted)
+            return
+
+        # Request current state of physical board from SquareOff Pro.
+        await self.send_command(b"30#R*\r\n")
+
+    # Handles a new physical state of the board, either read from the board or inferred from events
+    async def handle_board_state(self, new_occupancy):
+        # Communicate the new state of the board as presented by SquareOff to the engine, to allow the engine to light up
+        # specific squares on the board.
+        if self.opponentInstance:
+            self.opponentInstance.originalBitboard = new_occupancy
 
-            # Calls the function responsible for converting the SquareOff occupation string to a valid move
-            madeMove = await self.squareOffInstance.find_uci_move(new_board_bits=new_boardstate)                
+        # Calls the function responsible for converting the SquareOff occupation to a valid move
+        started = Metrics.start()
+        madeMove = await self.squareOffInstance.find_uci_move(new_occupancy=new_occupancy)
+        Metrics.stop("match", started)
 
-            # madeMove will either return a valid move, or return None in the case of castling (two moves) or illegal moves.
-            if madeMove:
+        # madeMove will either return a valid move, or return None in the case of castling (two moves) or illegal moves.
+        if madeMove:
 
-                # Push the resulting valid move to the ChessboardInstance.
-                # TODO: Move logic from SquareOff class to UartComm
-                self.squareOffInstance._push_and_return(madeMove)
+            # Push the resulting valid move to the ChessboardInstance.
+            # TODO: Move logic from SquareOff class to UartComm
+            self.squareOffInstance._push_and_return(madeMove)
 
-            # Check if the physical location of pieces matches with the expected occupied spaces on the ChessboardInstance.
-            if (new_boardstate != self.chessboardInstance.board_to_occupation_string()):
-                await self.squareOffInstance.lightNonmatchingSquares(new_boardstate)
+        # Check if the physical location of pieces matches with the expected occupied spaces on the ChessboardInstance.
+        if self.chessboardInstance.occupation_diff(new_occupancy):
+            await self.squareOffInstance.lightNonmatchingSquares(new_occupancy)
             
-            # If boardstates are matching (physical and ChessboardInstance, check if game is over). This is done here, to prevent
-            # a winner being indicated prematurely.
-            if (new_boardstate == self.chessboardInstance.board_to_occupation_string()):
-                await asyncio.sleep(0.3)
-                await self.send_command(b"26#ISG*")
-                await asyncio.sleep(0.3)
-                
-                pgn_text = self.chessboardInstance.game.accept(chess.pgn.StringExporter(headers=True, variations=True, comments=True))
-
-                if env.ENABLE_LICHESS_BROADCAST:
-                    self.lichessBroadcast.update_round(pgn_text)
-
-                if self.chessboardInstance.board.is_checkmate():
-                    winner = "Black" if self.chessboardInstance.board.turn == chess.WHITE else "White"
-                    print(f"Checkmate! {winner} wins.")
-                    if (winner == "White"):
-                        await self.send_command(b"27#wt*\r\n")
-                    if (winner == "Black"):
-                        await self.send_command(b"27#bl*\r\n")
-
-                elif self.chessboardInstance.board.is_stalemate() or self.chessboardInstance.board.is_insufficient_material():
-                    print("The game is a draw.")
-                    await self.send_command(b"27#dw*\r\n")
+        # If boardstates are matching (physical and ChessboardInstance, check if game is over). This is done here, to prevent
+        # a winner being indicated prematurely.
+        if not self.chessboardInstance.occupation_diff(new_occupancy):
+            await self.send_command(b"26#ISG*")
+
+            if self.config.ENABLE_LICHESS_BROADCAST:
+                self.lichessBroadcast.update_round()
+
+            if self.chessboardInstance.board.is_checkmate():
+                winner = "Black" if self.chessboardInstance.board.turn == chess.WHITE else "White"
+                log.info("Checkmate! %s wins.", winner)
+                if (winner == "White"):
+                    await self.send_command(b"27#wt*\r\n")
+                if (winner == "Black"):
+                    await self.send_command(b"27#bl*\r\n")
+                self.finish_game()
+
+            elif self.chessboardInstance.board.is_stalemate() or self.chessboardInstance.board.is_insufficient_material():
+                log.info("The game is a draw.")
+                await self.send_command(b"27#dw*\r\n")
+                self.finish_game()
                 
-                await self.squareOffInstance.on_move_made(madeMove)
+            await self.squareOffInstance.on_move_made(madeMove)
+
+    # The game is over, it should not be resumed on the next start
+    def finish_game(self):
+        if self.journal:
+            self.journal.finish(self.chessboardInstance.board.result())
+
+    def inference_stats(self):
+        return {"inferred_moves": self.inferred_moves, "board_reads": self.board_reads}
 
-    async def send_command(self, data: bytes):
-        for s in GeneralHelpers.sliced(data, self.rx_char.max_write_without_response_size):
-            await self.client.write_gatt_char(self.rx_char, s, response=False)
+    # Statistics of this board, see MultiBoard.py
+    def stats(self) -> dict:
+        chessboardInstance = getattr(self, "chessboardInstance", None)
+        return {
+            "board": getattr(self.config, "BOARD_NAME", None),
+            "moves": len(chessboardInstance.board.move_stack) if chessboardInstance else 0,
+            "fen": chessboardInstance.board.fen() if chessboardInstance else None,
+            "commands": self.scheduler.stats(),
+            **self.inference_stats(),
+        }
+
+    # Queues a command for the board. Never waits for the write itself, see CommandScheduler.
+    async def send_command(self, data: bytes, priority=None):
+        self.scheduler.submit(data, priority=priority)
+
+    async def write_command(self, data: bytes):
+        if self.recorder:
+            self.recorder.record(OUTBOUND, data)
+        await self.transport.write(data)
+
+        # First LED update after a putdown or an opponent move
+        if Metrics.ENABLED and data.startswith(b"25#"):
+            Metrics.since("putdown_to_led", "putdown", self, clear=True)
+            Metrics.since("opponent_to_led", "opponent_move", self, clear=True)
 
     # Push start of game sequence to the SquareOff board, as intercepted from the SquareOff mobile application
+    # The sequence is sent as the app does, in this order, so all of it gets the same priority instead of the priority
+    # of each kind
     async def send_game_start_sequence(self):
         sequence = [b"!#*\r\n", b"25#*\r\n", b"26#ISG*\r\n"]
         for cmd in sequence:
-            await self.send_command(cmd)
-            time.sleep(0.5)
+            await self.send_command(cmd, priority=PRIORITY_CONTROL)
 
-        print("Checking board setup...")
-        await self.send_command(b"30#R*\r\n")
+        log.info("Checking board setup...")
+        await self.send_command(b"30#R*\r\n", priority=PRIORITY_CONTROL)
     
+    # Continues the game in memory after the board reconnected. Pieces may have moved while disconnected, so instead of
+    # the game start sequence the board state is read once.
+    async def resync(self, transport):
+        self.transport = transport
+        self.parser.reset()
+        self.scheduler.on_reconnect()
+        self.squareOffInstance.physical_in_sync = False
+        self.ready.clear()
+
+        await transport.start_notify(self.handle_rx)
+        await self.send_command(b"30#R*\r\n")
+
     async def start_game(self):
-        self.chessboardInstance = ChessboardInstance(initial_fen=env.STARTING_FEN)
-        self.squareOffInstance = SquareOffInstance(chessboardInstance=self.chessboardInstance)
+        self.chessboardInstance = ChessboardInstance(initial_fen=self.config.STARTING_FEN, config=self.config)
+
+        # Continue an unfinished game from the journal, the board read after the start sequence verifies the pieces
+        # still match. From then on every move is journaled, see GameJournal.py.
+        self.journal = None
+        journal_path = getattr(self.config, "GAME_JOURNAL_PATH", None)
+        if journal_path:
+            restore_game(self.chessboardInstance, journal_path)
+            self.journal = GameJournal(self.chessboardInstance, journal_path)
+        self.squareOffInstance = SquareOffInstance(chessboardInstance=self.chessboardInstance, config=self.config)
+
+        # Promotion choices are recorded with the notifications, so a replay doesn't ask for them
+        if self.recorder:
+            self.chessboardInstance.listeners.append(self.recorder)
 
         self.OpponentInstance = None
 
         # Instantiate the opponent, based on whether the player wants to play against stockfish, Lichess, or just OTB
         # Detect what game should be played, and prevent unneeded imports
-        if env.PLAY_LICHESS_GAME:
+        if self.config.PLAY_LICHESS_GAME:
             from Opponents.LichessInstance import LichessInstance
             self.OpponentInstance = LichessInstance
-        elif len(env.ENGINE_PLAYERS) > 0:
+        elif len(self.config.ENGINE_PLAYERS) > 0:
             from Opponents.EngineInstance import EngineInstance
             self.OpponentInstance = EngineInstance
 
 
         if self.OpponentInstance:
-            self.opponentInstance = self.OpponentInstance(chessboardInstance=self.chessboardInstance, squareoffInstance=self.squareOffInstance)
+            self.opponentInstance = self.OpponentInstance(chessboardInstance=self.chessboardInstance, squareoffInstance=self.squareOffInstance,
+                                                           config=self.config)
+            await self.opponentInstance.start()
         else:
             self.opponentInstance = None
 
@@ -144,7 +290,43 @@ class ChessBoardUARTHandler:
             self.opponentInstance.uart_handler = self
 
         await self.CommSuccess()
+
+        # Optionally evaluate every position in the background, see LiveAnalysis.py
+        self.liveAnalysis = None
+        if getattr(self.config, "LIVE_ANALYSIS", False):
+            from LiveAnalysis import LiveAnalysis
+            broadcast = getattr(self, "lichessBroadcast", None)
+            self.liveAnalysis = LiveAnalysis(self.chessboardInstance, config=self.config,
+                                             on_annotated=broadcast.update_round if broadcast else None)
+            await self.liveAnalysis.start()
+
         await self.send_game_start_sequence()
 
         # First move, check to see who's turn it is
-        await self.squareOffInstance.check_turn()
\ No newline at end of file
+        await self.squareOffInstance.check_turn()
+
+    # Shuts down the opponent (engine process or Lichess streams) and, unless other boards still use them, any open
+    # Lichess connections
+    async def stop_game(self, close_client=True):
+        await self.scheduler.close()
+        log.info("Board commands: %s", self.scheduler.summary())
+
+        if self.recorder:
+            self.recorder.close()
+
+        if getattr(self, "journal", None):
+            self.journal.close()
+            log.info("Game journal: %s", self.journal.summary())
+
+        if getattr(self, "liveAnalysis", None):
+            await self.liveAnalysis.close()
+
+        if getattr(self, "lichessBroadcast", None):
+            await self.lichessBroadcast.close()
+
+        if getattr(self, "opponentInstance", None):
+            await self.opponentInstance.close()
+
+        if close_client and (self.config.PLAY_LICHESS_GAME or getattr(self.config, "LICHESS_BROADCAST_PUSH", False)):
+            import LichessApi
+            await LichessApi.close_client()
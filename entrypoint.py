@@ -1,50 +1,174 @@
 import asyncio
+import os
 import sys
+import time
 from bleak import BleakClient, BleakScanner
+from bleak.exc import BleakError
 
 # CircleOn specific imports, such as helper functions and the python-chess instance
-from GeneralHelpers import UART_SERVICE_UUID, UART_TX_CHAR_UUID, UART_RX_CHAR_UUID, sliced
+from GeneralHelpers import UART_SERVICE_UUID, UART_TX_CHAR_UUID, UART_RX_CHAR_UUID
+from Transport import BleTransport
 from UartComm import ChessBoardUARTHandler
+import Log
+import Metrics
 
 # General settings for the application
 import env
 
-async def uart_terminal():
+DEVICE_NAME = "Squareoff Pro"
 
-    # Squareoff Pro should be a safe hard-coded value
-    device = await BleakScanner.find_device_by_name("Squareoff Pro", cb={"use_bdaddr": True})
+# Seconds to try the cached address before falling back to scanning
+DIRECT_CONNECT_TIMEOUT = 5.0
+
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 30.0
+
+# The address of the last board connected to, so the next start can connect without scanning
+def load_cached_address(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as cache_file:
+        return cache_file.read().strip() or None
+
+def save_cached_address(path, address):
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as cache_file:
+        cache_file.write(address)
 
+# Connects to the cached board address directly, and scans for the board if that fails
+async def connect(cache_path, disconnected_callback) -> BleakClient:
+    address = load_cached_address(cache_path)
+    if address:
+        client = BleakClient(address, disconnected_callback=disconnected_callback, timeout=DIRECT_CONNECT_TIMEOUT)
+        try:
+            await client.connect()
+            print(f"Connected to {address} without scanning.")
+            return client
+        except (BleakError, asyncio.TimeoutError, OSError) as e:
+            print(f"Could not connect to {address} directly ({e!r}), scanning...")
+
+    # Squareoff Pro should be a safe hard-coded value
+    device = await BleakScanner.find_device_by_name(DEVICE_NAME, cb={"use_bdaddr": True})
     if device is None:
-        print("No matching device found.")
-        sys.exit(1)
+        raise BleakError("No matching device found.")
+
+    client = BleakClient(address_or_ble_device=device, disconnected_callback=disconnected_callback)
+    await client.connect()
+    save_cached_address(cache_path, device.address)
+    return client
+
+# Keeps the board connected. The game is started on the first connection and resynchronised after reconnecting.
+# Only connection problems are retried, errors starting the game end the task.
+async def maintain_connection(handler, connected):
+    cache_path = getattr(env, "DEVICE_CACHE_PATH", None)
+    delay = RECONNECT_MIN
+    started_game = False
 
-    def handle_disconnect(_: BleakClient):
-        print("Device was disconnected.")
-        for task in asyncio.all_tasks():
-            task.cancel()
+    while True:
+        attempt_started = time.perf_counter()
+        disconnected = asyncio.Event()
+        client = None
+        try:
+            client = await connect(cache_path, lambda _: disconnected.set())
+            await client.start_notify(UART_TX_CHAR_UUID, lambda c, d: None)
+            print("Connected...")
 
-    async with BleakClient(address_or_ble_device=device, disconnected_callback=handle_disconnect) as client:
-        await client.start_notify(UART_TX_CHAR_UUID, lambda c, d: None)
-        print("Connected...")
+            nus = client.services.get_service(UART_SERVICE_UUID)
+            rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
+            transport = BleTransport(client=client, rx_char=rx_char)
 
-        nus = client.services.get_service(UART_SERVICE_UUID)
-        rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
+            if not started_game:
+                handler.transport = transport
+                await transport.start_notify(handler.handle_rx)
+            else:
+                await handler.resync(transport)
+        except (BleakError, asyncio.TimeoutError, OSError) as e:
+            print(f"{e!r} Retrying in {delay:.0f} s.")
+            if client is not None:
+                await disconnect_quietly(client)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+            continue
 
-        # Instantiate the UART communicator, responsible for performing activities with changes on the board
-        handler = ChessBoardUARTHandler(client=client, rx_char=rx_char)
+        ready_reached = False
+        try:
+            if not started_game:
+                await handler.start_game()
+                started_game = True
+            connected.set()
 
-        await client.start_notify(UART_TX_CHAR_UUID, handler.handle_rx)
-        
-        await handler.start_game()
+            # The board may drop the link before it answers the first board read
+            ready = asyncio.create_task(handler.ready.wait())
+            dropped = asyncio.create_task(disconnected.wait())
+            try:
+                await asyncio.wait({ready, dropped}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                ready.cancel()
+                dropped.cancel()
+
+            if handler.ready.is_set() and not disconnected.is_set():
+                ready_reached = True
+                delay = RECONNECT_MIN
+                time_to_ready = time.perf_counter() - attempt_started
+                Metrics.observe("time_to_ready", time_to_ready)
+                print(f"Board ready in {time_to_ready:.2f} s.")
+                await disconnected.wait()
+        finally:
+            connected.clear()
+            await disconnect_quietly(client)
+
+        if ready_reached:
+            print("Device was disconnected, reconnecting...")
+        else:
+            # Back off as for a failed connection, a board that keeps dropping would otherwise be reconnected in a loop
+            print(f"Device was disconnected before it was ready, reconnecting in {delay:.0f} s.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+async def disconnect_quietly(client):
+    try:
+        await client.disconnect()
+    except (BleakError, asyncio.TimeoutError, OSError) as e:
+        print(f"Disconnecting failed: {e!r}")
+
+async def uart_terminal():
+    Log.setup(env)
+    await Metrics.start_from_config(env)
+
+    # Instantiate the UART communicator, responsible for performing activities with changes on the board. The handler
+    # and its game outlive connections to the board.
+    handler = ChessBoardUARTHandler(transport=None)
+    connected = asyncio.Event()
+    connection_task = asyncio.create_task(maintain_connection(handler, connected))
+
+    try:
+        # Errors starting the game end the connection task, they are raised here rather than waiting forever
+        waiting = asyncio.create_task(connected.wait())
+        await asyncio.wait({waiting, connection_task}, return_when=asyncio.FIRST_COMPLETED)
+        waiting.cancel()
+        if connection_task.done():
+            connection_task.result()
 
         loop = asyncio.get_running_loop()
         while True:
             data = await loop.run_in_executor(None, sys.stdin.buffer.readline)
             if not data:
                 break
-            for s in sliced(data, rx_char.max_write_without_response_size):
-                await client.write_gatt_char(rx_char, s, response=False)
+            if not connected.is_set():
+                print("Not connected, command not sent.")
+                continue
+            # Through the command queue, so its record of the LED state stays correct
+            await handler.send_command(data)
             print("sent:", data)
+    finally:
+        connection_task.cancel()
+        await asyncio.gather(connection_task, return_exceptions=True)
+        if hasattr(handler, "chessboardInstance"):
+            await handler.stop_game()
 
 if __name__ == "__main__":
     try:
@@ -6,9 +6,47 @@ ENGINE_PLAYERS=["white"]
 STOCKFISH_LOCATION="stockfish.exe"
 ENGINE_ELO=1200
 
+# By default the engine searches every move to depth 20. With
+# ENGINE_SEARCH_BUDGET=True it thinks for a time based on ENGINE_ELO (or
+# ENGINE_MOVE_TIME seconds when set), the number of legal moves and the clock
+# instead, and stops early once its best move is stable, which changes how
+# strong the bot plays. ENGINE_CLOCK=(seconds, increment) gives the bot a
+# clock, None plays without one.
+ENGINE_SEARCH_BUDGET=False
+ENGINE_MOVE_TIME=None
+ENGINE_CLOCK=None
+
+# Endgame tablebases. When SYZYGY_PATH points to a directory with Syzygy tables
+# (.rtbw/.rtbz files), bot moves in positions covered by the tables are looked up
+# instead of searched. Bots with an ENGINE_ELO of at least SYZYGY_OPTIMAL_ELO
+# play the fastest win, weaker bots any move keeping the result.
+SYZYGY_PATH=None
+SYZYGY_OPTIMAL_ELO=2000
+
+# Engine moves are remembered per position and engine settings, so positions
+# seen before are answered without searching. The most recent ENGINE_CACHE_SIZE
+# moves are kept in memory, up to ENGINE_CACHE_DISK_SIZE moves in the file at
+# ENGINE_CACHE_PATH (None keeps the cache in memory only). When OPENING_BOOK_PATH
+# points to a Polyglot (.bin) book, book moves are played first.
+ENGINE_CACHE_PATH="Game/engine_cache.sqlite"
+ENGINE_CACHE_SIZE=1024
+ENGINE_CACHE_DISK_SIZE=100000
+OPENING_BOOK_PATH=None
+
+# Engine processes are shared by all games (see MultiBoard.py). At most
+# ENGINE_POOL_SIZE engines are started, each using ENGINE_THREADS threads. None
+# sizes the pool to the number of CPU cores.
+ENGINE_POOL_SIZE=None
+ENGINE_THREADS=4
+
+# While the human is moving, the engine searches the reply it expects in the
+# background, so a correct prediction is answered right away.
+ENGINE_PONDER=True
+
 # Experimental, Lichess play
 PLAY_LICHESS_GAME = False
 LICHESS_TOKEN = ""
+LICHESS_BASE_URL = "https://lichess.org"
 
 # Specific to Lichess broadcasting. This function is handy for when you want to
 # stream your OTB-games to your friends, or if you want to perform live analysis
@@ -20,6 +58,29 @@ LICHESS_TOKEN = ""
 ENABLE_LICHESS_BROADCAST=False
 PGN_WRITE_LOCATION="Game/games.pgn"
 
+# When GAME_JOURNAL_PATH is set, for instance to "Game/journal.txt", every move
+# is journaled there and an unfinished game is resumed when the application is
+# restarted. To start a new game instead, delete the file before starting. In
+# multi-board mode every board gets its own journal, derived from this path.
+GAME_JOURNAL_PATH=None
+
+# Instead of relying on the broadcaster application, the game can also be pushed
+# to Lichess directly. This creates a broadcast with a round for the game, or
+# pushes to LICHESS_BROADCAST_ROUND_ID when set. Requires a LICHESS_TOKEN with
+# the study:write scope. Updates are sent at most every LICHESS_BROADCAST_DEBOUNCE
+# seconds.
+LICHESS_BROADCAST_PUSH=False
+LICHESS_BROADCAST_ROUND_ID=None
+LICHESS_BROADCAST_DEBOUNCE=1.0
+
+# Live analysis. When enabled, every position of the game is analysed in the
+# background for up to LIVE_ANALYSIS_TIME seconds by a separate engine process
+# (STOCKFISH_LOCATION, using LIVE_ANALYSIS_THREADS threads). The evaluation and
+# best line are added as comments to the PGN, so they show up in the broadcast.
+LIVE_ANALYSIS=False
+LIVE_ANALYSIS_TIME=1.0
+LIVE_ANALYSIS_THREADS=1
+
 # General PGN settings. The PGN-string of the ongoing game is always printed to
 # the terminal output after a move. Here you can set names of players and event
 # names. This information is also passed to the .pgn file that is written when
@@ -27,3 +88,43 @@ PGN_WRITE_LOCATION="Game/games.pgn"
 PGN_EVENT_NAME="SquareOff Pro event"
 PGN_WHITE_PLAYER="White"
 PGN_BLACK_PLAYER="Black"
+
+# Multi-board mode (python3 MultiBoard.py). Every entry is a board, with the
+# settings above that should differ for that board. ADDRESS selects a specific
+# device, boards without one get the next SquareOff Pro found. For example:
+# BOARDS=[{"BOARD_NAME": "Table 1", "ENGINE_ELO": 1500},
+#         {"BOARD_NAME": "Table 2", "ADDRESS": "AA:BB:CC:DD:EE:FF", "ENGINE_PLAYERS": []}]
+BOARDS=[]
+
+# Move detection. Moves are normally derived from the pickup and putdown events
+# of the board, without waiting for a full board read. The board is still read
+# when a move is ambiguous, when events don't add up and after every
+# BOARD_VERIFY_INTERVAL derived moves, to verify it is in sync.
+INFER_MOVES_FROM_EVENTS=True
+BOARD_VERIFY_INTERVAL=10
+
+# Connection. The address of the last connected board is stored in
+# DEVICE_CACHE_PATH, so the next start connects to it directly instead of
+# scanning (None always scans). A board that disconnects is reconnected
+# automatically and the game continues where it was.
+DEVICE_CACHE_PATH="Game/last_device.txt"
+
+# Logging. LOG_LEVEL applies to everything, LOG_LEVELS overrides it per module,
+# for instance {"UartComm": "DEBUG"} to show every notification and board read,
+# or {"SquareOffInstance": "DEBUG"} for the squares considered by move detection.
+LOG_LEVEL="INFO"
+LOG_LEVELS={}
+
+# Debugging. When set to a file path, all notifications from and commands to the
+# board are appended to a compact binary log. Logs can be inspected and replayed
+# with NotificationLog.py (python3 NotificationLog.py replay <file>).
+RECORD_NOTIFICATIONS=None
+
+# Latency metrics for the stages between putting down a piece and the board
+# showing the result. Off by default. When enabled, a summary is logged every
+# METRICS_SUMMARY_INTERVAL seconds, a JSON report is written to METRICS_DUMP_PATH
+# at exit and, if METRICS_PORT is set, served on http://127.0.0.1:<port>/.
+METRICS_ENABLED=False
+METRICS_SUMMARY_INTERVAL=60
+METRICS_DUMP_PATH="metrics.json"
+METRICS_PORT=None